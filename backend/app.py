@@ -11,6 +11,13 @@ from backend.processor import start_raw_processing
 from backend.preview import start_generate_preview_from_raw
 from backend.camera_capture import start_capture_from_cameras
 from imgs_2_video import create_video_from_pngs
+from video_encoder import HLS_CODEC_INFO
+
+# HLS 播放列表与 fMP4 分片的 MIME 类型（mimetypes 默认不认识 .m4s）
+_STREAM_MIMETYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".m4s": "video/iso.segment",
+}
 
 
 def create_app() -> Flask:
@@ -125,6 +132,9 @@ def create_app() -> Flask:
                     raw_path=p.input_path,
                     frames_dir=p.frames_dir,
                     preview_base=os.path.join(p.case_dir, "preview"),
+                    proxy_path=p.preview_proxy_mp4,
+                    proxy_step=Config.PREVIEW_PROXY_STEP,
+                    proxy_scale=Config.PREVIEW_PROXY_SCALE,
                 )
             elif case_type == "mp4":
                 # 对 mp4 上传，直接将原始 mp4 作为 preview.mp4
@@ -170,17 +180,24 @@ def create_app() -> Flask:
     @app.get("/api/cases/<case_id>")
     @require_login
     def api_case_info(case_id: str):
-        case_dir = os.path.join(Config.CASES_ROOT, case_id)
-        meta = read_json(os.path.join(case_dir, "meta.json")) or {}
-        preview_path = os.path.join(case_dir, "preview.mp4")
-        preview_exists = os.path.exists(preview_path) and os.path.getsize(preview_path) > 1024
+        p = get_case_paths(Config.CASES_ROOT, case_id, input_ext=".raw")
+        meta = read_json(os.path.join(p.case_dir, "meta.json")) or {}
+        # 两档预览：完整预览（preview.mp4）优先，其次为抽帧缩小的代理预览
+        preview_tier, preview_url, preview_scale = None, None, None
+        if os.path.exists(p.preview_mp4) and os.path.getsize(p.preview_mp4) > 1024:
+            preview_tier, preview_url, preview_scale = "full", f"/api/cases/{case_id}/preview.mp4", 1.0
+        elif os.path.exists(p.preview_proxy_mp4) and os.path.getsize(p.preview_proxy_mp4) > 1024:
+            preview_tier, preview_url = "proxy", f"/api/cases/{case_id}/preview_proxy.mp4"
+            preview_scale = Config.PREVIEW_PROXY_SCALE
         return jsonify(
             {
                 "ok": True,
                 "case_id": case_id,
                 "meta": meta,
-                "preview_exists": preview_exists,
-                "preview_url": f"/api/cases/{case_id}/preview.mp4" if preview_exists else None,
+                "preview_exists": preview_tier is not None,
+                "preview_tier": preview_tier,          # "proxy" / "full" / None
+                "preview_scale": preview_scale,        # 预览相对原始分辨率的缩放比例（框选坐标需除以它）
+                "preview_url": preview_url,
             }
         )
 
@@ -220,14 +237,20 @@ def create_app() -> Flask:
         if not result:
             return jsonify({"ok": True, "processing": True, "status": "pending", "result": None, "progress": "等待中"})
         # If final video exists, provide URL for frontend
-        final_path = os.path.join(Config.CASES_ROOT, case_id, "raw_final_visualization_video.mp4")
-        final_exists = os.path.exists(final_path) and os.path.getsize(final_path) > 1024
+        p = get_case_paths(Config.CASES_ROOT, case_id, input_ext=".raw")
+        final_exists = os.path.exists(p.final_mp4) and os.path.getsize(p.final_mp4) > 1024
+        # 渲染过程中边写出的 HLS 播放列表：出现第一个分片后即可开始播放
+        stream_exists = os.path.exists(p.final_hls_m3u8) and os.path.getsize(p.final_hls_m3u8) > 0
+        # 分片实际使用的编码（前端据此判断浏览器能否用 MediaSource 播放；未知时等待完整 MP4）
+        stream_codec = read_json(os.path.join(os.path.dirname(p.final_hls_m3u8), HLS_CODEC_INFO)) or {}
         return jsonify(
             {
                 "ok": True,
                 **result,
                 "final_video_exists": final_exists,
                 "final_video_url": f"/api/cases/{case_id}/raw_final_visualization_video.mp4" if final_exists else None,
+                "final_stream_url": f"/api/cases/{case_id}/final_hls/index.m3u8" if stream_exists else None,
+                "final_stream_codecs": stream_codec.get("codecs"),
             }
         )
 
@@ -241,6 +264,11 @@ def create_app() -> Flask:
             return jsonify({"ok": False, "msg": "非法路径"}), 400
         if not os.path.exists(path):
             return jsonify({"ok": False, "msg": "文件不存在"}), 404
+        ext = os.path.splitext(path)[1].lower()
+        if ext in _STREAM_MIMETYPES:
+            # 播放列表在渲染过程中不断追加分片，不能缓存
+            max_age = 0 if ext == ".m3u8" else None
+            return send_file(path, mimetype=_STREAM_MIMETYPES[ext], conditional=True, max_age=max_age)
         return send_file(path, conditional=True)
 
     @app.get("/api/user/history")
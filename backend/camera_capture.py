@@ -9,6 +9,8 @@ import numpy as np
 from backend.cases import CasePaths
 from backend.config import Config
 from imgs_2_video import create_video_from_pngs
+from raw_index import build_raw_index
+from raw_to_frames import RAW_VALUE_MASK
 
 
 _LOCKS: Dict[str, threading.Lock] = {}
@@ -35,6 +37,7 @@ def start_capture_from_cameras(case_paths: CasePaths, duration_sec: int = 10) ->
     - 只使用 16 位 Y16 热像摄像头（不再打开 RGB 摄像头）
     - 生成：
         * input*.bin：逐帧顺序保存 16 位原始数据（保持 16 位深度）
+        * input*.bin_index.npz：帧数、逐帧统计等索引，供后续阶段复用
         * frames/*.png：从 16 位数据归一化得到的 8bit 预览图（仅用于前端显示）
         * preview.mp4：由预览 PNG 合成的浏览器友好 MP4，用于前端 ROI 选取
 
@@ -106,6 +109,14 @@ def start_capture_from_cameras(case_paths: CasePaths, duration_sec: int = 10) ->
                 raw_f.close()
                 cap.release()
 
+            # 采集完成后生成 RAW 索引：几何与位掩码须与后续阶段 get_raw_index 校验的参数一致
+            # （按 320x256、14 位 RAW 读取），否则首次使用时索引会被判定无效并重新扫描
+            try:
+                build_raw_index(case_paths.input_path, frame_width=320, frame_height=256,
+                                value_mask=RAW_VALUE_MASK)
+            except Exception as e:
+                print(f"[camera] 生成索引失败: {e}")
+
             # 从 PNG 序列合成 preview.mp4，供前端使用
             try:
                 create_video_from_pngs(case_paths.frames_dir, case_paths.preview_mp4)
@@ -12,9 +12,11 @@ class CasePaths:
     input_path: str
     frames_dir: str
     preview_mp4: str
+    preview_proxy_mp4: str
     params_json: str
     result_json: str
     final_mp4: str
+    final_hls_m3u8: str
 
 
 def new_case_id() -> str:
@@ -29,9 +31,11 @@ def get_case_paths(cases_root: str, case_id: str, input_ext: str) -> CasePaths:
         input_path=os.path.join(case_dir, f"input{input_ext}"),
         frames_dir=os.path.join(case_dir, "frames"),
         preview_mp4=os.path.join(case_dir, "preview.mp4"),
+        preview_proxy_mp4=os.path.join(case_dir, "preview_proxy.mp4"),
         params_json=os.path.join(case_dir, "params.json"),
         result_json=os.path.join(case_dir, "result.json"),
         final_mp4=os.path.join(case_dir, "raw_final_visualization_video.mp4"),
+        final_hls_m3u8=os.path.join(case_dir, "final_hls", "index.m3u8"),
     )
 
 
@@ -30,3 +30,39 @@ class Config:
     CAMERA_FRAME_HEIGHT = int(os.environ.get("IRV_CAMERA_HEIGHT", "512"))
     CAMERA_FPS = int(os.environ.get("IRV_CAMERA_FPS", "30"))
 
+    # RAW 泄漏量计算流程：为 1 时各阶段在内存中传递 NumPy 数组（结果与写盘模式一致），
+    # 为 0 时每个阶段写出中间帧堆栈，便于排查问题。
+    PIPELINE_IN_MEMORY = os.environ.get("IRV_PIPELINE_IN_MEMORY", "1") == "1"
+
+    # 背景建模后端："external"（默认）为原来的外部 C++ 程序（需要线性化视频和程序路径）；
+    # "median" / "percentile" / "gaussian" 为进程内估计，"online" 为在线增量背景（长录像、场景漂移时使用）。
+    # 进程内后端在真实 case 上与外部程序的前景/泄漏量对比记录之前，默认仍使用外部程序。
+    BACKGROUND_BACKEND = os.environ.get("IRV_BACKGROUND_BACKEND", "external")
+    ONLINE_BACKGROUND_WINDOW = int(os.environ.get("IRV_ONLINE_BACKGROUND_WINDOW", "250"))
+
+    # 热力图叠加帧并行渲染的进程数（默认等于 CPU 核数）
+    RENDER_WORKERS = int(os.environ.get("IRV_RENDER_WORKERS", str(os.cpu_count() or 1)))
+
+    # 两档预览：上传后先生成抽帧（每 N 帧取 1 帧）并缩小的代理预览，完整预览生成后替换
+    PREVIEW_PROXY_STEP = int(os.environ.get("IRV_PREVIEW_PROXY_STEP", "4"))
+    PREVIEW_PROXY_SCALE = float(os.environ.get("IRV_PREVIEW_PROXY_SCALE", "0.5"))
+
+    # 热力图视频边渲染边写出 HLS 分片（final_hls/index.m3u8），前端渲染过程中即可开始播放
+    FINAL_VIDEO_HLS = os.environ.get("IRV_FINAL_VIDEO_HLS", "1") == "1"
+
+    # 光流推理每次前向的图像对数（显存不足时调小）
+    FLOW_BATCH_SIZE = int(os.environ.get("IRV_FLOW_BATCH_SIZE", "4"))
+
+    # 光流引擎："flownet2"（默认，mmflow 深度模型）/ "dis" / "farneback"（OpenCV CPU 光流，
+    # 无 GPU 的边缘设备和 CI 使用），以及 CPU 光流并行计算的进程数
+    FLOW_ENGINE = os.environ.get("IRV_FLOW_ENGINE", "flownet2")
+    FLOW_WORKERS = int(os.environ.get("IRV_FLOW_WORKERS", str(os.cpu_count() or 1)))
+
+    # "onnx" 光流引擎：FlowNet2 导出的 ONNX 模型路径（可为 int8 量化模型），
+    # 以及 ONNX Runtime 算子内 / 算子间并行的线程数
+    FLOW_ONNX_MODEL = os.environ.get("IRV_FLOW_ONNX_MODEL", "")
+    FLOW_ONNX_INTRA_THREADS = int(os.environ.get("IRV_FLOW_ONNX_INTRA_THREADS", str(os.cpu_count() or 1)))
+    FLOW_ONNX_INTER_THREADS = int(os.environ.get("IRV_FLOW_ONNX_INTER_THREADS", "1"))
+
+    # 光流堆栈的存储类型："float32"（默认）或 "float16"（体积减半）
+    FLOW_STACK_DTYPE = os.environ.get("IRV_FLOW_STACK_DTYPE", "float32")
@@ -1,12 +1,17 @@
 import os
 import threading
-from typing import Dict
+from typing import Dict, Optional
 
+import cv2
 import numpy as np
 from PIL import Image
 
-from imgs_2_video import create_video_for_web
-from raw_to_frames import decode_raw_video
+from video_encoder import encode_frames
+from frame_cache import open_decoded_frames
+from raw_index import get_raw_index, index_min_max
+from raw_to_frames import count_raw_frames, iter_frame_blocks, iter_raw_frames
+
+PREVIEW_FPS = 25
 
 
 _LOCKS: Dict[str, threading.Lock] = {}
@@ -18,26 +23,64 @@ def _lock_for(case_id: str) -> threading.Lock:
     return _LOCKS[case_id]
 
 
-def _to_uint8_stack(frames):
-    gmin = min(float(np.min(f)) for f in frames)
-    gmax = max(float(np.max(f)) for f in frames)
+def _preview_start(index) -> int:
+    # 与处理流程一致：帧数足够时跳过前 100 帧
+    return 100 if index["frame_count"] >= 100 else 0
+
+
+def _to_uint8_stack(raw_path: str, index):
+    # 全局 min/max 直接取自 RAW 索引，只需一遍流式遍历做拉伸，内存只占一个块
+    start = _preview_start(index)
+    gmin, gmax = index_min_max(index, start=start)
     denom = max(gmax - gmin, 1e-9)
-    for f in frames:
-        arr = ((f - gmin) / denom * 255.0).clip(0, 255).astype("uint8")
-        yield arr
+    # 解码结果写入 case 目录下的帧缓存，后续泄漏量计算直接复用
+    frames = open_decoded_frames(raw_path, frame_width=320, frame_height=256)
+    for block in iter_frame_blocks(frames, start=start):
+        yield from ((block - gmin) / denom * 255.0).clip(0, 255).astype("uint8")
+
+
+def _proxy_size(width: int, height: int, scale: float):
+    # 缩放后取偶数尺寸（yuv420p 要求），至少 2 像素
+    return (max(2, int(round(width * scale / 2)) * 2), max(2, int(round(height * scale / 2)) * 2))
 
 
-def _save_preview_frames_png(frames, frames_dir: str) -> None:
+def _proxy_frames_u8(raw_path: str, step: int, scale: float):
+    """
+    代理预览帧：直接从 RAW（memmap）每隔 step 帧抽取一帧并缩小，不等 RAW 索引和解码缓存。
+    亮度拉伸使用抽样帧的全局最值，抽样帧很少，缩小后全部留在内存中。
+    """
+    start = 100 if count_raw_frames(raw_path, 320, 256) >= 100 else 0
+    size = _proxy_size(320, 256, scale)
+    small, gmin, gmax = [], None, None
+    for block in iter_raw_frames(raw_path, start=start, step=step):
+        bmin, bmax = int(block.min()), int(block.max())
+        gmin = bmin if gmin is None else min(gmin, bmin)
+        gmax = bmax if gmax is None else max(gmax, bmax)
+        small.extend(cv2.resize(f, size, interpolation=cv2.INTER_AREA) for f in block)
+    denom = max(gmax - gmin, 1e-9) if small else 1.0
+    for f in small:
+        yield ((f.astype(np.float32) - gmin) / denom * 255.0).clip(0, 255).astype("uint8")
+
+
+def _iter_preview_frames_png(raw_path: str, index, frames_dir: str):
+    # 逐帧保存 PNG（后续处理的热力图底图），同时把同一帧交给视频编码，不再让 ffmpeg 回读 PNG
     os.makedirs(frames_dir, exist_ok=True)
-    for i, arr in enumerate(_to_uint8_stack(frames)):
+    for i, arr in enumerate(_to_uint8_stack(raw_path, index)):
         Image.fromarray(arr).save(os.path.join(frames_dir, f"{i:04d}.png"))
+        yield arr
 
 
-def start_generate_preview_from_raw(case_id: str, raw_path: str, frames_dir: str, preview_base: str) -> None:
+def start_generate_preview_from_raw(case_id: str, raw_path: str, frames_dir: str, preview_base: str,
+                                    proxy_path: Optional[str] = None, proxy_step: int = 4,
+                                    proxy_scale: float = 0.5) -> None:
     """
     Generate:
+    - <proxy_path>  (optional low-res proxy: every proxy_step-th frame, scaled by proxy_scale,
+      same duration as the full preview; ready within seconds of upload)
+    - <raw_path>_index.npz  (RAW sidecar index, reused by later stages)
+    - <raw_path>_frames_u16.npy  (decoded frame cache, reused by processing)
     - <frames_dir>/*.png  (uint8 stretched)
-    - <preview_base>.mp4  (25fps, browser-friendly)
+    - <preview_base>.mp4  (25fps, browser-friendly; replaces the proxy once written)
     """
 
     def _run():
@@ -45,11 +88,18 @@ def start_generate_preview_from_raw(case_id: str, raw_path: str, frames_dir: str
         if not lock.acquire(blocking=False):
             return
         try:
-            frames = decode_raw_video(raw_path, frame_width=320, frame_height=256, save_as_tiff=False)
-            if len(frames) >= 100:
-                frames = frames[100:]
-            _save_preview_frames_png(frames, frames_dir)
-            create_video_for_web(frames_dir=frames_dir, out_base=preview_base)
+            if proxy_path:
+                # 第一档：抽帧缩小的代理预览，用户可以先开始框选；失败不影响完整预览
+                try:
+                    encode_frames(_proxy_frames_u8(raw_path, proxy_step, proxy_scale), proxy_path,
+                                  preset="proxy", fps=PREVIEW_FPS / proxy_step)
+                except Exception as e:
+                    print(f"[preview] 代理预览生成失败: {e}")
+            # 上传后首先生成 RAW 索引（帧数、逐帧统计等），后续阶段直接复用
+            index = get_raw_index(raw_path, frame_width=320, frame_height=256)
+            # 帧以 rawvideo 直接送入 ffmpeg，PNG 写盘与编码并行
+            encode_frames(_iter_preview_frames_png(raw_path, index, frames_dir), f"{preview_base}.mp4",
+                          preset="preview", fps=PREVIEW_FPS)
         finally:
             lock.release()
 
@@ -3,6 +3,7 @@ from datetime import datetime
 from typing import Dict
 
 from backend.cases import CasePaths, write_json
+from backend.config import Config
 
 # Reuse your existing pipeline for RAW as much as possible
 from infra_red_video_for_local_test import _predict_leakage_with_params
@@ -51,6 +52,18 @@ def start_raw_processing(case_paths: CasePaths) -> None:
                 params=params,
                 case_id=case_paths.case_id,
                 output_case_dir=case_paths.case_dir,
+                in_memory=Config.PIPELINE_IN_MEMORY,
+                background_backend=Config.BACKGROUND_BACKEND,
+                online_background_window=Config.ONLINE_BACKGROUND_WINDOW,
+                render_workers=Config.RENDER_WORKERS,
+                final_hls=Config.FINAL_VIDEO_HLS,
+                flow_batch_size=Config.FLOW_BATCH_SIZE,
+                flow_engine=Config.FLOW_ENGINE,
+                flow_workers=Config.FLOW_WORKERS,
+                flow_onnx_model=Config.FLOW_ONNX_MODEL or None,
+                flow_intra_op_threads=Config.FLOW_ONNX_INTRA_THREADS,
+                flow_inter_op_threads=Config.FLOW_ONNX_INTER_THREADS,
+                flow_dtype=Config.FLOW_STACK_DTYPE,
             )
 
             write_json(
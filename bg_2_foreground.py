@@ -1,13 +1,14 @@
-import os
 import cv2
 import numpy as np
 import tifffile
 from tqdm import tqdm
-import re  # 用于自然排序
 
+from frame_stack import DEFAULT_IO_WORKERS, FrameOutput, iter_named_blocks, iter_named_frames
+from preprocess_kernel import PreprocessKernel
 
-def reverse_linearize_background(png_path, output_tiff_path, min_val, scale_factor):
-    """将线性化的背景图 PNG 恢复为原始16位灰度图（TIFF）。"""
+
+def restore_background(png_path, min_val, scale_factor):
+    """将线性化的背景图 PNG 逆线性化，返回16位背景数组（不写盘）。"""
     # 读取8位PNG背景（线性化后的）
     img_mapped = cv2.imread(png_path, cv2.IMREAD_GRAYSCALE)
     if img_mapped is None:
@@ -19,43 +20,47 @@ def reverse_linearize_background(png_path, output_tiff_path, min_val, scale_fact
     # 逆线性化计算（恢复为16位）
     img_restored = img_mapped.astype(np.float32) * scale_factor + min_val
     img_restored = np.clip(img_restored, 0, 65535).astype(np.uint16)  # 16位范围限制
+    return img_restored
+
+
+def reverse_linearize_background(png_path, output_tiff_path, min_val, scale_factor):
+    """将线性化的背景图 PNG 恢复为原始16位灰度图（TIFF）。"""
+    img_restored = restore_background(png_path, min_val, scale_factor)
 
     # 保存为16位TIFF
     tifffile.imwrite(output_tiff_path, img_restored)
     print(f"背景图已逆线性化保存为: {output_tiff_path}")
 
 
-def extract_foreground_from_linearized_sequence(
-        frames_folder, background_tiff_path, output_folder
-):
-    """使用逆线性化后的16位TIFF背景图与帧图像序列相减，提取前景。"""
-    os.makedirs(output_folder, exist_ok=True)
-
-    # 读取16位TIFF背景图（逆线性化后的）
-    try:
-        background = tifffile.imread(background_tiff_path)
-    except Exception as e:
-        raise FileNotFoundError(f"未能读取背景TIFF图像: {background_tiff_path}，错误: {e}")
-
-    # 校验背景图格式
+def _check_background(background):
     if background.ndim != 2:
         raise ValueError(f"背景图必须是单通道灰度图，实际通道数: {background.ndim}")
     if background.dtype != np.uint16:
         raise TypeError(f"背景TIFF应为16位，实际为{background.dtype}")
-    bg_height, bg_width = background.shape
 
-    # 自然排序帧文件（按文件名中的数字排序）
-    frame_files = [f for f in os.listdir(frames_folder) if f.lower().endswith(('.tiff', '.tif'))]
-    # 提取文件名中的数字进行排序（如"frame_10.tif"提取10）
-    frame_files.sort(key=lambda x: int(re.findall(r'\d+', x)[-1]))
 
-    for filename in tqdm(frame_files, desc="提取前景"):
-        frame_path = os.path.join(frames_folder, filename)
-        # 用tifffile读取16位TIFF帧
-        try:
-            frame = tifffile.imread(frame_path)
-        except Exception as e:
-            print(f"跳过错误帧 {filename}: 读取失败 - {e}")
+def iter_foreground_frames(frames, background=None, online_model=None):
+    """
+    逐帧产出前景，边读边算：frames 可以是帧堆栈（.npz）、逐帧文件夹、(N, H, W) 数组，
+    或正在解码中的逐帧迭代器（例如按裁剪窗口流式读取RAW）。
+
+    参数：
+        frames: 输入帧（见 frame_stack.iter_named_frames）
+        background (np.ndarray | None): 固定的16位背景
+        online_model (OnlineBackgroundModel | None): 在线背景模型；提供时每帧先用当前背景
+            提取前景再更新背景，不需要固定背景
+
+    产出：
+        (name, foreground): 帧名与 uint16 前景；格式不符的帧会被跳过
+    """
+    if background is None and online_model is None:
+        raise ValueError("background 与 online_model 至少需要提供一个")
+    if background is not None:
+        _check_background(background)
+
+    for filename, frame in iter_named_frames(frames, exts=('.tiff', '.tif')):
+        if frame is None:
+            print(f"跳过错误帧 {filename}: 读取失败")
             continue
 
         # 校验帧图像格式
@@ -65,19 +70,107 @@ def extract_foreground_from_linearized_sequence(
         if frame.dtype != np.uint16:
             print(f"跳过 {filename}: 非16位TIFF（实际{frame.dtype}）")
             continue
-        if frame.shape != (bg_height, bg_width):
+
+        if online_model is not None:
+            yield filename, online_model.apply(frame)
+            continue
+
+        if frame.shape != background.shape:
             print(f"跳过 {filename}: 尺寸与背景不匹配（帧: {frame.shape}, 背景: {background.shape}）")
             continue
 
-        # 背景相减（确保结果非负，转为16位）
-        # foreground = np.maximum(frame - background, 0).astype(np.uint16)  # 替代cv2.subtract，更直观控制
-        foreground = np.maximum(frame.astype(np.int32) - background.astype(np.int32), 0).astype(np.uint16)
+        # 背景相减（uint16 饱和减法：max(frame, bg) - bg，结果非负，不经过 int32 临时数组）
+        foreground = np.maximum(frame, background)
+        foreground -= background
+        yield filename, foreground
+
+
+def _check_block(names, block, background):
+    # 整块校验（块内帧的尺寸和类型一致），不符合时逐帧打印跳过原因
+    reason = None
+    if block.ndim != 3:
+        reason = "非单通道灰度图"
+    elif block.dtype != np.uint16:
+        reason = f"非16位TIFF（实际{block.dtype}）"
+    elif block.shape[1:] != background.shape:
+        reason = f"尺寸与背景不匹配（帧: {block.shape[1:]}, 背景: {background.shape}）"
+    if reason is not None:
+        for name in names:
+            print(f"跳过 {name}: {reason}")
+        return False
+    return True
+
+
+def iter_foreground_blocks(frames, background, chunk=64, workers=1):
+    """
+    按块做前景提取：每次对 (n, H, W) uint16 帧块做饱和减法（融合内核，复用输出缓冲区），
+    产出 (names, foreground_block)。产出的块在取下一块之前有效，需要保留时请拷贝。
+
+    参数：
+        frames: 输入帧（帧堆栈、逐帧文件夹、(N, H, W) 数组或帧迭代器）
+        background (np.ndarray): 16位背景
+        chunk (int): 每块帧数（帧堆栈按其存储块）
+        workers (int): 逐帧文件夹并行读取的线程数
+    """
+    _check_background(background)
+    kernel = PreprocessKernel(0, 1, background=background)
+    for names, block in iter_named_blocks(frames, chunk, exts=('.tiff', '.tif'), workers=workers):
+        if not _check_block(names, block, background):
+            continue
+        yield names, kernel.run_block(block, planes=("foreground",))["foreground"]
+
 
-        # 保存为16位TIFF
-        output_path = os.path.join(output_folder, filename)
-        tifffile.imwrite(output_path, foreground)
+def extract_foreground_from_linearized_sequence(
+        frames_folder, background_tiff_path, output_folder, export_dir=None, online_model=None,
+        chunk=64, workers=DEFAULT_IO_WORKERS
+):
+    """
+    使用逆线性化后的16位TIFF背景图与帧图像序列相减，提取前景。
+    frames_folder / output_folder 可以是逐帧文件夹，也可以是帧堆栈（.npz）；
+    frames_folder 也可以是逐帧产出的迭代器，前景会随输入逐块写出，不必等全部帧就绪。
+    固定背景时按块做饱和减法，逐帧文件的读取和编码写盘由 workers 个线程并行完成。
+    export_dir 为可选的逐帧TIFF导出目录（调试用）。
+    online_model 为在线背景模型时不使用固定背景（background_tiff_path 可传 None），逐帧处理。
+
+    返回：
+        output_folder: 前景输出（文件夹或帧堆栈路径），可直接作为下一阶段的输入
+    """
+    background = None
+    if online_model is None:
+        # 读取16位TIFF背景图（逆线性化后的）
+        try:
+            background = tifffile.imread(background_tiff_path)
+        except Exception as e:
+            raise FileNotFoundError(f"未能读取背景TIFF图像: {background_tiff_path}，错误: {e}")
+
+    # 帧按文件名中的数字自然排序（如"frame_10.tif"提取10）；帧堆栈按写入顺序
+    with FrameOutput(output_folder, ext='.tiff', export_dir=export_dir, workers=workers) as out:
+        if online_model is not None:
+            for filename, foreground in tqdm(iter_foreground_frames(frames_folder, online_model=online_model),
+                                             desc="提取前景"):
+                out.write(filename, foreground)
+        else:
+            blocks = iter_foreground_blocks(frames_folder, background, chunk=chunk, workers=workers)
+            for names, foreground in tqdm(blocks, desc="提取前景"):
+                # 保存为16位TIFF（或写入帧堆栈）
+                for filename, frame in zip(names, foreground):
+                    out.write(filename, frame)
+                # 下一块会复用同一块输出缓冲区，先等这一块写完
+                out.flush()
 
     print(f"前景提取完成，结果保存在: {output_folder}")
+    return output_folder
+
+
+def subtract_background_stack(frames, background):
+    """
+    内存版前景提取：(N, H, W) uint16 帧数组逐帧减去背景（结果截断为非负），
+    与 extract_foreground_from_linearized_sequence 的计算一致，不读写磁盘。
+    """
+    if frames.shape[1:] != background.shape:
+        raise ValueError(f"帧尺寸与背景不匹配（帧: {frames.shape[1:]}, 背景: {background.shape}）")
+    kernel = PreprocessKernel(0, 1, background=background)
+    return kernel.run_stack(frames, planes=("foreground",))["foreground"]
 
 
 def full_foreground_pipeline(
@@ -87,6 +180,7 @@ def full_foreground_pipeline(
         restored_background_tiff_path,
         min_val,
         scale_factor,
+        export_dir=None,
 ):
     """总流程：先逆线性化背景图为16位TIFF，再用该背景提取前景。"""
     # 第一步：逆线性化背景图（PNG→16位TIFF）
@@ -101,7 +195,8 @@ def full_foreground_pipeline(
     extract_foreground_from_linearized_sequence(
         frames_folder=frames_folder,
         background_tiff_path=restored_background_tiff_path,  # 关键修改：使用恢复后的16位背景
-        output_folder=output_foreground_folder
+        output_folder=output_foreground_folder,
+        export_dir=export_dir
     )
 
 
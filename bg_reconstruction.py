@@ -1,5 +1,8 @@
 import subprocess
 import os
+import time
+
+import numpy as np
 
 def run_background_model(input_video_path, output_image_path, binary_path="./background_model"):
     """
@@ -50,3 +53,164 @@ def run_background_model(input_video_path, output_image_path, binary_path="./bac
         return output_image_path
     else:
         raise FileNotFoundError(f"未找到生成的背景图像文件：{output_image_path}")
+
+
+# ---------------- 进程内背景建模（不经过外部程序和 MP4/PNG 往返） ----------------
+BACKGROUND_BACKENDS = ("external", "median", "percentile", "gaussian", "online")
+
+
+def _percentile_background(frames, percentile, step, block_rows):
+    # 按行分带计算时间维分位数：每次只把 (N, block_rows, W) 读入内存
+    n_frames, height, width = frames.shape
+    background = np.empty((height, width), dtype=np.uint16)
+    for r in range(0, height, block_rows):
+        band = np.asarray(frames[::step, r:r + block_rows])
+        value = np.percentile(band, percentile, axis=0)
+        background[r:r + block_rows] = np.clip(np.rint(value), 0, 65535).astype(np.uint16)
+    return background
+
+
+class OnlineBackgroundModel:
+    """
+    在线增量背景模型（逐像素运行高斯均值）：每来一帧更新一次均值和方差，
+    只有与当前均值相差不超过 k 个标准差的像素参与更新（烟羽等前景不会被吸进背景）。
+    每帧开销与像素数成正比，内存占用固定（均值、方差和几块同尺寸的临时缓冲），
+    适合长录像边解码边出前景；window 越小背景跟随场景漂移越快。
+
+    前 window 帧的学习率取 1/(t+1)（相当于累积平均，尽快收敛），之后固定为 1/window。
+    """
+
+    def __init__(self, window=250, k=2.5, init_var=None):
+        """
+        参数:
+        window (int): 自适应窗口（帧数），学习率为 1/window
+        k (float): 判定为背景像素的标准差倍数
+        init_var (float | None): 初始方差；None 时取第一帧的空间方差
+        """
+        if window < 1:
+            raise ValueError("window 必须 >= 1")
+        self.window = window
+        self.k = k
+        self.init_var = init_var
+        self.frame_count = 0
+        self._mean = None
+
+    def _init(self, frame):
+        self._mean = frame.copy()
+        init_var = self.init_var if self.init_var is not None else float(frame.var())
+        self._var = np.full(frame.shape, max(init_var, 1.0), dtype=np.float32)
+        self._diff = np.empty_like(self._mean)
+        self._sq = np.empty_like(self._mean)
+        self._mask = np.empty(frame.shape, dtype=bool)
+
+    def update(self, frame):
+        """用一帧 uint16 图像更新背景。"""
+        frame = np.asarray(frame, dtype=np.float32)
+        if self._mean is None:
+            self._init(frame)
+            self.frame_count = 1
+            return
+        if frame.shape != self._mean.shape:
+            raise ValueError(f"帧尺寸与背景不匹配（帧: {frame.shape}, 背景: {self._mean.shape}）")
+        alpha = max(1.0 / (self.frame_count + 1), 1.0 / self.window)
+        diff, sq, mask = self._diff, self._sq, self._mask
+        np.subtract(frame, self._mean, out=diff)
+        np.multiply(diff, diff, out=sq)
+        np.less_equal(sq, (self.k * self.k) * self._var, out=mask)
+        np.subtract(sq, self._var, out=sq)
+        np.multiply(diff, mask, out=diff)
+        np.multiply(sq, mask, out=sq)
+        diff *= alpha
+        sq *= alpha
+        self._mean += diff
+        self._var += sq
+        self.frame_count += 1
+
+    @property
+    def background(self):
+        """当前背景估计（uint16）；还没有输入任何帧时为 None。"""
+        if self._mean is None:
+            return None
+        return np.clip(np.rint(self._mean), 0, 65535).astype(np.uint16)
+
+    def apply(self, frame):
+        """
+        先用当前背景对该帧做前景提取（饱和减法，结果非负），再用该帧更新背景。
+        第一帧时背景就是它自己，前景全为0。
+
+        返回:
+        np.ndarray: uint16 前景
+        """
+        frame = np.asarray(frame)
+        if self._mean is None:
+            # 第一帧只用于初始化背景（不再重复更新，以免方差减半、帧计数多算一帧）
+            self.update(frame)
+            return np.zeros(frame.shape, dtype=np.uint16)
+        background = self.background
+        foreground = np.maximum(frame, background)
+        foreground -= background
+        self.update(frame)
+        return foreground
+
+
+def _gaussian_background(frames, step, chunk, alpha, k):
+    # 用在线模型顺序过一遍所有帧，取最终的背景；
+    # 初始方差取前 chunk 帧逐像素方差的均值（比单帧空间方差更接近时间噪声）
+    frames = frames[::step]
+    init_var = float(np.asarray(frames[:chunk], dtype=np.float32).var(axis=0).mean())
+    model = OnlineBackgroundModel(window=max(int(round(1.0 / alpha)), 1), k=k, init_var=init_var)
+    for i in range(0, len(frames), chunk):
+        for frame in np.asarray(frames[i:i + chunk]):
+            model.update(frame)
+    return model.background
+
+
+def estimate_background(frames, method="median", percentile=50.0, step=1,
+                        block_rows=32, chunk=64, alpha=0.02, k=2.5):
+    """
+    直接在裁剪后的 uint16 帧序列上估计背景，返回 uint16 背景图，
+    不再经过 PNG→MP4→外部程序→8位PNG→逆线性化 的有损往返。
+
+    参数:
+    frames (np.ndarray): (N, H, W) uint16 帧数组（ndarray 或 memmap）
+    method (str): "median" 时间中值；"percentile" 时间分位数；"gaussian" 逐帧高斯均值
+    percentile (float): method="percentile" 时使用的分位数（0-100）
+    step (int): 帧抽样间隔（>1 时只用部分帧估计，速度更快）
+    block_rows (int): 中值/分位数按行分带计算时每带的行数（控制内存占用）
+    chunk (int): 高斯背景每次读入的帧数
+    alpha (float): 高斯背景的学习率
+    k (float): 高斯背景判定为背景像素的标准差倍数
+
+    返回:
+    np.ndarray: (H, W) uint16 背景图
+    """
+    if frames.ndim != 3 or len(frames) == 0:
+        raise ValueError(f"帧序列应为非空的 (N, H, W) 数组，实际形状: {frames.shape}")
+    if step <= 0 or block_rows <= 0 or chunk <= 0:
+        raise ValueError("step / block_rows / chunk 必须为正整数")
+
+    start_time = time.time()
+    if method == "median":
+        background = _percentile_background(frames, 50.0, step, block_rows)
+    elif method == "percentile":
+        if not 0 <= percentile <= 100:
+            raise ValueError(f"percentile 应在 0-100 之间，实际为 {percentile}")
+        background = _percentile_background(frames, percentile, step, block_rows)
+    elif method == "gaussian":
+        background = _gaussian_background(frames, step, chunk, alpha, k)
+    else:
+        raise ValueError(f"未知的背景建模方法 {method}，可选：{BACKGROUND_BACKENDS[1:4]}")
+    print(f"背景建模完成（{method}，{len(range(0, len(frames), step))} 帧），耗时 {time.time() - start_time:.2f} 秒")
+    return background
+
+# 调用方式：------------------------------------------------------------------------
+# # 外部 C++ 程序（输入为线性化视频，输出8位背景PNG）
+# run_background_model("linearized_video.mp4", "background_ori.png", binary_path="./background_model")
+#
+# # 进程内：直接由裁剪后的 uint16 帧得到 uint16 背景
+# background = estimate_background(cropped_frames, method="median")
+#
+# # 在线：边读帧边出前景，背景随场景漂移缓慢更新
+# model = OnlineBackgroundModel(window=250)
+# for frame in frames:
+#     foreground = model.apply(frame)
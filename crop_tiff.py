@@ -1,96 +1,171 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import numpy as np
 
+from frame_stack import DEFAULT_IO_WORKERS, FrameOutput
+
+
+def crop_stack(frames, crop_width, crop_height, offset_left, offset_top, copy=True):
+    """
+    对 (N, H, W) 帧数组（ndarray 或 memmap）做整段裁剪：一次切片得到裁剪视图，
+    并在同一次向量化归约中求出全局最小值和最大值。
+
+    参数：
+        frames (np.ndarray): (N, H, W) 帧数组
+        crop_width, crop_height, offset_left, offset_top: 同 crop_frames
+        copy (bool): True 时返回连续的裁剪副本；False 时返回原数组上的裁剪视图
+            （不拷贝，适合下游直接消费，但会一直引用整块原数组）
+
+    返回：
+        cropped (np.ndarray): (N, crop_height, crop_width) 裁剪帧；帧尺寸不足时为空数组
+        global_min (int | None): 全局最小值（无帧时为None）
+        global_max (int | None): 全局最大值（无帧时为None）
+    """
+    cropped = frames[:, offset_top:offset_top + crop_height,
+                     offset_left:offset_left + crop_width]
+    if cropped.shape[1:] != (crop_height, crop_width):
+        print(f"图像尺寸不足，无法裁剪：帧尺寸 {frames.shape[1:]}")
+        return np.empty((0, crop_height, crop_width), dtype=frames.dtype), None, None
+    if copy:
+        cropped = np.ascontiguousarray(cropped)
+    if len(cropped) == 0:
+        return cropped, None, None
+    return cropped, int(cropped.min()), int(cropped.max())
+
+
+def _read_tiff(path):
+    return cv2.imread(path, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
+
+
+def _write_crops(paths, crops, workers):
+    # cv2 编码/写盘时释放 GIL，线程池即可并行
+    if workers <= 1:
+        for path, crop in zip(paths, crops):
+            cv2.imwrite(path, crop)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(cv2.imwrite, paths, crops))
+
+
 def crop_frames(input_source, crop_width, crop_height,
                 offset_left, offset_top,
-                output_dir=None, file_ext=".tiff"):
+                output_dir=None, file_ext=".tiff", workers=DEFAULT_IO_WORKERS):
     """
     裁剪一组帧图像，并计算全局最小值和最大值。
 
     参数：
-        input_source (str | list[np.ndarray]):
-            - 如果是字符串，则认为是输入文件夹路径
-            - 如果是numpy数组列表，则直接处理这些帧
+        input_source (str | np.ndarray | Iterable[np.ndarray]):
+            - 如果是字符串，则认为是输入文件夹路径（多线程并行读取）
+            - 如果是 (N, H, W) 数组，则整段切片裁剪（见 crop_stack）
+            - 如果是numpy数组列表（或逐帧产出的迭代器），则直接处理这些帧
         crop_width (int): 裁剪宽度
         crop_height (int): 裁剪高度
         offset_left (int): 裁剪起始x位置
         offset_top (int): 裁剪起始y位置
-        output_dir (str): 保存裁剪结果的目录（None表示不保存）
+        output_dir (str): 保存裁剪结果的目录（None表示不保存，下游直接使用返回的数组）
         file_ext (str): 保存文件扩展名（仅在保存时有效）
+        workers (int): 并行读取/写入图像的线程数
 
     返回：
-        cropped_frames (list[np.ndarray]): 裁剪后的帧
+        cropped_frames (np.ndarray | list[np.ndarray]): 裁剪后的帧
+            （输入为 (N, H, W) 数组时为 (N, h, w) 数组，否则为列表）
         global_min (int): 全局最小值
         global_max (int): 全局最大值
     """
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    if isinstance(input_source, np.ndarray) and input_source.ndim == 3:
+        cropped, global_min, global_max = crop_stack(
+            input_source, crop_width, crop_height, offset_left, offset_top
+        )
+        if output_dir:
+            paths = [os.path.join(output_dir, f"frame_{idx+1:04d}{file_ext}")
+                     for idx in range(len(cropped))]
+            _write_crops(paths, cropped, workers)
+        if global_min is None:
+            return cropped, float('inf'), float('-inf')
+        return cropped, global_min, global_max
+
     cropped_frames = []
+    out_names = []
     global_min = float('inf')
     global_max = float('-inf')
 
-    if output_dir:
-        os.makedirs(output_dir, exist_ok=True)
-
     if isinstance(input_source, str):
-        # 从文件夹读取
-        filenames = sorted(os.listdir(input_source))
-        for filename in filenames:
-            if filename.lower().endswith(('.tiff', '.tif')):
-                img_path = os.path.join(input_source, filename)
-                img = cv2.imread(img_path, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
+        # 从文件夹读取（线程池并行解码，结果保持文件名顺序）
+        filenames = [f for f in sorted(os.listdir(input_source))
+                     if f.lower().endswith(('.tiff', '.tif'))]
+        paths = [os.path.join(input_source, f) for f in filenames]
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            images = pool.map(_read_tiff, paths)
+            for filename, img in zip(filenames, images):
                 if img is None:
                     print(f"无法读取图像: {filename}")
                     continue
 
+                # 拷贝裁剪区域，不让小视图一直引用整张解码图像
                 crop = img[offset_top:offset_top + crop_height,
-                           offset_left:offset_left + crop_width]
+                           offset_left:offset_left + crop_width].copy()
 
                 if crop.shape != (crop_height, crop_width):
                     print(f"图像尺寸不足，无法裁剪：{filename}")
                     continue
 
-                # 更新全局统计
-                current_min, current_max = np.min(crop), np.max(crop)
-                global_min = min(global_min, current_min)
-                global_max = max(global_max, current_max)
-
+                # 读取时顺带更新全局统计，不再额外堆叠一份全部裁剪帧
+                global_min = min(global_min, int(crop.min()))
+                global_max = max(global_max, int(crop.max()))
                 cropped_frames.append(crop)
+                out_names.append(filename)
 
-                if output_dir:
-                    out_path = os.path.join(output_dir, filename)
-                    cv2.imwrite(out_path, crop)
-
-    elif isinstance(input_source, list):
-        # 从内存帧数组读取
+    elif hasattr(input_source, '__iter__'):
+        # 从内存帧数组（或流式迭代器）读取
         for idx, img in enumerate(input_source):
+            # 拷贝裁剪区域，避免小视图一直引用整块解码缓冲
             crop = img[offset_top:offset_top + crop_height,
-                       offset_left:offset_left + crop_width]
+                       offset_left:offset_left + crop_width].copy()
 
             if crop.shape != (crop_height, crop_width):
                 print(f"第 {idx} 帧尺寸不足，无法裁剪")
                 continue
 
-            current_min, current_max = np.min(crop), np.max(crop)
-            global_min = min(global_min, current_min)
-            global_max = max(global_max, current_max)
-
+            global_min = min(global_min, int(crop.min()))
+            global_max = max(global_max, int(crop.max()))
             cropped_frames.append(crop)
-
-            if output_dir:
-                filename = f"frame_{idx+1:04d}{file_ext}"
-                out_path = os.path.join(output_dir, filename)
-                cv2.imwrite(out_path, crop)
+            out_names.append(f"frame_{idx+1:04d}{file_ext}")
 
     else:
-        raise ValueError("input_source 必须是文件夹路径或帧数组列表")
+        raise ValueError("input_source 必须是文件夹路径或帧数组序列")
+
+    if output_dir:
+        _write_crops([os.path.join(output_dir, name) for name in out_names], cropped_frames, workers)
 
     return cropped_frames, global_min, global_max
 
+def save_cropped_frames(frames, output_dir, file_ext=".tiff", export_dir=None, workers=DEFAULT_IO_WORKERS):
+    """
+    将已裁剪的帧按 frame_0001.tiff 的命名规则保存（与 crop_frames 的输出一致）。
+
+    参数：
+        frames (Iterable[np.ndarray]): 裁剪后的帧
+        output_dir (str): 保存目录；以 .npz 结尾时写入帧堆栈
+        file_ext (str): 逐帧保存时的文件扩展名
+        export_dir (str): 可选，额外逐帧导出的目录（调试用）
+        workers (int): 逐帧写文件时的并行线程数
+    """
+    with FrameOutput(output_dir, ext=file_ext, export_dir=export_dir, workers=workers) as out:
+        for idx, crop in enumerate(frames):
+            out.write(f"frame_{idx+1:04d}", crop)
+
 # 调用方式：-------------------------------------------------------------------------------
 # 直接处理第一步返回的帧数组
 # frames = decode_raw_video("video.raw", 320, 256, save_as_tiff=False)
 # cropped_frames, gmin, gmax = crop_frames(frames, 80, 60, 122, 76)
 # print("全局最小值:", gmin, "全局最大值:", gmax)
+# 整段 (N, H, W) 数组/memmap：一次切片 + 一次归约，不写盘
+# cropped, gmin, gmax = crop_stack(load_raw_frames("video.raw"), 80, 60, 122, 76)
 # 处理已有的 TIFF 文件夹（磁盘裁剪并保存）
 # cropped_frames, gmin, gmax = crop_frames(
 #     input_source="Q_10_frames_tiff",
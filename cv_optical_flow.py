@@ -0,0 +1,97 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+CV_FLOW_METHODS = ("dis", "farneback")
+DEFAULT_FLOW_WORKERS = os.cpu_count() or 1
+
+# 每个进程缓存一个 DIS 实例（创建开销不大，但逐对创建没有必要）
+_DIS = {}
+
+
+def _init_flow_worker():
+    # 每个进程只用单线程 OpenCV，避免多进程 × 多线程的过度订阅
+    cv2.setNumThreads(1)
+
+
+def _to_gray(img):
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return np.ascontiguousarray(img, dtype=np.uint8)
+
+
+def compute_cv_flow(img1, img2, method="dis"):
+    """
+    用 OpenCV 传统光流计算 img1→img2 的稠密光流（CPU）。
+
+    参数：
+        img1, img2 (np.ndarray): uint8 灰度或BGR图像
+        method (str): "dis"（DIS，默认 medium 预设）或 "farneback"
+
+    返回：
+        flow (np.ndarray): (H, W, 2) float32，单位为像素（与 FlowNet2 输出的 .flo 含义一致）
+    """
+    g1, g2 = _to_gray(img1), _to_gray(img2)
+    if method == "dis":
+        dis = _DIS.get(method)
+        if dis is None:
+            dis = _DIS[method] = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_MEDIUM)
+        flow = dis.calc(g1, g2, None)
+    elif method == "farneback":
+        flow = cv2.calcOpticalFlowFarneback(g1, g2, None, pyr_scale=0.5, levels=3, winsize=15,
+                                            iterations=3, poly_n=5, poly_sigma=1.2, flags=0)
+    else:
+        raise ValueError(f"未知的光流方法 {method}，可选：{CV_FLOW_METHODS}")
+    return flow.astype(np.float32, copy=False)
+
+
+def _flow_task(task):
+    """计算一对图像的光流（在工作进程中执行），返回 (名称, 光流, 错误信息)。"""
+    name, img1, img2, method = task
+    try:
+        return name, compute_cv_flow(img1, img2, method), None
+    except Exception as e:
+        return name, None, str(e)
+
+
+def iter_cv_flows(pairs, method="dis", workers=DEFAULT_FLOW_WORKERS):
+    """
+    按输入顺序产出每对图像的光流；workers > 1 时用进程池并行，最多同时提交 4 * workers 对。
+
+    参数：
+        pairs (Iterable): 产出 (pair_name, img1, img2) 的图像对迭代器
+        method (str): 见 CV_FLOW_METHODS
+        workers (int): 进程数（<=1 时在当前进程逐对计算）
+
+    产出：
+        (pair_name, flow, error): 失败时 flow 为 None，error 为错误信息
+    """
+    if method not in CV_FLOW_METHODS:
+        raise ValueError(f"未知的光流方法 {method}，可选：{CV_FLOW_METHODS}")
+    tasks = ((name, img1, img2, method) for name, img1, img2 in pairs)
+    if workers <= 1:
+        for task in tasks:
+            yield _flow_task(task)
+        return
+    # 后端在线程中调用本函数，fork 多线程进程不安全，这里统一用 spawn 启动工作进程
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_flow_worker) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(_flow_task, task))
+            if len(pending) >= 4 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# 调用方式：------------------------------------------------------------------------
+# from invert_and_pairs import iter_frame_pairs
+# for name, flow, error in iter_cv_flows(iter_frame_pairs(linear_frames), method="dis", workers=4):
+#     ...
+#
+# # 或通过统一入口写出 .flo：
+# run_optical_flow_inference(iter_frame_pairs(linear_frames), "out_flo", engine="dis")
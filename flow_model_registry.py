@@ -0,0 +1,119 @@
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import psutil
+
+# 进程内最多同时保留的光流模型数（不同 config/checkpoint/device 组合）
+MAX_CACHED_MODELS = max(1, int(os.environ.get("IRV_FLOW_MODEL_CACHE_SIZE", "2")))
+# 可用内存（CPU 为系统内存，CUDA 为显存）低于该值（MB）时按最久未使用的顺序释放模型
+MIN_FREE_MEMORY_MB = int(os.environ.get("IRV_FLOW_MODEL_MIN_FREE_MB", "1024"))
+
+_MODELS = OrderedDict()  # (config, checkpoint, device) -> model，按使用先后排序
+_LOCK = threading.Lock()
+_LOAD_LOCKS = {}
+
+
+def _model_key(config_file, checkpoint_file, device):
+    return os.path.abspath(config_file), os.path.abspath(checkpoint_file), str(device)
+
+
+def free_memory_mb(device="cpu"):
+    """设备当前可用内存（MB）：CUDA 设备为空闲显存，其他为系统可用内存。"""
+    if str(device).startswith("cuda"):
+        import torch
+        free, _ = torch.cuda.mem_get_info(torch.device(device))
+        return free / 2 ** 20
+    return psutil.virtual_memory().available / 2 ** 20
+
+
+def _release(devices):
+    gc.collect()
+    if any(str(d).startswith("cuda") for d in devices):
+        import torch
+        torch.cuda.empty_cache()
+
+
+def _pop_lru():
+    key, _ = _MODELS.popitem(last=False)
+    print(f"[模型缓存] 释放光流模型：{key[1]}（{key[2]}）")
+    return key[2]
+
+
+def trim_models(device="cpu", keep=0):
+    """
+    内存不足时按最久未使用的顺序释放缓存的模型，直到可用内存不低于 MIN_FREE_MEMORY_MB
+    或只剩最近使用的 keep 个模型。返回释放的模型数。
+    """
+    released = []
+    with _LOCK:
+        while len(_MODELS) > keep and free_memory_mb(device) < MIN_FREE_MEMORY_MB:
+            released.append(_pop_lru())
+    if released:
+        _release(released)
+    return len(released)
+
+
+def clear_models():
+    """释放全部缓存的模型。"""
+    with _LOCK:
+        devices = [key[2] for key in _MODELS]
+        _MODELS.clear()
+    _release(devices)
+
+
+def get_model(config_file, checkpoint_file, device, loader):
+    """
+    取得（必要时加载）光流模型。同一 (config, checkpoint, device) 在进程内只加载一次，
+    之后的 case 直接复用；并发请求同一模型时只有一个线程加载。
+
+    参数：
+        config_file, checkpoint_file (str): 模型配置与权重路径
+        device (str): 设备，如 'cuda:0' 或 'cpu'
+        loader (callable): loader(config_file, checkpoint_file, device=device) 返回模型，
+            例如 mmflow.apis.init_model
+
+    返回：
+        (model, load_time): load_time 为本次加载耗时（秒），命中缓存时为 0.0
+    """
+    key = _model_key(config_file, checkpoint_file, device)
+    with _LOCK:
+        if key in _MODELS:
+            _MODELS.move_to_end(key)
+            return _MODELS[key], 0.0
+        load_lock = _LOAD_LOCKS.setdefault(key, threading.Lock())
+
+    with load_lock:
+        with _LOCK:
+            if key in _MODELS:
+                _MODELS.move_to_end(key)
+                return _MODELS[key], 0.0
+            # 加载新模型前腾出位置：超过数量上限或内存不足时释放最久未使用的模型
+            released = []
+            while _MODELS and len(_MODELS) >= MAX_CACHED_MODELS:
+                released.append(_pop_lru())
+        if released:
+            _release(released)
+        trim_models(device)
+
+        start = time.time()
+        model = loader(config_file, checkpoint_file, device=device)
+        load_time = time.time() - start
+        with _LOCK:
+            _MODELS[key] = model
+        print(f"[模型缓存] 已加载光流模型：{checkpoint_file}（{device}），耗时 {load_time:.2f} 秒")
+        return model, load_time
+
+
+def cached_models():
+    """当前缓存的模型键列表（最久未使用的在前）。"""
+    with _LOCK:
+        return list(_MODELS)
+
+# 调用方式：------------------------------------------------------------------------
+# from mmflow.apis import init_model
+# model, load_time = get_model(config_file, checkpoint_file, "cuda:0", init_model)
+# ...                                   # 推理
+# trim_models("cuda:0", keep=1)         # 显存不足时释放其他模型
@@ -0,0 +1,150 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+FLOW_STACK_EXT = ".npy"
+FLOW_STACK_DTYPES = ("float32", "float16")
+
+# .npy 头部固定占 128 字节：先写占位头部逐帧追加数据，帧数确定后在 close() 时回填真实形状
+_HEADER_SIZE = 128
+_NPY_MAGIC = b"\x93NUMPY\x01\x00"
+
+
+def is_flow_stack_path(path):
+    """按扩展名判断路径是否为光流堆栈（.npy），否则视为 .flo 文件夹。"""
+    return isinstance(path, str) and path.lower().endswith(FLOW_STACK_EXT)
+
+
+def flow_index_path(path):
+    """光流堆栈的帧索引文件：<堆栈去扩展名>.index.json（帧名列表，第 i 个对应堆栈第 i 帧）。"""
+    return f"{os.path.splitext(path)[0]}.index.json"
+
+
+def _npy_header(shape, dtype):
+    # 按 .npy 1.0 格式生成固定长度的头部（空格填充，换行结尾），数据从第 _HEADER_SIZE 字节开始
+    desc = repr({"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": tuple(shape)})
+    text = desc.ljust(_HEADER_SIZE - len(_NPY_MAGIC) - 2 - 1) + "\n"
+    if len(_NPY_MAGIC) + 2 + len(text) != _HEADER_SIZE:
+        raise ValueError(f"光流堆栈形状 {shape} 超出头部长度")
+    return _NPY_MAGIC + struct.pack("<H", len(text)) + text.encode("latin1")
+
+
+class FlowStackWriter:
+    """
+    光流堆栈写入器：一个 case 的全部光流写入同一个 (N, H, W, 2) 的 .npy 文件（可选 float16），
+    帧名按写入顺序记录在索引文件中。逐帧追加，不需要预先知道帧数；
+    写入临时文件，close() 时原子替换，读者不会看到写了一半的堆栈。
+    """
+
+    def __init__(self, path, dtype="float32"):
+        if str(np.dtype(dtype)) not in FLOW_STACK_DTYPES:
+            raise ValueError(f"光流堆栈只支持 {FLOW_STACK_DTYPES}，收到 {dtype}")
+        self.path = path
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self._tmp = path + ".part"
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._f = open(self._tmp, "wb")
+        self._f.write(_npy_header((0, 0, 0, 2), self.dtype))
+        self._names = []
+        self._frame_shape = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def __len__(self):
+        return len(self._names)
+
+    def append(self, flow, name=None):
+        """追加一帧光流 (H, W, 2)；name 为帧名，默认按序号命名。"""
+        flow = np.ascontiguousarray(flow, dtype=self.dtype)
+        if flow.ndim != 3 or flow.shape[2] != 2:
+            raise ValueError(f"光流应为 (H, W, 2)，收到 {flow.shape}")
+        if self._frame_shape is None:
+            self._frame_shape = flow.shape
+        elif flow.shape != self._frame_shape:
+            raise ValueError(f"光流尺寸不一致：{flow.shape}，堆栈为 {self._frame_shape}")
+        self._f.write(flow.data)
+        self._names.append(name if name is not None else f"{len(self._names):04d}")
+
+    def close(self):
+        if self._f is None:
+            return
+        self._f.seek(0)
+        self._f.write(_npy_header((len(self._names),) + (self._frame_shape or (0, 0, 2)), self.dtype))
+        self._f.close()
+        self._f = None
+        index_path = flow_index_path(self.path)
+        with open(index_path + ".part", "w", encoding="utf-8") as f:
+            json.dump({"names": self._names}, f, ensure_ascii=False)
+        os.replace(index_path + ".part", index_path)
+        os.replace(self._tmp, self.path)
+
+    def abort(self):
+        if self._f is None:
+            return
+        self._f.close()
+        self._f = None
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+
+class FlowStack:
+    """
+    光流堆栈读取器：内存映射打开，stack[i] / stack.get(name) 返回第 i 帧的零拷贝只读视图
+    (H, W, 2)，数据类型为写入时的 float32 或 float16；同一帧反复访问不会重复读盘解析。
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"光流堆栈 {path} 不存在")
+        self.path = path
+        self.flows = np.load(path, mmap_mode="r")
+        with open(flow_index_path(path), encoding="utf-8") as f:
+            self.names = list(json.load(f)["names"])
+        if len(self.names) != len(self.flows):
+            raise ValueError(f"光流堆栈 {path} 与索引帧数不一致：{len(self.flows)} / {len(self.names)}")
+        self._name_to_idx = {n: i for i, n in enumerate(self.names)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        # 释放内存映射（已取出的视图仍持有映射，直到它们被回收）
+        self.flows = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, idx):
+        return self.flows[idx]
+
+    def index(self, name):
+        """帧名对应的帧序号。"""
+        return self._name_to_idx[name]
+
+    def get(self, name):
+        """按帧名取光流视图。"""
+        return self.flows[self._name_to_idx[name]]
+
+    def __iter__(self):
+        yield from zip(self.names, self.flows)
+
+# 调用方式：------------------------------------------------------------------------
+# with FlowStackWriter("case_infer_flow.npy", dtype="float16") as w:
+#     for name, flow in flows:
+#         w.append(flow, name)
+#
+# with FlowStack("case_infer_flow.npy") as stack:
+#     flow = stack[10]                    # 第10帧的零拷贝视图
+#     flow = stack.get("0110_img1")       # 按帧名读取
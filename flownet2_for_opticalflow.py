@@ -1,7 +1,19 @@
 import os
+import contextlib
 import glob
+import queue
+import threading
+import time
+import cv2
 import numpy as np
-from mmflow.apis import init_model, inference_model
+
+from cv_optical_flow import CV_FLOW_METHODS, DEFAULT_FLOW_WORKERS, iter_cv_flows
+from flow_stack import FlowStackWriter, is_flow_stack_path
+from onnx_optical_flow import DEFAULT_INTER_OP_THREADS, DEFAULT_INTRA_OP_THREADS
+
+FLOW_ENGINES = ("flownet2", "onnx") + CV_FLOW_METHODS
+# 需要加载模型（进程内缓存复用）的引擎
+_MODEL_ENGINES = ("flownet2", "onnx")
 
 
 def save_flow_as_flo(flow, filepath):
@@ -14,59 +26,243 @@ def save_flow_as_flo(flow, filepath):
         flow.astype(np.float32).tofile(f)
 
 
+def _iter_pair_files(input_dir):
+    # 旧的配对图像文件夹：按文件名排序后两两成对（{n}_img1.png, {n}_img2.png）
+    images = sorted(glob.glob(os.path.join(input_dir, '*.png')))
+    print(f"找到图像数: {len(images)}")
+    if len(images) < 2:
+        print("图像数量不足以成对推理")
+        return
+    for i in range(0, len(images) - 1, 2):
+        img1, img2 = images[i], images[i + 1]
+        print(f"正在处理图像对: {os.path.basename(img1)} 和 {os.path.basename(img2)}")
+        yield os.path.splitext(os.path.basename(img1))[0], img1, img2
+
+
+def _as_model_input(img):
+    # 与 cv2.imread 读取配对PNG的结果一致：灰度帧转为3通道BGR
+    if isinstance(img, np.ndarray) and img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    return img
+
+
+def _iter_batches(pairs, batch_size):
+    # 组批：图像（路径时用 cv2.imread 读成 BGR，与 mmflow 读图一致）在这里读好，前向时不再读盘
+    batch = []
+    for base_name, img1, img2 in pairs:
+        if isinstance(img1, str):
+            img1, img2 = cv2.imread(img1), cv2.imread(img2)
+        batch.append((base_name, _as_model_input(img1), _as_model_input(img2)))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _prefetch(iterable, depth=1):
+    """后台线程提前准备后续 depth 个元素，与当前批次的前向推理重叠；异常在取用时重新抛出。"""
+    items = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def _put(entry):
+        # 消费方提前结束时不再阻塞在 put 上
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker():
+        try:
+            for item in iterable:
+                if not _put((item, None)):
+                    return
+        except Exception as e:
+            _put((None, e))
+            return
+        _put((done, None))
+
+    threading.Thread(target=_worker, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def _iter_flownet2_flows(pairs, timing, config_file, checkpoint_file, device, batch_size):
+    # FlowNet2（mmflow）引擎：按批前向推理，产出 (pair_name, flow)
+    # 延迟导入：只用 CPU 引擎时不需要安装 mmflow（及模型缓存依赖的 torch / psutil）
+    from mmflow.apis import init_model, inference_model
+    from flow_model_registry import get_model, trim_models
+
+    # 初始化模型：同一进程内按 (config, checkpoint, device) 复用已加载的模型
+    print(f"初始化光流模型：{config_file}")
+    model, timing["load_time"] = get_model(config_file, checkpoint_file, device, init_model)
+
+    # 按批处理图像对：一次前向推理 batch_size 对
+    for batch in _prefetch(_iter_batches(pairs, batch_size)):
+        names, img1s, img2s = zip(*batch)
+        # 推理
+        start = time.time()
+        results = inference_model(model, list(img1s), list(img2s))
+        timing["inference_time"] += time.time() - start
+        # 批量输入时 inference_model 返回每对一个结果字典（前向光流为 'flow' 或 'flow_fw'）
+        yield from ((name, r.get('flow', r.get('flow_fw'))) for name, r in zip(names, results))
+
+    # 模型保持常驻供后续 case 复用；内存不足时释放其他模型
+    trim_models(device, keep=1)
+
+
+def _iter_onnx_flows(pairs, timing, onnx_model, batch_size, intra_op_threads, inter_op_threads):
+    # ONNX Runtime 引擎（CPU）：FlowNet2 导出的 ONNX 模型，组批与预取方式与 flownet2 引擎相同
+    from onnx_optical_flow import load_onnx_flow_model
+
+    print(f"初始化 ONNX 光流模型：{onnx_model}")
+    model, timing["load_time"] = load_onnx_flow_model(onnx_model, intra_op_threads, inter_op_threads)
+
+    for batch in _prefetch(_iter_batches(pairs, batch_size)):
+        names, img1s, img2s = zip(*batch)
+        start = time.time()
+        results = model.predict(img1s, img2s)
+        timing["inference_time"] += time.time() - start
+        yield from zip(names, results)
+
+
+def _iter_cv_engine_flows(pairs, timing, method, workers):
+    # OpenCV 传统光流引擎（CPU，多进程）：产出 (pair_name, flow)，单对失败时 flow 为 None
+    pairs = ((name, cv2.imread(img1) if isinstance(img1, str) else img1,
+              cv2.imread(img2) if isinstance(img2, str) else img2) for name, img1, img2 in pairs)
+    start = time.time()
+    for name, flow, error in iter_cv_flows(pairs, method=method, workers=workers):
+        if error is not None:
+            print(f"光流计算失败 {name}: {error}")
+        yield name, flow
+    timing["inference_time"] = time.time() - start
+
+
 def run_optical_flow_inference(
     input_dir,
     flo_output_dir,
-    config_file,
-    checkpoint_file,
-    device='cuda:0'
+    config_file=None,
+    checkpoint_file=None,
+    device='cuda:0',
+    batch_size=4,
+    engine="flownet2",
+    workers=DEFAULT_FLOW_WORKERS,
+    onnx_model=None,
+    intra_op_threads=DEFAULT_INTRA_OP_THREADS,
+    inter_op_threads=DEFAULT_INTER_OP_THREADS,
+    flow_dtype="float32",
+    flo_export_dir=None
 ):
     """
-    使用光流模型对图像对进行推理并保存 .flo 文件
+    使用光流模型对图像对进行推理，保存为光流堆栈或 .flo 文件
 
     参数：
-        input_dir (str): 包含成对输入图像的文件夹
-        flo_output_dir (str): 输出 .flo 文件的目录
-        config_file (str): 光流模型的 config 路径
-        checkpoint_file (str): 模型权重路径
-        device (str): 设备，如 'cuda:0' 或 'cpu'
-    """
-    # 初始化模型
-    print(f"初始化光流模型：{config_file}")
-    model = init_model(config_file, checkpoint_file, device=device)
+        input_dir (str | Iterable): 包含成对输入图像的文件夹，或直接产出
+            (pair_name, img1, img2) 的图像对迭代器（如 invert_and_pairs.iter_frame_pairs，
+            不经过配对PNG文件）；.flo 以 pair_name 命名
+        flo_output_dir (str): 输出路径。以 .npy 结尾时整个 case 的光流写成一个 (N, H, W, 2) 光流堆栈
+            （flow_stack.FlowStackWriter，帧名索引写在 <去扩展名>.index.json），否则为 .flo 文件目录
+        config_file (str): 光流模型的 config 路径（flownet2 引擎）
+        checkpoint_file (str): 模型权重路径（flownet2 引擎）
+        device (str): 设备，如 'cuda:0' 或 'cpu'（flownet2 引擎）
+        batch_size (int): 每次前向推理的图像对数；下一批图像由后台线程提前准备，
+            与当前批次的推理重叠。输出仍按图像对逐个保存为 .flo（flownet2 / onnx 引擎）
+        engine (str): 光流引擎，见 FLOW_ENGINES。"flownet2" 为 mmflow 深度模型；
+            "onnx" 为导出为 ONNX 的 FlowNet2，在 ONNX Runtime CPU 上推理（不需要 mmflow 和 GPU）；
+            "dis" / "farneback" 为 OpenCV 传统光流（纯 CPU）
+        workers (int): 传统光流引擎并行计算的进程数
+        onnx_model (str): onnx 引擎使用的 .onnx 模型路径（见 onnx_optical_flow.export_flownet2_onnx）
+        intra_op_threads, inter_op_threads (int): onnx 引擎算子内 / 算子间并行的线程数
+        flow_dtype (str): 光流堆栈的存储类型，"float32" 或 "float16"（体积减半）
+        flo_export_dir (str): 可选，同时按图像对导出 .flo 文件的目录（供外部工具使用）
 
-    # 创建输出目录
-    os.makedirs(flo_output_dir, exist_ok=True)
-
-    # 获取图像列表
-    images = sorted(glob.glob(os.path.join(input_dir, '*.png')))
-    print(f"找到图像数: {len(images)}")
+    返回：
+        timing (dict): {"pairs": 推理的图像对数, "load_time": 模型加载耗时（秒，命中缓存为0）,
+            "inference_time": 前向推理总耗时（秒）, "model_cached": 是否复用了已加载的模型}
+    """
+    if engine not in FLOW_ENGINES:
+        raise ValueError(f"未知的光流引擎 {engine}，可选：{FLOW_ENGINES}")
+    if batch_size <= 0:
+        raise ValueError("batch_size 必须为正整数")
+    if engine == "onnx" and not onnx_model:
+        raise ValueError("onnx 引擎需要指定 onnx_model")
 
-    if len(images) < 2:
-        print("图像数量不足以成对推理")
-        return
+    # 输出：光流堆栈，或 .flo 文件目录；可选再导出一份 .flo
+    stack = FlowStackWriter(flo_output_dir, dtype=flow_dtype) if is_flow_stack_path(flo_output_dir) else None
+    flo_dirs = [d for d in (None if stack is not None else flo_output_dir, flo_export_dir) if d]
+    for flo_dir in flo_dirs:
+        os.makedirs(flo_dir, exist_ok=True)
 
-    # 按对处理图像
-    for i in range(0, len(images) - 1, 2):
-        img1, img2 = images[i], images[i + 1]
-        print(f"正在处理图像对: {os.path.basename(img1)} 和 {os.path.basename(img2)}")
+    # 图像对：配对图像文件夹，或内存中的图像对迭代器
+    pairs = _iter_pair_files(input_dir) if isinstance(input_dir, str) else input_dir
 
-        # 推理
-        result = inference_model(model, img1, img2)
+    timing = {"load_time": 0.0, "inference_time": 0.0}
+    if engine == "flownet2":
+        flows = _iter_flownet2_flows(pairs, timing, config_file, checkpoint_file, device, batch_size)
+    elif engine == "onnx":
+        flows = _iter_onnx_flows(pairs, timing, onnx_model, batch_size, intra_op_threads, inter_op_threads)
+    else:
+        flows = _iter_cv_engine_flows(pairs, timing, engine, workers)
 
-        if result is None or result.size == 0:
-            print(f"无效光流结果: {img1} 和 {img2}")
-            continue
+    pair_count = 0
+    with stack if stack is not None else contextlib.nullcontext():
+        for base_name, result in flows:
+            pair_count += 1
+            if result is None or result.size == 0:
+                print(f"无效光流结果: {base_name}")
+                continue
 
-        # 构造输出文件名
-        base_name = os.path.splitext(os.path.basename(img1))[0]
-        flo_path = os.path.join(flo_output_dir, f'{base_name}.flo')
+            if stack is not None:
+                stack.append(result, base_name)
+            for flo_dir in flo_dirs:
+                # 保存 .flo 文件
+                save_flow_as_flo(result, os.path.join(flo_dir, f'{base_name}.flo'))
 
-        # 保存 .flo 文件
-        save_flow_as_flo(result, flo_path)
-        # print(f"已保存光流: {flo_path}")
+    load_time = timing["load_time"]
+    model_cached = engine in _MODEL_ENGINES and load_time == 0
+    print(f"光流推理完成（{engine}）：{pair_count} 对，模型加载 {load_time:.2f} 秒"
+          f"{'（复用已加载模型）' if model_cached else ''}，"
+          f"推理 {timing['inference_time']:.2f} 秒")
+    return {
+        "pairs": pair_count,
+        "load_time": load_time,
+        "inference_time": timing["inference_time"],
+        "model_cached": model_cached,
+    }
 
 # 调用示例：
+# # 整个 case 的光流写成一个 float16 光流堆栈，同时导出 .flo 供外部工具使用：
+# run_optical_flow_inference(iter_frame_pairs(linear_frames, invert=True), 'case_infer_flow.npy',
+#                            engine='dis', flow_dtype='float16', flo_export_dir='case_infer_flo')
+#
+# # 无 GPU 时使用导出的 ONNX 模型在 CPU 上推理 FlowNet2：
+# run_optical_flow_inference(iter_frame_pairs(linear_frames, invert=True), 'out_flo', engine='onnx',
+#                            onnx_model='pretrain_model/flownet2_int8.onnx', intra_op_threads=4)
+#
+# # 无 GPU 时使用 CPU 传统光流（多进程）：
+# run_optical_flow_inference(iter_frame_pairs(linear_frames), 'out_flo', engine='dis', workers=4)
+#
+# # 直接使用线性化帧的图像对（不写配对PNG）：
+# run_optical_flow_inference(
+#     input_dir=iter_frame_pairs(linear_frames, invert=True),
+#     flo_output_dir='infer_on_real_data/gf320_0526/out',
+#     config_file='configs/flownet2/flownet2_8x1_slong_flyingchairs_384x448.py',
+#     checkpoint_file='pretrain_model/flownet2_8x1_slong_flyingchairs_384x448_20220625_212801-88d61800.pth',
+#     device='cuda:0'
+# )
+#
 # run_optical_flow_inference(
 #     input_dir='data/real_data/frames_192_144_pairs_invert',
 #     flo_output_dir='infer_on_real_data/gf320_0526/out',
@@ -1,125 +1,315 @@
+import multiprocessing
 import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
 import numpy as np
 from PIL import Image
-import matplotlib.pyplot as plt
-from scipy.ndimage import binary_dilation, gaussian_filter
 
-from imgs_2_video import create_video_from_pngs
+from frame_stack import FrameStack, is_frame_stack_path
+from video_encoder import encode_frames
+
+DEFAULT_RENDER_WORKERS = os.cpu_count() or 1
+
+# ColorBrewer YlOrRd 9级色标（与 matplotlib 的 'YlOrRd' 相同的锚点，RGB）
+_YLORRD_ANCHORS = np.array([
+    (255, 255, 204), (255, 237, 160), (254, 217, 118),
+    (254, 178, 76), (253, 141, 60), (252, 78, 42),
+    (227, 26, 28), (189, 0, 38), (128, 0, 38),
+], dtype=np.float64) / 255.0
+
+
+def _build_ylorrd_lut(n=256):
+    # 锚点等距线性插值到 n 级，再按 matplotlib 的方式截断为 uint8；存为 BGR 便于直接配合 cv2
+    x = np.linspace(0.0, 1.0, len(_YLORRD_ANCHORS))
+    t = np.linspace(0.0, 1.0, n)
+    rgb = np.stack([np.interp(t, x, _YLORRD_ANCHORS[:, c]) for c in range(3)], axis=1)
+    return (rgb * 255).astype(np.uint8)[:, ::-1].copy()
+
+
+YLORRD_LUT_BGR = _build_ylorrd_lut()
+_DILATE_KERNEL = np.ones((5, 5), dtype=np.uint8)
+
+
+def _gaussian_blur(img, sigma):
+    # 可分离高斯模糊，结果与 scipy.ndimage.gaussian_filter(img, sigma) 一致：
+    # 核半径 int(4*sigma+0.5)，边界反射；整数输入时与 scipy 一样每个方向滤波后截断取整
+    radius = int(4.0 * sigma + 0.5)
+    kernel = cv2.getGaussianKernel(2 * radius + 1, sigma, cv2.CV_64F)
+    identity = np.ones((1, 1))
+    truncate = np.issubdtype(img.dtype, np.integer)
+    out = img.astype(np.float64)
+    for kx, ky in ((identity, kernel), (kernel, identity)):
+        out = cv2.sepFilter2D(out, -1, kx, ky, borderType=cv2.BORDER_REFLECT)
+        if truncate:
+            np.floor(out, out=out)
+    return out
+
+
+def render_heatmap(fg_array, sigma=1.5, threshold=10, size=None):
+    """
+    将一帧前景渲染为热力图（不经过 matplotlib）：阈值掩码→5x5膨胀→高斯模糊→
+    在有效像素范围内归一化→查 YlOrRd 色表。
+
+    参数：
+        fg_array (np.ndarray): 前景帧（单通道；多通道时取第一通道）
+        sigma (float): 高斯模糊强度
+        threshold (float): 显示阈值（浓度>该值才显色）
+        size (tuple | None): 目标尺寸 (w, h)；与前景尺寸不一致时先缩放
+
+    返回：
+        heatmap (np.ndarray): (h, w, 3) uint8 BGR 热力图
+        valid (np.ndarray): (h, w) bool，True 表示该像素显色（其余透明）
+    """
+    if fg_array.ndim == 3:
+        fg_array = fg_array[:, :, 0]  # 多通道转单通道（取第一通道）
+    # 确保前景尺寸与裁剪尺寸一致（若不一致，按裁剪尺寸缩放）
+    if size is not None and fg_array.shape != (size[1], size[0]):
+        fg_array = np.array(Image.fromarray(fg_array).resize(size, Image.LANCZOS))
+
+    # 步骤1：浓度阈值掩码；步骤2：膨胀（连接离散点，形成连续区域）
+    mask = (fg_array > threshold).astype(np.uint8)
+    dilated_mask = cv2.dilate(mask, _DILATE_KERNEL).astype(bool)
+    # 步骤3：高斯模糊（让颜色过渡自然）
+    blurred = _gaussian_blur(fg_array, sigma)
+    # 步骤4：仅保留膨胀后且浓度达标的像素
+    valid = dilated_mask & (blurred > threshold)
+
+    heatmap = np.zeros(fg_array.shape + (3,), dtype=np.uint8)
+    if valid.any():
+        vals = blurred[valid]
+        vmin, vmax = float(vals.min()), float(vals.max())
+        # 与 matplotlib 的 Normalize + 256级色表取色方式一致
+        norm = (vals - vmin) / (vmax - vmin) if vmax > vmin else np.zeros_like(vals)
+        lut_idx = np.clip((norm * len(YLORRD_LUT_BGR)).astype(np.int32), 0, len(YLORRD_LUT_BGR) - 1)
+        heatmap[valid] = YLORRD_LUT_BGR[lut_idx]
+    return heatmap, valid
+
+
+def render_overlay(base_bgr, fg_array, crop, sigma=1.5, threshold=10, opacity=1.0):
+    """
+    将前景热力图直接合成到原尺寸帧（BGR 数组，原地修改）的裁剪位置；
+    超出原图范围的部分会被裁掉。opacity 为热力图不透明度（1 为完全覆盖）。
+    """
+    x, y, w, h = (int(v) for v in crop)
+    heatmap, valid = render_heatmap(fg_array, sigma, threshold, size=(w, h))
+
+    # 与原图求交（裁剪框可能部分超出原图）
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, base_bgr.shape[1]), min(y + h, base_bgr.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return base_bgr
+    heatmap = heatmap[y0 - y:y1 - y, x0 - x:x1 - x]
+    valid = valid[y0 - y:y1 - y, x0 - x:x1 - x]
+    region = base_bgr[y0:y1, x0:x1]
+
+    if opacity >= 1.0:
+        region[valid] = heatmap[valid]
+    else:
+        blended = region[valid].astype(np.float32) * (1.0 - opacity) + heatmap[valid].astype(np.float32) * opacity
+        region[valid] = np.clip(np.rint(blended), 0, 255).astype(np.uint8)
+    return base_bgr
+
+
+def _init_render_worker():
+    # 每个进程只用单线程 OpenCV，避免多进程 × 多线程的过度订阅
+    cv2.setNumThreads(1)
+
+
+def _render_task(task):
+    """
+    渲染一帧（在工作进程中执行）：读取原图和前景→合成热力图。
+    返回 (序号, 结果, 错误信息)；encode 为 True 时结果为PNG字节，否则为BGR数组。
+    贴热力图失败但原图可读时，结果为未叠加的原图（错误信息照常返回）。
+    """
+    idx, fg, raw_path, crop, sigma, threshold, encode = task
+    raw_img = cv2.imread(raw_path, cv2.IMREAD_COLOR)
+    if raw_img is None:
+        return idx, None, f"无法读取原图像 {raw_path}"
+    error = None
+    try:
+        if isinstance(fg, str):
+            with Image.open(fg) as fg_img:
+                fg = np.array(fg_img)
+        render_overlay(raw_img, fg, crop, sigma, threshold)
+    except Exception as e:
+        error = str(e)
+    if not encode:
+        return idx, raw_img, error
+    ok, buf = cv2.imencode(".png", raw_img)
+    if not ok:
+        return idx, None, error or "PNG编码失败"
+    return idx, buf.tobytes(), error
+
+
+def _collect_overlay_inputs(input_foreground_dir, user_raw_image_dir):
+    # 列出前景（文件路径或帧数组）和原图路径，按顺序一一对应；出错时返回 None
+    fg_inputs = [] if isinstance(input_foreground_dir, np.ndarray) else [input_foreground_dir]
+    for path in fg_inputs + [user_raw_image_dir]:
+        if not os.path.exists(path):
+            print(f"错误：文件夹 {path} 不存在！")
+            return None
+
+    # 按文件名排序（确保帧顺序严格对应）；前景为帧堆栈（.npz）时按写入顺序
+    if isinstance(input_foreground_dir, np.ndarray):
+        # 内存模式：直接使用 (N, H, W) 前景帧数组
+        foregrounds = list(input_foreground_dir)
+    elif is_frame_stack_path(input_foreground_dir):
+        with FrameStack(input_foreground_dir) as fg_stack:
+            foregrounds = list(fg_stack.to_array())  # 裁剪尺寸的前景帧，整体读入内存
+    else:
+        foregrounds = [os.path.join(input_foreground_dir, f)
+                       for f in sorted(os.listdir(input_foreground_dir))
+                       if f.lower().endswith(('.tiff', '.tif'))]
+    raw_paths = [os.path.join(user_raw_image_dir, f)
+                 for f in sorted(os.listdir(user_raw_image_dir))
+                 if f.lower().endswith(('.png', '.jpg', '.tiff', '.bmp'))]
+
+    # 检查帧数量匹配
+    if len(foregrounds) != len(raw_paths):
+        print(f"错误：前景帧数量（{len(foregrounds)}）与原图像数量（{len(raw_paths)}）不匹配！")
+        return None
+    if not foregrounds:
+        print("错误：前景文件夹中无有效TIFF文件！")
+        return None
+    return foregrounds, raw_paths
+
+
+def _iter_render_results(foregrounds, raw_paths, crop, sigma, threshold, encode, workers):
+    # 按帧序产出渲染结果；workers > 1 时用进程池并行，最多同时提交 4 * workers 帧
+    tasks = ((idx, fg, raw_path, crop, sigma, threshold, encode)
+             for idx, (fg, raw_path) in enumerate(zip(foregrounds, raw_paths)))
+    if workers <= 1:
+        for task in tasks:
+            yield _render_task(task)
+        return
+    # 后端在线程中调用本函数，fork 多线程进程不安全，这里统一用 spawn 启动工作进程
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_render_worker) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(_render_task, task))
+            if len(pending) >= 4 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _parse_crop(crop_params):
+    # 解析裁剪参数（转为整数，确保坐标准确）
+    return (int(crop_params["x"]), int(crop_params["y"]),
+            int(crop_params["width"]), int(crop_params["height"]))
+
+
+def iter_overlay_frames(input_foreground_dir, user_raw_image_dir, crop_params,
+                        sigma=1.5, threshold=10, workers=DEFAULT_RENDER_WORKERS):
+    """
+    以帧流的形式产出叠加热力图后的帧（不写盘），顺序与输入一致。
+
+    产出：
+        (idx, frame, error): 帧序号（从0开始）、BGR帧（原图无法读取时为 None）、
+            该帧的错误信息（无错误时为 None）
+    """
+    inputs = _collect_overlay_inputs(input_foreground_dir, user_raw_image_dir)
+    if inputs is None:
+        return
+    foregrounds, raw_paths = inputs
+    yield from _iter_render_results(foregrounds, raw_paths, _parse_crop(crop_params),
+                                    sigma, threshold, False, workers)
+
 
 def generate_heatmap_and_paste_to_raw(
-    input_foreground_dir,  # 第6步输出的前景文件夹（TIFF）
+    input_foreground_dir,  # 第6步输出的前景文件夹（TIFF）、前景帧堆栈（.npz）或内存帧数组
     user_raw_image_dir,    # 用户指定的原尺寸图像文件夹
     crop_params,           # 裁剪参数（x:左偏移, y:上偏移, width:裁剪宽, height:裁剪高）
     output_frame_dir,      # 最终替换后的帧保存文件夹
     sigma=1.5,             # 高斯模糊强度（控制热力图平滑度）
-    threshold=10           # 热力图显示阈值（浓度>该值才显色）
+    threshold=10,          # 热力图显示阈值（浓度>该值才显色）
+    workers=DEFAULT_RENDER_WORKERS  # 并行渲染的进程数（<=1 时在当前进程逐帧渲染）
 ):
     """
     直接将热力图形式的前景，贴到原尺寸图像的对应裁剪位置
     流程：前景→热力图→按裁剪参数贴到原图像→保存替换后帧
+    各帧由进程池并行渲染和编码，按顺序写出连续编号的 0001.png、0002.png ...；
+    单帧出错不会中断整个流程：贴图失败的帧保留原图，原图无法读取的帧被跳过，
+    出错的帧在最后统一汇报。至少写出一帧时返回 True。
     """
-    # 输入合法性检查
-    for path in [input_foreground_dir, user_raw_image_dir]:
-        if not os.path.exists(path):
-            print(f"错误：文件夹 {path} 不存在！")
-            return False
+    inputs = _collect_overlay_inputs(input_foreground_dir, user_raw_image_dir)
+    if inputs is None:
+        return False
+    foregrounds, raw_paths = inputs
     os.makedirs(output_frame_dir, exist_ok=True)
     print(f"替换后帧将保存到：{output_frame_dir}")
 
-    # 按文件名排序（确保帧顺序严格对应）
-    foreground_files = sorted([f for f in os.listdir(input_foreground_dir) 
-                              if f.lower().endswith(('.tiff', '.tif'))])
-    raw_files = sorted([f for f in os.listdir(user_raw_image_dir) 
-                       if f.lower().endswith(('.png', '.jpg', '.tiff', '.bmp'))])
+    crop = _parse_crop(crop_params)
+    print(f"\n热力图粘贴参数：位置({crop[0]},{crop[1]})，尺寸({crop[2]}x{crop[3]})，进程数 {workers}")
 
-    # 检查帧数量匹配
-    if len(foreground_files) != len(raw_files):
-        print(f"错误：前景帧数量（{len(foreground_files)}）与原图像数量（{len(raw_files)}）不匹配！")
-        return False
-    if not foreground_files:
-        print("错误：前景文件夹中无有效TIFF文件！")
-        return False
+    start_time = time.time()
+    written, errors = 0, []
+    for idx, png_bytes, error in _iter_render_results(foregrounds, raw_paths, crop,
+                                                      sigma, threshold, True, workers):
+        raw_fn = os.path.basename(raw_paths[idx])
+        if error is not None:
+            errors.append((raw_fn, error))
+        if png_bytes is None:
+            continue
+        # 保存替换后的帧（按写出顺序连续编号，确保 ffmpeg 的 %04d 序列不断档）
+        written += 1
+        with open(os.path.join(output_frame_dir, f"{written:04d}.png"), "wb") as f:
+            f.write(png_bytes)
+        if written % 50 == 0:
+            print(f"已处理 {idx + 1}/{len(raw_paths)} 帧")
 
-    # 解析裁剪参数（转为整数，确保坐标准确）
-    crop_x = int(crop_params["x"])
-    crop_y = int(crop_params["y"])
-    crop_w = int(crop_params["width"])
-    crop_h = int(crop_params["height"])
-    print(f"\n热力图粘贴参数：位置({crop_x},{crop_y})，尺寸({crop_w}x{crop_h})")
-
-    # 逐帧处理：前景→热力图→贴到原图像
-    for idx, (fg_fn, raw_fn) in enumerate(zip(foreground_files, raw_files), 1):
-        fg_path = os.path.join(input_foreground_dir, fg_fn)
-        raw_path = os.path.join(user_raw_image_dir, raw_fn)
-        print(f"处理第 {idx}/{len(foreground_files)} 帧：{raw_fn}")
-
-        try:
-            # 1. 读取前景TIFF并转为单通道数组
-            with Image.open(fg_path) as fg_img:
-                fg_array = np.array(fg_img)
-                if len(fg_array.shape) == 3:
-                    fg_array = fg_array[:, :, 0]  # 多通道转单通道（取第一通道）
-                # 确保前景尺寸与裁剪尺寸一致（若不一致，按裁剪尺寸缩放）
-                if fg_array.shape != (crop_h, crop_w):
-                    fg_img_resized = fg_img.resize((crop_w, crop_h), Image.LANCZOS)
-                    fg_array = np.array(fg_img_resized)
-
-            # 2. 生成平滑热力图（消除像素感+渐变效果）
-            # 步骤1：创建浓度阈值掩码（只显示>threshold的区域）
-            mask = fg_array > threshold
-            # 步骤2：膨胀操作（连接离散点，形成连续区域）
-            dilated_mask = binary_dilation(mask, structure=np.ones((5, 5)))
-            # 步骤3：高斯模糊（让颜色过渡自然）
-            blurred_array = gaussian_filter(fg_array, sigma=sigma)
-            # 步骤4：过滤无效区域（仅保留膨胀后且浓度达标的像素）
-            masked_heatmap = np.where(dilated_mask & (blurred_array > threshold), blurred_array, np.nan)
-
-            # 3. 渲染热力图为PIL图像（带透明背景）
-            # 创建与裁剪尺寸匹配的画布
-            fig, ax = plt.subplots(figsize=(crop_w/100, crop_h/100), dpi=100)
-            ax.axis('off')  # 隐藏坐标轴
-            # 渲染热力图（双线性插值确保平滑）
-            valid_vals = masked_heatmap[~np.isnan(masked_heatmap)]
-            if len(valid_vals) > 0:
-                im = ax.imshow(
-                    masked_heatmap,
-                    cmap='YlOrRd',  # 黄→橙→红渐变（符合之前需求）
-                    vmin=valid_vals.min(),
-                    vmax=valid_vals.max(),
-                    interpolation='bilinear'  # 关键：消除像素感
-                )
-            # 保存热力图为临时PNG（透明背景）
-            temp_heatmap = os.path.join(output_frame_dir, f"temp_heatmap_{idx}.png")
-            plt.subplots_adjust(left=0, right=1, top=1, bottom=0)  # 移除边距
-            plt.savefig(
-                temp_heatmap,
-                dpi=100,
-                bbox_inches='tight',
-                pad_inches=0,
-                transparent=True  # 背景透明，只保留热力图区域
-            )
-            plt.close()  # 关闭画布，释放内存
-
-            # 4. 将热力图贴到原尺寸图像的对应裁剪位置
-            # 读取原图像（转为RGBA支持透明叠加）
-            raw_img = Image.open(raw_path).convert("RGBA")
-            # 读取热力图（带透明通道）
-            heatmap_img = Image.open(temp_heatmap).convert("RGBA")
-            # 粘贴热力图到原图像的裁剪位置（透明区域不覆盖原图像）
-            raw_img.paste(heatmap_img, (crop_x, crop_y), heatmap_img)
-
-            # 5. 保存替换后的帧（转为RGB格式，兼容视频生成）
-            output_fn = f"{idx:04d}.png"  # 按顺序命名，确保视频帧正确
-            output_path = os.path.join(output_frame_dir, output_fn)
-            raw_img.convert("RGB").save(output_path)
-
-            # 6. 删除临时热力图文件
-            os.remove(temp_heatmap)
-
-        except Exception as e:
-            print(f"处理帧 {raw_fn} 出错：{str(e)}")
-            return False
-
-    print(f"\n所有帧处理完成！替换后帧路径：{output_frame_dir}")
-    return True
+    for raw_fn, error in errors:
+        print(f"处理帧 {raw_fn} 出错：{error}")
+    print(f"\n帧处理完成：写出 {written}/{len(raw_paths)} 帧，出错 {len(errors)} 帧，"
+          f"耗时 {time.time() - start_time:.2f} 秒。替换后帧路径：{output_frame_dir}")
+    return written > 0
+
+
+def render_heatmap_video(
+    input_foreground_dir,  # 前景文件夹（TIFF）、前景帧堆栈（.npz）或内存帧数组
+    user_raw_image_dir,    # 用户指定的原尺寸图像文件夹
+    crop_params,           # 裁剪参数（x:左偏移, y:上偏移, width:裁剪宽, height:裁剪高）
+    output_video_path,     # 输出视频路径（.mp4）
+    sigma=1.5,
+    threshold=10,
+    workers=DEFAULT_RENDER_WORKERS,
+    fps=25,
+    hls_dir=None           # 可选：边渲染边写出 HLS 分片的目录（前端可在渲染过程中开始播放）
+):
+    """
+    与 generate_heatmap_and_paste_to_raw 相同的贴图流程，但渲染好的帧直接以 rawvideo
+    送入 ffmpeg 编码，不再经过 PNG 编码、%04d 帧目录和 ffmpeg 回读解码。
+    单帧错误的处理方式相同（贴图失败保留原图，原图无法读取则跳过），最后统一汇报。
+    提供 hls_dir 时，渲染过程中同时写出 hls_dir/index.m3u8 及分片，MP4 在编码结束后才出现。
+
+    返回：
+        str | None: 输出视频路径；没有任何可用帧时返回 None
+    """
+    inputs = _collect_overlay_inputs(input_foreground_dir, user_raw_image_dir)
+    if inputs is None:
+        return None
+    foregrounds, raw_paths = inputs
+    crop = _parse_crop(crop_params)
+    print(f"\n热力图粘贴参数：位置({crop[0]},{crop[1]})，尺寸({crop[2]}x{crop[3]})，进程数 {workers}")
+
+    start_time = time.time()
+    errors = []
+
+    def _frames():
+        for idx, frame, error in _iter_render_results(foregrounds, raw_paths, crop,
+                                                      sigma, threshold, False, workers):
+            if error is not None:
+                errors.append((os.path.basename(raw_paths[idx]), error))
+            if frame is not None:
+                yield frame
 
+    video_path = encode_frames(_frames(), output_video_path, preset="final", fps=fps, hls_dir=hls_dir)
+    for raw_fn, error in errors:
+        print(f"处理帧 {raw_fn} 出错：{error}")
+    print(f"\n热力图视频完成：共 {len(raw_paths)} 帧，出错 {len(errors)} 帧，"
+          f"耗时 {time.time() - start_time:.2f} 秒。视频路径：{output_video_path}")
+    return video_path
@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+from typing import Dict
+
+import numpy as np
+
+from raw_to_frames import iter_raw_frames, count_raw_frames
+
+
+_LOCKS: Dict[str, threading.Lock] = {}
+_LOCKS_GUARD = threading.Lock()
+
+
+def _lock_for(path: str) -> threading.Lock:
+    with _LOCKS_GUARD:
+        if path not in _LOCKS:
+            _LOCKS[path] = threading.Lock()
+        return _LOCKS[path]
+
+
+def decoded_cache_path(raw_path):
+    """RAW文件对应的解码帧缓存路径（uint16 .npy，与RAW同目录）。"""
+    return f"{raw_path}_frames_u16.npy"
+
+
+def _cache_is_valid(cache_path, raw_path, expected_shape):
+    if not os.path.exists(cache_path):
+        return False
+    # RAW 在缓存生成之后被改动过，缓存作废
+    if os.path.getmtime(cache_path) < os.path.getmtime(raw_path):
+        return False
+    try:
+        cached = np.load(cache_path, mmap_mode='r')
+    except Exception:
+        return False
+    return cached.shape == expected_shape and cached.dtype == np.uint16
+
+
+def _fill_cache(raw_path, cache_path, shape, frame_width, frame_height, chunk):
+    start_time = time.time()
+    tmp = cache_path + ".tmp"
+    out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint16, shape=shape)
+    pos = 0
+    for block in iter_raw_frames(raw_path, chunk=chunk,
+                                 frame_width=frame_width, frame_height=frame_height):
+        out[pos:pos + len(block)] = block
+        pos += len(block)
+    out.flush()
+    del out
+    os.replace(tmp, cache_path)
+    print(f"解码帧缓存已生成：{cache_path}（{shape[0]} 帧，耗时 {time.time() - start_time:.2f} 秒）")
+
+
+def open_decoded_frames(raw_path, frame_width=320, frame_height=256, chunk=64):
+    """
+    返回RAW解码帧缓存的只读memmap (N, H, W)，像素已做14位掩码。
+    缓存不存在或RAW已变化时解码一次并写入缓存；同一RAW的并发调用者
+    会等待这一次进行中的解码完成后直接复用，而不是各自重复解码。
+
+    参数：
+        raw_path (str): RAW文件路径
+        frame_width (int): 每帧宽度（像素）
+        frame_height (int): 每帧高度（像素）
+        chunk (int): 填充缓存时每次解码的帧数
+
+    返回：
+        frames (np.memmap): 形状为 (N, frame_height, frame_width) 的uint16只读数组
+    """
+    cache_path = decoded_cache_path(raw_path)
+    shape = (count_raw_frames(raw_path, frame_width, frame_height), frame_height, frame_width)
+    with _lock_for(os.path.abspath(cache_path)):
+        if not _cache_is_valid(cache_path, raw_path, shape):
+            _fill_cache(raw_path, cache_path, shape, frame_width, frame_height, chunk)
+    return np.load(cache_path, mmap_mode='r')
+
+# 调用方式：------------------------------------------------------------------------
+# frames = open_decoded_frames("video.raw", 320, 256)   # 第一次调用解码并写缓存
+# frames = open_decoded_frames("video.raw", 320, 256)   # 之后直接复用
+# roi_frames, gmin, gmax = read_frames_roi(frames, (122, 76, 80, 60), start=100)
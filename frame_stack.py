@@ -0,0 +1,395 @@
+import os
+import re
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import tifffile
+
+STACK_EXT = ".npz"
+DEFAULT_IO_WORKERS = min(8, os.cpu_count() or 1)  # 逐帧文件读写的默认线程数
+
+
+def is_frame_stack_path(path):
+    """按扩展名判断路径是否为帧堆栈文件（.npz），否则视为逐帧文件夹。"""
+    return isinstance(path, str) and path.lower().endswith(STACK_EXT)
+
+
+def _natural_key(name):
+    # 与各阶段原有逻辑一致：按文件名中最后一段数字排序（frame_0164.tif -> 164）
+    nums = re.findall(r'\d+', name)
+    return (int(nums[-1]) if nums else float('inf'), name)
+
+
+class FrameStackWriter:
+    """
+    分块帧堆栈写入器：一个阶段的所有帧写入同一个 .npz（zip）文件，
+    每 chunk 帧存为一个 chunk_XXXXX.npy 成员，可选无损压缩（deflate）。
+    写入临时文件，close() 时原子替换，读者不会看到写了一半的堆栈。
+    """
+
+    def __init__(self, path, chunk=64, compress=False):
+        if chunk <= 0:
+            raise ValueError("chunk 必须为正整数")
+        self.path = path
+        self.chunk = chunk
+        self._tmp = path + ".tmp"
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        self._zf = zipfile.ZipFile(
+            self._tmp, 'w',
+            compression=zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED,
+            allowZip64=True
+        )
+        self._pending = None  # 预分配的 (chunk, H, W) 块缓冲，append 时把帧拷进去
+        self._n_pending = 0
+        self._names = []
+        self._n_chunks = 0
+        self._frame_shape = None
+        self._dtype = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def __len__(self):
+        return len(self._names)
+
+    def _write_member(self, key, arr):
+        with self._zf.open(f"{key}.npy", 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.ascontiguousarray(arr), allow_pickle=False)
+
+    def _flush(self):
+        if not self._n_pending:
+            return
+        self._write_member(f"chunk_{self._n_chunks:05d}", self._pending[:self._n_pending])
+        self._n_chunks += 1
+        self._n_pending = 0
+
+    def append(self, frame, name=None):
+        """追加一帧；name 为帧名（不含扩展名），默认按序号命名。帧会被拷贝，调用方可立即复用其缓冲区。"""
+        frame = np.asarray(frame)
+        if self._frame_shape is None:
+            self._frame_shape, self._dtype = frame.shape, frame.dtype
+            self._pending = np.empty((self.chunk,) + frame.shape, dtype=frame.dtype)
+        elif frame.shape != self._frame_shape or frame.dtype != self._dtype:
+            raise ValueError(
+                f"帧尺寸/类型不一致：{frame.shape}/{frame.dtype}，"
+                f"堆栈为 {self._frame_shape}/{self._dtype}"
+            )
+        self._pending[self._n_pending] = frame
+        self._n_pending += 1
+        self._names.append(name if name is not None else f"{len(self._names):04d}")
+        if self._n_pending >= self.chunk:
+            self._flush()
+
+    def extend(self, frames, names=None):
+        """批量追加帧（可以是 (N, H, W) 数组或帧迭代器）。"""
+        names = iter(names) if names is not None else None
+        for frame in frames:
+            self.append(frame, next(names) if names is not None else None)
+
+    def close(self):
+        if self._zf is None:
+            return
+        self._flush()
+        self._write_member("names", np.array(self._names, dtype=str))
+        self._write_member("meta", np.array([self.chunk, len(self._names)], dtype=np.int64))
+        self._write_member("frame_shape", np.array(self._frame_shape or (), dtype=np.int64))
+        self._write_member("dtype", np.array(str(self._dtype or "uint8")))
+        self._zf.close()
+        self._zf = None
+        os.replace(self._tmp, self.path)
+
+    def abort(self):
+        if self._zf is None:
+            return
+        self._zf.close()
+        self._zf = None
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+
+class FrameStack:
+    """
+    帧堆栈读取器：按帧序号随机访问（只解压所在的块），也可按块顺序遍历。
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"帧堆栈 {path} 不存在")
+        self.path = path
+        self._npz = np.load(path, allow_pickle=False)
+        self.names = [str(n) for n in self._npz["names"]]
+        self.chunk, count = (int(v) for v in self._npz["meta"])
+        self.frame_shape = tuple(int(v) for v in self._npz["frame_shape"])
+        self.dtype = np.dtype(self._npz["dtype"].item())
+        self._n_chunks = (count + self.chunk - 1) // self.chunk
+        self._name_to_idx = {n: i for i, n in enumerate(self.names)}
+        self._lock = threading.Lock()
+        self._cached_idx, self._cached_chunk = None, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self._npz.close()
+
+    def __len__(self):
+        return len(self.names)
+
+    def load_chunk(self, chunk_idx):
+        """读取第 chunk_idx 块，返回 (n, H, W) 数组。"""
+        return self._npz[f"chunk_{chunk_idx:05d}"]
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"帧序号 {idx} 超出范围（共 {len(self)} 帧）")
+        chunk_idx, offset = divmod(idx, self.chunk)
+        with self._lock:
+            if self._cached_idx != chunk_idx:
+                self._cached_chunk = self.load_chunk(chunk_idx)
+                self._cached_idx = chunk_idx
+            return self._cached_chunk[offset]
+
+    def get(self, name):
+        """按帧名读取一帧。"""
+        return self[self._name_to_idx[name]]
+
+    def iter_chunks(self):
+        for chunk_idx in range(self._n_chunks):
+            yield self.load_chunk(chunk_idx)
+
+    def __iter__(self):
+        for block in self.iter_chunks():
+            yield from block
+
+    def to_array(self):
+        """一次性读出全部帧为 (N, H, W) 数组。"""
+        if not self.names:
+            return np.empty((0,) + self.frame_shape, dtype=self.dtype)
+        return np.concatenate(list(self.iter_chunks()))
+
+
+def _read_frame_file(path):
+    if path.lower().endswith(('.tif', '.tiff')):
+        return tifffile.imread(path)
+    return cv2.imread(path, cv2.IMREAD_UNCHANGED)
+
+
+def array_frame_names(n):
+    """内存帧数组的隐含帧名，与裁剪阶段的 frame_0001 命名规则一致。"""
+    return [f"frame_{i+1:04d}" for i in range(n)]
+
+
+def list_frame_names(source, exts=('.tif', '.tiff', '.png')):
+    """列出帧名（不含扩展名）：堆栈按写入顺序，文件夹按文件名最后一段数字排序。"""
+    if isinstance(source, np.ndarray):
+        return array_frame_names(len(source))
+    if is_frame_stack_path(source):
+        with FrameStack(source) as stack:
+            return list(stack.names)
+    files = sorted((f for f in os.listdir(source) if f.lower().endswith(exts)), key=_natural_key)
+    return [os.path.splitext(f)[0] for f in files]
+
+
+def _read_frame_file_safe(path):
+    try:
+        return _read_frame_file(path), None
+    except Exception as e:
+        return None, e
+
+
+def _iter_read_files(paths, workers):
+    # 线程池按顺序预读（最多积压 2 * workers 帧），保证产出顺序与 paths 一致
+    if workers <= 1:
+        for path in paths:
+            yield _read_frame_file_safe(path)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(_read_frame_file_safe, path))
+            if len(pending) > 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_named_frames(source, exts=('.tif', '.tiff', '.png'), workers=1):
+    """
+    统一读取一个阶段的输出：source 可以是帧堆栈（.npz）、逐帧文件夹，
+    或内存中的 (N, H, W) 帧数组 / 逐帧产出的迭代器（按 frame_0001 规则命名）。
+    workers > 1 时文件夹中的帧由线程池并行读取（顺序不变）。
+
+    产出：
+        (name, frame): 帧名（不含扩展名）与帧数组；文件夹中读取失败的帧为 None
+    """
+    if isinstance(source, np.ndarray):
+        yield from zip(array_frame_names(len(source)), source)
+        return
+
+    if not isinstance(source, str):
+        for i, frame in enumerate(source):
+            yield f"frame_{i+1:04d}", frame
+        return
+
+    if is_frame_stack_path(source):
+        with FrameStack(source) as stack:
+            names = iter(stack.names)
+            for block in stack.iter_chunks():
+                for frame in block:
+                    yield next(names), frame
+        return
+
+    files = sorted((f for f in os.listdir(source) if f.lower().endswith(exts)), key=_natural_key)
+    results = _iter_read_files([os.path.join(source, f) for f in files], workers)
+    for filename, (frame, error) in zip(files, results):
+        if error is not None:
+            print(f"读取帧失败 {filename}: {error}")
+        yield os.path.splitext(filename)[0], frame
+
+
+def iter_named_blocks(source, chunk=64, exts=('.tif', '.tiff', '.png'), workers=1):
+    """
+    按块读取一个阶段的输出，产出 (names, block)：block 为 (n, H, W) 数组。
+    帧堆栈直接按存储块产出（不再逐帧拼接），数组按 chunk 切片（视图）；
+    文件夹/迭代器逐帧凑满 chunk 帧，跳过读取失败的帧，帧尺寸或类型变化时提前断块。
+    """
+    if chunk <= 0:
+        raise ValueError("chunk 必须为正整数")
+    if isinstance(source, np.ndarray):
+        names = array_frame_names(len(source))
+        for i in range(0, len(source), chunk):
+            yield names[i:i + chunk], source[i:i + chunk]
+        return
+
+    if is_frame_stack_path(source):
+        with FrameStack(source) as stack:
+            for i, block in enumerate(stack.iter_chunks()):
+                yield stack.names[i * stack.chunk:(i + 1) * stack.chunk], block
+        return
+
+    names, frames = [], []
+    for name, frame in iter_named_frames(source, exts, workers=workers):
+        if frame is None:
+            continue
+        if frames and (frame.shape != frames[0].shape or frame.dtype != frames[0].dtype):
+            yield names, np.stack(frames)
+            names, frames = [], []
+        names.append(name)
+        frames.append(frame)
+        if len(frames) >= chunk:
+            yield names, np.stack(frames)
+            names, frames = [], []
+    if frames:
+        yield names, np.stack(frames)
+
+
+def _write_frame_file(path, frame):
+    if path.lower().endswith(('.tif', '.tiff')):
+        tifffile.imwrite(path, frame)
+    else:
+        cv2.imwrite(path, frame)
+
+
+class FrameOutput:
+    """
+    阶段输出：output 为 .npz 时写入帧堆栈，否则按 <name><ext> 逐帧写入文件夹。
+    export_dir 为可选的逐帧导出目录（调试用），与堆栈输出同时写入。
+    workers > 1 时逐帧文件的编码和写盘交给线程池并行完成（按提交顺序等待，
+    最多积压 2 * workers 帧），退出 with 时等待全部写完；
+    此时传入的帧数组在写完之前不能被调用方修改。
+    """
+
+    def __init__(self, output, ext, compress=False, export_dir=None, chunk=64, workers=1):
+        self.output = output
+        self.ext = ext
+        self.export_dir = export_dir
+        self.workers = workers
+        self._writer = None
+        self._pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self._futures = deque()
+        if is_frame_stack_path(output):
+            self._writer = FrameStackWriter(output, chunk=chunk, compress=compress)
+        else:
+            os.makedirs(output, exist_ok=True)
+        if export_dir:
+            os.makedirs(export_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        write_error = None
+        try:
+            self._drain()
+        except Exception as e:
+            write_error = e
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+        if self._writer is not None:
+            if exc_type is None and write_error is None:
+                self._writer.close()
+            else:
+                self._writer.abort()
+        if write_error is not None and exc_type is None:
+            raise write_error
+
+    def _drain(self, keep=0):
+        # 按提交顺序等待后台写入，直到积压不超过 keep 帧；写入失败时抛出第一个错误
+        first_error = None
+        while len(self._futures) > keep:
+            try:
+                self._futures.popleft().result()
+            except Exception as e:
+                if first_error is None:
+                    first_error = e
+        if first_error is not None:
+            raise first_error
+
+    def flush(self):
+        """等待所有已提交的后台写入完成（调用方要复用帧缓冲区之前调用）。"""
+        self._drain()
+
+    def _write_file(self, path, frame):
+        if self._pool is None:
+            _write_frame_file(path, frame)
+            return
+        self._futures.append(self._pool.submit(_write_frame_file, path, frame))
+        self._drain(keep=2 * self.workers)
+
+    def write(self, name, frame):
+        """写入一帧，返回该帧的引用（文件夹模式为文件路径，堆栈模式为帧名）。"""
+        if self.export_dir:
+            self._write_file(os.path.join(self.export_dir, f"{name}{self.ext}"), frame)
+        if self._writer is not None:
+            self._writer.append(frame, name)
+            return name
+        path = os.path.join(self.output, f"{name}{self.ext}")
+        self._write_file(path, frame)
+        return path
+
+# 调用方式：------------------------------------------------------------------------
+# with FrameStackWriter("foreground.npz", chunk=64, compress=True) as w:
+#     for i, frame in enumerate(frames):
+#         w.append(frame, f"frame_{i+1:04d}")
+#
+# with FrameStack("foreground.npz") as stack:
+#     frame = stack[10]                   # 随机访问第10帧
+#     for block in stack.iter_chunks():   # 按块顺序遍历
+#         ...
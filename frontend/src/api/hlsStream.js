@@ -0,0 +1,137 @@
+import { api } from './client'
+
+const POLL_MS = 1000
+
+function parsePlaylist(text) {
+  const lines = text.split('\n').map((l) => l.trim())
+  const map = lines.find((l) => l.startsWith('#EXT-X-MAP:'))
+  const init = map ? /URI="([^"]+)"/.exec(map)[1] : null
+  const segments = lines.filter((l) => l && !l.startsWith('#'))
+  return { init, segments, ended: lines.includes('#EXT-X-ENDLIST') }
+}
+
+// 分片无法追加或解码（编码格式不受支持等），重试也不会成功
+class SegmentError extends Error {}
+
+function waitUpdate(sb) {
+  return new Promise((resolve) => sb.addEventListener('updateend', resolve, { once: true }))
+}
+
+/**
+ * 播放渲染过程中不断追加分片的 HLS 播放列表（event 类型，fMP4 分片）。
+ * 浏览器原生支持 HLS 时直接设置 src，否则用 MediaSource 逐个追加分片，
+ * 播放列表出现 #EXT-X-ENDLIST 后结束流（之后 loop 可正常循环播放）。
+ *
+ * codecs 为后端实际使用的编码器对应的 codecs 字符串（如 avc1.64001f）；未知或浏览器不支持时
+ * 返回 null（调用方应等待完整 MP4）。播放过程中出错（分片无法解码、追加失败）时停止流并调用
+ * onError，调用方可改用完整 MP4。
+ *
+ * 返回 stop 函数，或 null。
+ */
+export function attachHlsStream(video, url, codecs, onError) {
+  if (!codecs) return null
+  const mime = `video/mp4; codecs="${codecs}"`
+  let stop = () => {}
+
+  function fail(e) {
+    console.error('分片播放失败，改为等待完整视频', e)
+    stop()
+    if (onError) onError(e)
+  }
+
+  if (video.canPlayType('application/vnd.apple.mpegurl') && video.canPlayType(mime)) {
+    const onVideoError = () => fail(video.error)
+    video.addEventListener('error', onVideoError, { once: true })
+    video.src = url
+    stop = () => {
+      video.removeEventListener('error', onVideoError)
+      video.removeAttribute('src')
+    }
+    return stop
+  }
+  if (!window.MediaSource || !MediaSource.isTypeSupported(mime)) return null
+
+  const base = url.slice(0, url.lastIndexOf('/') + 1)
+  const ms = new MediaSource()
+  let stopped = false
+  let timer = null
+  let appended = 0
+  let initDone = false
+
+  async function fetchBuffer(name) {
+    const { data } = await api.get(base + name, { responseType: 'arraybuffer' })
+    return data
+  }
+
+  async function append(sb, name) {
+    const buffer = await fetchBuffer(name)
+    if (stopped) return false
+    // appendBuffer 抛出异常或解码出错（SourceBuffer error 事件）都说明分片无法播放
+    const failed = new Promise((resolve) => sb.addEventListener('error', resolve, { once: true }))
+    try {
+      sb.appendBuffer(buffer)
+    } catch (e) {
+      throw new SegmentError(`分片无法追加：${name}（${e}）`)
+    }
+    if ((await Promise.race([waitUpdate(sb).then(() => null), failed])) !== null) {
+      throw new SegmentError(`分片无法解码：${name}`)
+    }
+    return true
+  }
+
+  async function poll(sb) {
+    if (stopped) return
+    try {
+      const { data } = await api.get(url, { responseType: 'text', params: { t: Date.now() } })
+      const pl = parsePlaylist(data)
+      if (!initDone && pl.init) {
+        if (!(await append(sb, pl.init))) return
+        initDone = true
+      }
+      while (initDone && appended < pl.segments.length && !stopped) {
+        if (!(await append(sb, pl.segments[appended]))) return
+        appended += 1
+      }
+      if (pl.ended && initDone && appended === pl.segments.length) {
+        if (ms.readyState === 'open') ms.endOfStream()
+        return
+      }
+    } catch (e) {
+      if (e instanceof SegmentError) {
+        // 分片本身无法播放：停止流，交由调用方改用完整 MP4
+        fail(e)
+        return
+      }
+      // 网络错误：稍后重试
+      console.error('加载视频分片失败', e)
+    }
+    timer = setTimeout(() => poll(sb), POLL_MS)
+  }
+
+  ms.addEventListener(
+    'sourceopen',
+    () => {
+      let sb
+      try {
+        sb = ms.addSourceBuffer(mime)
+      } catch (e) {
+        fail(e)
+        return
+      }
+      sb.mode = 'sequence'
+      poll(sb)
+    },
+    { once: true },
+  )
+  const objectUrl = URL.createObjectURL(ms)
+  video.src = objectUrl
+
+  stop = () => {
+    if (stopped) return
+    stopped = true
+    if (timer) clearTimeout(timer)
+    URL.revokeObjectURL(objectUrl)
+    video.removeAttribute('src')
+  }
+  return stop
+}
@@ -1,24 +1,55 @@
 import os
 import math
+import numpy as np
+import tifffile
 from datetime import datetime
 from planck import inverse_planck
 # from ui_bridge import make_preview_and_wait
 from ui_bridge import make_preview_and_wait, save_leakage_result  # 新增 save_leakage_result
 
-from bg_2_foreground import full_foreground_pipeline
-from bg_reconstruction import run_background_model
-from crop_tiff import crop_frames
+from bg_2_foreground import (extract_foreground_from_linearized_sequence, iter_foreground_frames,
+                             restore_background)
+from bg_reconstruction import OnlineBackgroundModel, estimate_background, run_background_model
+from crop_tiff import save_cropped_frames
 from flownet2_for_opticalflow import run_optical_flow_inference
+from cv_optical_flow import DEFAULT_FLOW_WORKERS
+from onnx_optical_flow import DEFAULT_INTER_OP_THREADS, DEFAULT_INTRA_OP_THREADS
 from hitran import generate_d_i_cl
-from imgs_2_video import create_video_for_web, create_video_from_pngs
-from invert_and_pairs import prepare_optical_flow_input
-from linear_for_bg import linearize_frames
-from predict_leakage import predict_leakage
-from raw_to_frames import decode_raw_video
-from foreground_colormap import generate_heatmap_and_paste_to_raw
+from imgs_2_video import create_video_from_pngs
+from invert_and_pairs import iter_frame_pairs, prepare_optical_flow_input
+from linear_for_bg import linearize_frames, linearize_stack
+from predict_leakage import load_lookup_table, predict_leakage
+from preprocess_kernel import PreprocessKernel
+from raw_index import get_raw_index, index_min_max
+from raw_to_frames import iter_frame_blocks, iter_raw_frames, read_frames_roi
+from frame_cache import open_decoded_frames
+from foreground_colormap import DEFAULT_RENDER_WORKERS, render_heatmap_video
 
 
-def _predict_leakage_with_params(rawFilePath, user_raw_image_dir, params, case_id=1, output_case_dir=None):
+def _iter_decoding_roi(raw_path, roi, out, stats, start=100):
+    """
+    流式解码RAW的裁剪窗口，每解码一块就逐帧产出，下游（在线背景前景提取）不必等整段解码完成；
+    同时把帧拷进预分配的 out，供后续线性化和保存裁剪帧使用。
+    裁剪窗口的全局最值与 read_frames_roi 一样逐块累计，解码结束后写在 stats["min"] / stats["max"]。
+    """
+    pos = 0
+    stats["min"], stats["max"] = None, None
+    for block in iter_raw_frames(raw_path, start=start, roi=roi):
+        out[pos:pos + len(block)] = block
+        block_min, block_max = int(block.min()), int(block.max())
+        stats["min"] = block_min if stats["min"] is None else min(stats["min"], block_min)
+        stats["max"] = block_max if stats["max"] is None else max(stats["max"], block_max)
+        yield from out[pos:pos + len(block)]
+        pos += len(block)
+
+
+def _predict_leakage_with_params(rawFilePath, user_raw_image_dir, params, case_id=1, output_case_dir=None,
+                                 export_frames=False, in_memory=False, background_backend="external",
+                                 online_background_window=250, render_workers=DEFAULT_RENDER_WORKERS,
+                                 final_hls=True, flow_batch_size=4, flow_engine="flownet2",
+                                 flow_workers=DEFAULT_FLOW_WORKERS, flow_onnx_model=None,
+                                 flow_intra_op_threads=DEFAULT_INTRA_OP_THREADS,
+                                 flow_inter_op_threads=DEFAULT_INTER_OP_THREADS, flow_dtype="float32"):
     """
     优化后流程：
     1. 原有泄漏量预测逻辑不变（裁剪、线性化、前景提取等）
@@ -27,22 +58,43 @@ def _predict_leakage_with_params(rawFilePath, user_raw_image_dir, params, case_i
         rawFilePath: 输入RAW文件路径（原有）
         user_raw_image_dir: 用户指定的原尺寸图像文件夹（新增）
         case_id: 可以是数字或字符串（用于标记一次检测）
+        export_frames: 中间结果（裁剪、线性化、前景、CL）默认写成每阶段一个帧堆栈（.npz），
+            为 True 时额外按原目录名逐帧导出，便于调试
+        in_memory: 为 True 时各阶段之间直接传递 NumPy 数组，不写中间帧堆栈；
+            只写前端需要的产物（热力图视频、结果）以及外部背景建模程序所需的输入视频。
+            泄漏量结果与写盘模式逐位一致
+        background_backend: 背景建模后端。"external" 为外部 C++ 程序（需要线性化视频，
+            背景经8位PNG往返）；"median" / "percentile" / "gaussian" 为进程内估计
+            （见 bg_reconstruction.estimate_background），直接得到16位背景；
+            "online" 为在线增量背景（OnlineBackgroundModel），前景逐帧产出，适合长录像
+        online_background_window: 在线背景的自适应窗口（帧数）
+        render_workers: 热力图叠加帧并行渲染的进程数
+        final_hls: 为 True 时热力图视频边渲染边写出 HLS 分片（<output_case_dir>/final_hls/index.m3u8），
+            前端无需等完整 MP4 生成即可开始播放
+        flow_batch_size: 光流推理每次前向的图像对数
+        flow_engine: 光流引擎。"flownet2" 为 mmflow 深度模型（需要 GPU 配置的权重）；
+            "onnx" 为导出为 ONNX 的 FlowNet2（ONNX Runtime CPU 推理，需要 flow_onnx_model）；
+            "dis" / "farneback" 为 OpenCV 传统光流（纯 CPU，多进程，适合快速估算和无 GPU 环境）
+        flow_workers: 传统光流引擎并行计算的进程数
+        flow_onnx_model: onnx 引擎使用的 .onnx 模型路径
+        flow_intra_op_threads / flow_inter_op_threads: onnx 引擎算子内 / 算子间并行的线程数
+        flow_dtype: 光流堆栈（{rawFilePath}_infer_flow.npy）的存储类型，"float32" 或 "float16"；
+            export_frames 为 True 时另外按图像对导出 .flo 文件
     """
     # 旧流程里 case_id 是 int，新 Web 流程中是 UUID 字符串，这里统一转成字符串即可
     inspection_id = str(case_id)
 
-    # 1. 解析RAW文件（原有）
-    frames = decode_raw_video(
-        rawFilePath,
-        frame_width=320,
-        frame_height=256,
-        save_as_tiff=False
-    )
-    # 去掉前100帧（原有）
-    if len(frames) >= 100:
-        frames = frames[100:]
-    else:
-        frames = []
+    def _export_dir(path):
+        return path if export_frames else None
+
+    cropped_stack = f"{rawFilePath}_frames_tiff_cropped.npz"
+    linear_stack = f"{rawFilePath}_frames_tiff_cropped_linearized.npz"
+    foreground_stack = f"{rawFilePath}_foreground.npz"
+    flow_stack = f"{rawFilePath}_infer_flow.npy"
+
+    # 1. 由RAW索引检查帧数：不足100帧直接返回（实际解码在第4步按裁剪窗口进行）
+    raw_index = get_raw_index(rawFilePath, frame_width=320, frame_height=256)
+    if raw_index["frame_count"] < 100:
         print("警告：视频总帧数不足100帧，已清空帧列表")
         return {
             "dateTime": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
@@ -68,15 +120,40 @@ def _predict_leakage_with_params(rawFilePath, user_raw_image_dir, params, case_i
     height_even = height_ceil if height_ceil % 2 == 0 else height_ceil + 1
     print(f"🔄 裁剪参数优化：原始({crop_width},{crop_height}) → 偶数({width_even},{height_even})")
 
-    # 4. 裁剪帧（原有，用于后续前景提取）
-    cropped_frames, gmin, gmax = crop_frames(
-        frames,
-        width_even,
-        height_even,
-        crop["x"],
-        crop["y"],
-        output_dir=f"{rawFilePath}_frames_tiff_cropped"
-    )
+    # 4. 裁剪帧：跳过前100帧，只解码裁剪窗口，同一遍得到全局最值（用于后续前景提取）
+    roi = (crop["x"], crop["y"], width_even, height_even)
+    if background_backend == "online":
+        # 在线背景：RAW 按裁剪窗口边解码边提取前景（第7步不再单独提取），不等待整段解码；
+        # 裁剪窗口的全局最值在解码过程中累计，与其他后端（read_frames_roi）一致
+        cropped_frames = np.empty((raw_index["frame_count"] - 100, height_even, width_even), dtype=np.uint16)
+        online_model = OnlineBackgroundModel(window=online_background_window)
+        roi_stats = {}
+        decoding = _iter_decoding_roi(rawFilePath, roi, cropped_frames, roi_stats)
+        if in_memory:
+            # CL 由 predict_leakage 逐帧换算
+            foreground_source = np.empty_like(cropped_frames)
+            for i, (_, foreground) in enumerate(iter_foreground_frames(decoding, online_model=online_model)):
+                foreground_source[i] = foreground
+        else:
+            extract_foreground_from_linearized_sequence(
+                frames_folder=decoding,
+                background_tiff_path=None,
+                output_folder=foreground_stack,
+                export_dir=_export_dir(f"{rawFilePath}_foreground"),
+                online_model=online_model
+            )
+            foreground_source = foreground_stack
+        gmin, gmax = roi_stats["min"], roi_stats["max"]
+    else:
+        # 复用预览阶段生成的解码帧缓存；缓存不存在或正在生成时等待同一次解码
+        decoded_frames = open_decoded_frames(rawFilePath, frame_width=320, frame_height=256)
+        cropped_frames, gmin, gmax = read_frames_roi(decoded_frames, roi, start=100)
+    if not in_memory:
+        save_cropped_frames(
+            cropped_frames,
+            output_dir=cropped_stack,
+            export_dir=_export_dir(f"{rawFilePath}_frames_tiff_cropped")
+        )
     print("全局最小值:", gmin, "全局最大值:", gmax)
 
     # --------------------------
@@ -100,33 +177,63 @@ def _predict_leakage_with_params(rawFilePath, user_raw_image_dir, params, case_i
     print("背景温度 Tb(K):", Tb, "环境温度 Tg(K):", Tg)
 
     # 5. 线性化（原有，用于背景建模和光流）
-    scale = linearize_frames(
-        input_dir=f"{rawFilePath}_frames_tiff_cropped",
-        output_dir=f"{rawFilePath}_frames_tiff_cropped_linearized",
-        min_val=gmin,
-        max_val=gmax
-    )
+    if in_memory:
+        linear_source, scale = linearize_stack(cropped_frames, gmin, gmax)
+    else:
+        scale = linearize_frames(
+            input_dir=cropped_stack,
+            output_dir=linear_stack,
+            min_val=gmin,
+            max_val=gmax,
+            export_dir=_export_dir(f"{rawFilePath}_frames_tiff_cropped_linearized")
+        )
+        linear_source = linear_stack
 
-    # 6. 背景建模（仅用于前景提取，不参与后续叠加，原有）
-    linear_video_path = f"{rawFilePath}_linearized_video.mp4"
-    create_video_from_pngs(f"{rawFilePath}_frames_tiff_cropped_linearized", linear_video_path)
-    background_path = f"{rawFilePath}_background_ori.png"
-    run_background_model(
-        linear_video_path,
-        background_path,
-        binary_path="/media/ecust/新加卷/qyx/qyx/bgs_method/background_model"
-    )
+    # 6. 背景建模（仅用于前景提取，不参与后续叠加）
+    if background_backend == "external":
+        # 外部 C++ 程序：线性化帧→MP4→8位背景PNG，再逆线性化为16位（原有）
+        linear_video_path = f"{rawFilePath}_linearized_video.mp4"
+        create_video_from_pngs(linear_source, linear_video_path)
+        background_path = f"{rawFilePath}_background_ori.png"
+        run_background_model(
+            linear_video_path,
+            background_path,
+            binary_path="/media/ecust/新加卷/qyx/qyx/bgs_method/background_model"
+        )
+        background = restore_background(background_path, min_val=gmin, scale_factor=scale)
+    elif background_backend == "online":
+        # 在线背景：不需要整段背景，前景已在第4步随解码逐帧产出，背景随场景缓慢更新
+        background = None
+    else:
+        # 进程内：直接在裁剪后的 uint16 帧上估计背景，没有 MP4/8位PNG 的有损往返
+        background = estimate_background(cropped_frames, method=background_backend)
+
+    # 生成查找表（只依赖 Tb / Tg；提前生成，内存模式下前景与 CL 可在同一遍中算出）
+    ch4_coef_path = "/media/ecust/新加卷/qyx/qyx/hanjie_demo/hanjie_demo/InfraRedVideo/CH4_nu_coef.npy"
+    lookup_table_path = f"{rawFilePath}_d_i_cl.npy"
+    CLs, d_i_list = generate_d_i_cl(Tb, Tg, ch4_coef_path, lookup_table_path)
 
     # 7. 前景提取（核心输入，原有）
-    foreground_dir = f"{rawFilePath}_foreground"
-    full_foreground_pipeline(
-        frames_folder=f"{rawFilePath}_frames_tiff_cropped",
-        linear_background_png=background_path,
-        output_foreground_folder=foreground_dir,
-        restored_background_tiff_path=f"{rawFilePath}_background.tiff",
-        min_val=gmin,
-        scale_factor=scale
-    )
+    cl_frames = None
+    if background is None:
+        # 在线背景：前景已在第4步随解码产出
+        pass
+    elif in_memory:
+        # 融合内核：逐块同时得到前景和 CL 图
+        kernel = PreprocessKernel(gmin, scale, background=background)
+        kernel.set_lookup(*load_lookup_table(lookup_table_path))
+        planes = kernel.run_stack(cropped_frames, planes=("foreground", "cl"))
+        foreground_source, cl_frames = planes["foreground"], planes["cl"]
+    else:
+        restored_background_path = f"{rawFilePath}_background.tiff"
+        tifffile.imwrite(restored_background_path, background)
+        extract_foreground_from_linearized_sequence(
+            frames_folder=cropped_stack,
+            background_tiff_path=restored_background_path,
+            output_folder=foreground_stack,
+            export_dir=_export_dir(f"{rawFilePath}_foreground")
+        )
+        foreground_source = foreground_stack
 
     # --------------------------
     # 新增核心步骤：热力图贴到原图像+生成视频
@@ -138,64 +245,63 @@ def _predict_leakage_with_params(rawFilePath, user_raw_image_dir, params, case_i
         "width": width_even,
         "height": height_even
     }
-    # 替换后帧的保存文件夹
-    processed_frame_dir = f"{rawFilePath}_processed_frames_with_heatmap"
-    # 1. 生成热力图并贴到原图像
-    paste_success = generate_heatmap_and_paste_to_raw(
-        input_foreground_dir=foreground_dir,
-        user_raw_image_dir=user_raw_image_dir,
-        crop_params=crop_params,
-        output_frame_dir=processed_frame_dir,
-        sigma=1.5,  # 可调整：值越大热力图越平滑
-        threshold=10  # 可调整：值越大仅显示高浓度区域
-    )
-
-    # 2. 生成25fps视频（用于浏览器展示）
     # 构建新的视频保存目录，包含case_id变量
     if output_case_dir is None:
         output_case_dir = os.path.dirname(os.path.abspath(rawFilePath))
     os.makedirs(output_case_dir, exist_ok=True)
-    # 构建完整的视频路径（不带 .mp4 后缀，create_video_for_web 会加）
+    # 构建完整的视频路径（不带 .mp4 后缀）
     final_video_path = os.path.join(output_case_dir, "raw_final_visualization_video")
 
-    if paste_success:
-        video_success = create_video_for_web(
-            frames_dir=processed_frame_dir,
-            out_base=final_video_path
-        )
-        video_result = final_video_path if video_success else "视频生成失败"
-    else:
-        video_result = "热力图粘贴失败，无法生成视频"
-        processed_frame_dir = "无"
+    # 生成热力图并贴到原图像，渲染好的帧直接送入 ffmpeg 生成25fps视频（用于浏览器展示），
+    # 不再落盘 PNG 帧目录；同时写出 HLS 分片供前端边渲染边播放
+    video_success = render_heatmap_video(
+        input_foreground_dir=foreground_source,
+        user_raw_image_dir=user_raw_image_dir,
+        crop_params=crop_params,
+        output_video_path=f"{final_video_path}.mp4",
+        sigma=1.5,  # 可调整：值越大热力图越平滑
+        threshold=10,  # 可调整：值越大仅显示高浓度区域
+        workers=render_workers,
+        hls_dir=os.path.join(output_case_dir, "final_hls") if final_hls else None
+    )
+    video_result = final_video_path if video_success else "热力图粘贴失败，无法生成视频"
 
     # --------------------------
     # 原有后续步骤（光流、查找表、泄漏量预测，保持不变）
     # --------------------------
-    prepare_optical_flow_input(
-        linear_folder=f"{rawFilePath}_frames_tiff_cropped_linearized",
-        output_pair_folder=f"{rawFilePath}_frames_tiff_cropped_linearized_invert_pairs",
-        invert=True
-    )
+    # 图像对直接由线性化帧（内存数组或帧堆栈）惰性产出，不再写配对PNG目录；仅调试导出时写出
+    if export_frames:
+        prepare_optical_flow_input(
+            linear_folder=linear_source,
+            output_pair_folder=f"{rawFilePath}_frames_tiff_cropped_linearized_invert_pairs",
+            invert=True
+        )
     run_optical_flow_inference(
-        input_dir=f"{rawFilePath}_frames_tiff_cropped_linearized_invert_pairs",
-        flo_output_dir=f"{rawFilePath}_infer_flo",
+        input_dir=iter_frame_pairs(linear_source, invert=True),
+        flo_output_dir=flow_stack,
         config_file='/media/ecust/新加卷/qyx/qyx/mmflow/configs/flownet2/flownet2_8x1_slong_flyingchairs_384x448.py',
         checkpoint_file='/media/ecust/新加卷/qyx/qyx/mmflow/work_dirs/my_flownet2_8x1_slong_flyingchairs_384x448/latest.pth',
-        device='cuda:0'
+        device='cuda:0',
+        batch_size=flow_batch_size,
+        engine=flow_engine,
+        workers=flow_workers,
+        onnx_model=flow_onnx_model,
+        intra_op_threads=flow_intra_op_threads,
+        inter_op_threads=flow_inter_op_threads,
+        flow_dtype=flow_dtype,
+        flo_export_dir=_export_dir(f"{rawFilePath}_infer_flo")
     )
-    # 生成查找表
-    ch4_coef_path = "/media/ecust/新加卷/qyx/qyx/hanjie_demo/hanjie_demo/InfraRedVideo/CH4_nu_coef.npy"
-    lookup_table_path = f"{rawFilePath}_d_i_cl.npy"
-    CLs, d_i_list = generate_d_i_cl(Tb, Tg, ch4_coef_path, lookup_table_path)
     # 泄漏量预测
     fov_val = math.radians(fov_val)
     pixel_size = 2 * distance_val * math.tan(fov_val / 2) / 320
     print("换算像素尺寸:", pixel_size)
     leakage_value = predict_leakage(
-        foreground_folder=foreground_dir,
-        flow_folder=f"{rawFilePath}_infer_flo",
-        lookup_table_path=lookup_table_path, 
-        pixel_size=pixel_size
+        foreground_folder=foreground_source,
+        flow_folder=flow_stack,
+        lookup_table_path=lookup_table_path,
+        pixel_size=pixel_size,
+        cl_export_dir=_export_dir(os.path.join(os.path.dirname(foreground_stack), "CL")),
+        cl_frames=cl_frames
     )
 
     # --------------------------
@@ -222,16 +328,15 @@ def test_predict_leakage(rawFilePath, user_raw_image_dir):
     新的上传式 Web API 不会走这个函数，而是直接传入 params 并指定输出目录。
     """
     inspection_id = 1
-    frames = decode_raw_video(
-        rawFilePath,
-        frame_width=320,
-        frame_height=256,
-        save_as_tiff=False
-    )
-    if len(frames) >= 100:
-        frames = frames[100:]
+    raw_index = get_raw_index(rawFilePath, frame_width=320, frame_height=256)
+    if raw_index["frame_count"] >= 100:
+        # 预览需要两遍遍历（先求全局最值再拉伸），因此传入可重复调用的帧迭代器工厂
+        decoded_frames = open_decoded_frames(rawFilePath, frame_width=320, frame_height=256)
+
+        def frames():
+            for block in iter_frame_blocks(decoded_frames, start=100):
+                yield from block
     else:
-        frames = []
         print("警告：视频总帧数不足100帧，已清空帧列表")
         return {
             "dateTime": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
@@ -240,11 +345,14 @@ def test_predict_leakage(rawFilePath, user_raw_image_dir):
             "processed_frames_dir": "无"
         }
 
+    gmin, gmax = index_min_max(raw_index, start=100)
     params = make_preview_and_wait(
         frames=frames,
         case_id=inspection_id,
         server_host="58.246.12.34",
-        server_port=5001
+        server_port=5001,
+        gmin=gmin,
+        gmax=gmax
     )
     return _predict_leakage_with_params(
         rawFilePath=rawFilePath,
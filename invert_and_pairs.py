@@ -1,31 +1,42 @@
 import os
-import shutil
 import numpy as np
 from PIL import Image
 import re
 
+from frame_stack import is_frame_stack_path, iter_named_frames
 
-def prepare_optical_flow_input(linear_folder, output_pair_folder, invert=True):
+
+def _iter_linear_frames(linear_folder):
+    if not isinstance(linear_folder, str) or is_frame_stack_path(linear_folder):
+        # 帧堆栈、内存帧数组或 memmap：按帧顺序读取（数组按帧取视图，不拷贝）
+        return iter_named_frames(linear_folder)
+    # 获取所有png图像（按名称排序）
+    frames = sorted([f for f in os.listdir(linear_folder) if f.lower().endswith('.png')])
+    return ((f, np.array(Image.open(os.path.join(linear_folder, f)))) for f in frames)
+
+
+def iter_frame_pairs(linear_folder, invert=True):
     """
-    将线性化图像反转后，生成成对图像用于光流推理
+    惰性产出相邻帧组成的图像对，供光流推理直接使用（不写盘）。
+    相邻两对共用中间那一帧，每帧只读取、反转一次。
 
     参数：
-        linear_folder (str): 原始线性化图像文件夹
-        output_pair_folder (str): 输出的图像对文件夹
+        linear_folder (str | np.ndarray): 线性化图像文件夹、线性化帧堆栈（.npz）、
+            内存帧数组或 memmap
         invert (bool): 是否进行像素值反转（默认True）
-    """
 
-    # 确保输出文件夹存在
-    os.makedirs(output_pair_folder, exist_ok=True)
-
-    # 获取所有png图像（按名称排序）
-    frames = sorted([f for f in os.listdir(linear_folder) if f.lower().endswith('.png')])
-    if not frames:
+    产出：
+        (pair_name, img1, img2): pair_name 与原配对文件 {n:04d}_img1 同名（不含扩展名），
+            img1 / img2 为 uint8 灰度帧
+    """
+    named_frames = _iter_linear_frames(linear_folder)
+    first = next(named_frames, None)
+    if first is None:
         print("源文件夹中未找到PNG图像")
         return
 
     # 提取起始编号（从文件名提取4位数字）
-    match = re.search(r'\d{4}', frames[0])
+    match = re.search(r'\d{4}', first[0])
     if match:
         start_num = int(match.group())
         print(f"起始编号提取成功: {start_num}")
@@ -33,43 +44,46 @@ def prepare_optical_flow_input(linear_folder, output_pair_folder, invert=True):
         start_num = 1
         print(f"起始编号提取失败，使用默认值: {start_num}")
 
-    for i in range(len(frames) - 1):
-        img1_name, img2_name = frames[i], frames[i + 1]
-        img1_path = os.path.join(linear_folder, img1_name)
-        img2_path = os.path.join(linear_folder, img2_name)
+    # 像素反转
+    prev_np = 255 - first[1] if invert else first[1]
+    for i, (_, cur_np) in enumerate(named_frames):
+        if invert:
+            cur_np = 255 - cur_np
+        yield f"{start_num + i:04d}_img1", prev_np, cur_np
+        prev_np = cur_np
 
-        # 读取图像
-        img1 = Image.open(img1_path)
-        img2 = Image.open(img2_path)
 
-        # 转换为numpy数组
-        img1_np = np.array(img1)
-        img2_np = np.array(img2)
+def prepare_optical_flow_input(linear_folder, output_pair_folder, invert=True):
+    """
+    将线性化图像反转后，生成成对图像用于光流推理
+    （光流推理可直接使用 iter_frame_pairs，这里只在需要导出配对图像时使用）
 
-        # 像素反转
-        if invert:
-            img1_np = 255 - img1_np
-            img2_np = 255 - img2_np
+    参数：
+        linear_folder (str | np.ndarray): 原始线性化图像文件夹、线性化帧堆栈（.npz）或内存帧数组
+        output_pair_folder (str): 输出的图像对文件夹
+        invert (bool): 是否进行像素值反转（默认True）
+    """
 
-        # 转回PIL图像
-        img1_inv = Image.fromarray(img1_np)
-        img2_inv = Image.fromarray(img2_np)
+    # 确保输出文件夹存在
+    os.makedirs(output_pair_folder, exist_ok=True)
 
+    pair_count = 0
+    for pair_name, img1_np, img2_np in iter_frame_pairs(linear_folder, invert):
         # 保存为成对命名格式
-        pair_idx = start_num + i
-        out_img1_path = os.path.join(output_pair_folder, f"{pair_idx:04d}_img1.png")
-        out_img2_path = os.path.join(output_pair_folder, f"{pair_idx:04d}_img2.png")
-
-        img1_inv.save(out_img1_path)
-        img2_inv.save(out_img2_path)
-
-        # print(f"已保存图像对 {pair_idx:04d}: {img1_name}, {img2_name}")
+        pair_idx = pair_name[:-len("_img1")]
+        Image.fromarray(img1_np).save(os.path.join(output_pair_folder, f"{pair_idx}_img1.png"))
+        Image.fromarray(img2_np).save(os.path.join(output_pair_folder, f"{pair_idx}_img2.png"))
+        pair_count += 1
 
-    print(f"\n图像对准备完成，共计 {len(frames) - 1} 对")
+    print(f"\n图像对准备完成，共计 {pair_count} 对")
 
 # 调用示例：
 # prepare_optical_flow_input(
 #     linear_folder='/你的/线性化图像路径',
 #     output_pair_folder='/你的/反转配对图像输出路径',
 #     invert=True  # 反转像素值
-# )
\ No newline at end of file
+# )
+#
+# # 光流推理直接使用图像对（不写盘）：
+# for pair_name, img1, img2 in iter_frame_pairs(linear_frames, invert=True):
+#     ...
@@ -1,28 +1,54 @@
-import os
 import numpy as np
-import tifffile
-import cv2
 from tqdm import tqdm
 import math
 
+from frame_stack import DEFAULT_IO_WORKERS, FrameOutput, iter_named_blocks
+from preprocess_kernel import PreprocessKernel
 
-def linearize_frames(input_dir, output_dir, min_val, max_val):
+
+def linearize_frames(input_dir, output_dir, min_val, max_val, export_dir=None,
+                     chunk=64, workers=DEFAULT_IO_WORKERS):
     """
     将裁剪后的16位TIFF图像线性映射到0-255，并保存为PNG。
     自动选择合适的整数倍数进行缩放，以最大化对比度。
+    按块做整数映射（复用同一块输出缓冲区），PNG 编码由线程池并行完成，输出顺序不变。
 
     参数：
-        input_dir (str): 输入裁剪后TIFF图像的文件夹
-        output_dir (str): 输出PNG文件夹
+        input_dir (str | np.ndarray | Iterable[np.ndarray]): 输入裁剪后TIFF图像的文件夹、
+            帧堆栈（.npz）、(N, H, W) 帧数组或逐帧产出的迭代器
+        output_dir (str): 输出PNG文件夹，或帧堆栈（.npz）
         min_val (int): 全局最小值
         max_val (int): 全局最大值
+        export_dir (str): 可选，额外逐帧导出PNG的目录（调试用）
+        chunk (int): 每块映射的帧数
+        workers (int): 并行编码PNG的线程数
 
     返回：
         scale_factor (int): 线性映射时除以的整数倍数（用于逆线性化）
     """
-    os.makedirs(output_dir, exist_ok=True)
+    scale_factor = compute_scale_factor(min_val, max_val)
+    kernel = PreprocessKernel(min_val, scale_factor)
+
+    # 按块遍历帧（文件夹、帧堆栈、数组或迭代器），整块统一映射
+    blocks = iter_named_blocks(input_dir, chunk, exts=('.tif', '.tiff'), workers=workers)
+    with FrameOutput(output_dir, ext='.png', export_dir=export_dir, workers=workers) as out:
+        for names, block in tqdm(blocks, desc="线性化"):
+            if block.dtype != np.uint16:
+                for name, img in zip(names, block):
+                    out.write(name, linearize_frame(img, min_val, scale_factor))
+                continue
+            linear = kernel.run_block(block, planes=("linear",))["linear"]
+            for name, img in zip(names, linear):
+                out.write(name, img)
+            # 下一块会复用内核的输出缓冲区，先等这一块的PNG写完
+            out.flush()
 
-    # 自动计算整数倍数
+    print("✅ 全部完成！PNG图像已保存到：", output_dir)
+    return scale_factor
+
+
+def compute_scale_factor(min_val, max_val):
+    """自动选择整数倍数，使 (max_val - min_val) / scale_factor 不超过255。"""
     value_range = max_val - min_val
     scale_factor = math.ceil(value_range / 255)  # 向上取整，保证不溢出
 
@@ -34,28 +60,32 @@ def linearize_frames(input_dir, output_dir, min_val, max_val):
     print(f"  - 缩放因子scale_factor: {scale_factor}")
 
     print(f"自动选择的倍数: {scale_factor} (范围 {value_range} / 255 ≈ {value_range / 255:.2f})")
+    return scale_factor
 
-    # 遍历文件
-    for filename in tqdm(os.listdir(input_dir)):
-        if filename.lower().endswith(('.tif', '.tiff')):
-            input_path = os.path.join(input_dir, filename)
-            output_path = os.path.join(output_dir, os.path.splitext(filename)[0] + '.png')
 
-            img = tifffile.imread(input_path)
+def linearize_frame(img, min_val, scale_factor):
+    """将一帧16位图像映射到0-255（uint8）。"""
+    img_mapped = (img - min_val) / scale_factor
+    return np.clip(img_mapped, 0, 255).astype(np.uint8)
 
-            # 映射到0-255
-            img_mapped = (img - min_val) / scale_factor
-            img_mapped = np.clip(img_mapped, 0, 255).astype(np.uint8)
 
-            cv2.imwrite(output_path, img_mapped)
+def linearize_stack(frames, min_val, max_val):
+    """
+    内存版线性化：直接对 (N, H, W) 帧数组做与 linearize_frames 相同的映射，不读写磁盘
+    （由融合内核分块计算，结果与逐帧 linearize_frame 逐位一致）。
 
-    print("✅ 全部完成！PNG图像已保存到：", output_dir)
-    return scale_factor
+    返回：
+        linear_frames (np.ndarray): (N, H, W) uint8 线性化帧
+        scale_factor (int): 线性映射时除以的整数倍数（用于逆线性化）
+    """
+    scale_factor = compute_scale_factor(min_val, max_val)
+    kernel = PreprocessKernel(min_val, scale_factor)
+    return kernel.run_stack(frames, planes=("linear",))["linear"], scale_factor
 
 # 调用示例：-------------------------------------------------------------------------------
 # scale = linearize_frames(
 #     input_dir="Q_10_frames_tiff_80_60",
-#     output_dir="Q_10_frames_tiff_80_60_linear",
+#     output_dir="Q_10_frames_tiff_80_60_linear.npz",  # 以 .npz 结尾时写入帧堆栈
 #     min_val=12609,
 #     max_val=13297
 # )
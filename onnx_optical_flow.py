@@ -0,0 +1,348 @@
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+# ONNX Runtime CPU 推理的默认线程数：算子内并行用满 CPU 核，算子间顺序执行
+DEFAULT_INTRA_OP_THREADS = os.cpu_count() or 1
+DEFAULT_INTER_OP_THREADS = 1
+
+# 写入 ONNX 元数据的预处理参数（推理端据此复现 mmflow 测试流水线，不需要 mmcv）
+_META_KEY = "irv_flow_preprocess"
+_DEFAULT_PREPROCESS = {"mean": [0.0, 0.0, 0.0], "std": [255.0, 255.0, 255.0], "to_rgb": False,
+                       "size_mode": "resize", "size_divisor": 64}
+
+
+def _as_int(value):
+    return int(value[0]) if isinstance(value, (tuple, list)) else int(value)
+
+
+def _test_pipeline(cfg):
+    # mmflow 配置的测试数据流水线（data.test 可能是数据集列表或嵌套 dataset）
+    test = cfg.data.test
+    if isinstance(test, (list, tuple)):
+        test = test[0]
+    while "pipeline" not in test and "dataset" in test:
+        test = test["dataset"]
+    return test.get("pipeline", [])
+
+
+def _preprocess_cfg(cfg):
+    """从 mmflow 配置中取出推理端需要的预处理参数：归一化与输入尺寸对齐方式。"""
+    meta = dict(_DEFAULT_PREPROCESS)
+    for step in _test_pipeline(cfg):
+        if step["type"] == "Normalize":
+            meta.update(mean=[float(v) for v in step["mean"]], std=[float(v) for v in step["std"]],
+                        to_rgb=bool(step.get("to_rgb", False)))
+        elif step["type"] in ("InputResize", "InputPad"):
+            meta.update(size_mode="resize" if step["type"] == "InputResize" else "pad",
+                        size_divisor=2 ** int(step["exponent"]))
+    return meta
+
+
+def _replace_correlation(model):
+    """
+    将 mmcv 的 Correlation 算子（C++/CUDA 自定义算子，无法导出 ONNX）替换为等价的纯 PyTorch 实现：
+    out[n, i, j, h, w] = sum_c f1[n, c, h, w] * f2[n, c, h + (i - d) * p, w + (j - d) * p]，
+    d 为 max_displacement，p 为 dilation_patch，越界处补零。仅支持 kernel_size=1、stride=1 的配置
+    （FlowNetC 即如此）。返回替换的算子数。
+    """
+    import torch
+    import torch.nn.functional as F
+    from mmcv.ops import Correlation
+
+    class _TorchCorrelation(torch.nn.Module):
+        def __init__(self, max_displacement, dilation_patch):
+            super().__init__()
+            self.max_displacement = max_displacement
+            self.dilation_patch = dilation_patch
+
+        def forward(self, feat1, feat2):
+            patch = 2 * self.max_displacement + 1
+            radius = self.max_displacement * self.dilation_patch
+            height, width = feat1.shape[2], feat1.shape[3]
+            feat2 = F.pad(feat2, (radius, radius, radius, radius))
+            corr = []
+            for i in range(patch):
+                dy = i * self.dilation_patch
+                for j in range(patch):
+                    dx = j * self.dilation_patch
+                    corr.append((feat1 * feat2[:, :, dy:dy + height, dx:dx + width]).sum(1))
+            corr = torch.stack(corr, 1)
+            return corr.reshape(corr.shape[0], patch, patch, height, width)
+
+    replaced = 0
+    for name, module in list(model.named_modules()):
+        if not isinstance(module, Correlation):
+            continue
+        if (_as_int(module.kernel_size), _as_int(module.stride), _as_int(module.padding),
+                _as_int(module.dilation)) != (1, 1, 0, 1):
+            raise ValueError(f"{name}: 仅支持 kernel_size=1, stride=1, padding=0, dilation=1 的 Correlation")
+        parent = model.get_submodule(name.rsplit(".", 1)[0]) if "." in name else model
+        setattr(parent, name.rsplit(".", 1)[-1],
+                _TorchCorrelation(_as_int(module.max_displacement), _as_int(module.dilation_patch)))
+        replaced += 1
+    return replaced
+
+
+def _patch_decoders(model):
+    """
+    mmflow 解码器的 forward_test 最后会把光流转成 numpy 并按 img_metas 还原尺寸，无法导出；
+    这里把解码器的 forward_test 换成只保留张量部分：末级预测上采样到输入尺寸并乘以 flow_div。
+    """
+    import torch.nn.functional as F
+
+    def _tensor_forward_test(decoder, *args, H=None, W=None, img_metas=None, **kwargs):
+        kwargs.pop("return_multi_level_flow", None)
+        flow_pred = decoder(*args, **kwargs)
+        flow = flow_pred[decoder.end_level] if isinstance(flow_pred, dict) else flow_pred
+        if H is not None and W is not None:
+            flow = F.interpolate(flow, size=(H, W), mode="bilinear", align_corners=False)
+        return flow * decoder.flow_div
+
+    for module in model.modules():
+        if hasattr(module, "flow_div") and hasattr(module, "end_level") and hasattr(module, "forward_test"):
+            module.forward_test = lambda *args, _decoder=module, **kwargs: \
+                _tensor_forward_test(_decoder, *args, **kwargs)
+
+
+def _write_metadata(onnx_path, meta):
+    import onnx
+
+    model = onnx.load(onnx_path)
+    del model.metadata_props[:]
+    entry = model.metadata_props.add()
+    entry.key, entry.value = _META_KEY, json.dumps(meta)
+    onnx.save(model, onnx_path)
+
+
+def export_flownet2_onnx(config_file, checkpoint_file, onnx_path, input_size=(256, 320), opset=16,
+                         quantize=False):
+    """
+    将 run_optical_flow_inference 使用的 FlowNet2（mmflow）权重导出为 ONNX，可选再做 int8 动态量化。
+
+    导出的模型输入为归一化后的图像对 "imgs"（N, 6, H, W），输出为网络分辨率下的光流 "flow"
+    （N, 2, H, W）；N、H、W 均为动态维度。归一化参数和输入尺寸对齐方式写入 ONNX 元数据，
+    由 OnnxFlowModel 在推理前后复现（与 mmflow 测试流水线一致）。
+
+    参数：
+        config_file, checkpoint_file (str): mmflow 模型配置与权重路径
+        onnx_path (str): 输出的 .onnx 路径
+        input_size (tuple): 导出时追踪用的样例输入尺寸 (H, W)，应为 size_divisor 的倍数
+        opset (int): ONNX opset 版本。FlowNet2 的 Warp 使用 grid_sample，需要 opset >= 16
+        quantize (bool): 是否额外输出 int8 动态量化模型 {onnx_path 去扩展名}_int8.onnx
+
+    返回：
+        paths (dict): {"onnx": 导出的模型路径, "int8": 量化模型路径（未量化时为 None）}
+    """
+    import torch
+    from mmflow.apis import init_model
+
+    model = init_model(config_file, checkpoint_file, device="cpu")
+    model.eval()
+    meta = _preprocess_cfg(model.cfg)
+    print(f"替换 Correlation 算子 {_replace_correlation(model)} 个，预处理参数：{meta}")
+    _patch_decoders(model)
+
+    class _FlowTensorModel(torch.nn.Module):
+        def __init__(self, flow_model):
+            super().__init__()
+            self.flow_model = flow_model
+
+        def forward(self, imgs):
+            return self.flow_model.forward_test(imgs, img_metas=None)
+
+    dummy = torch.randn(1, 6, *input_size)
+    os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+    start = time.time()
+    with torch.no_grad():
+        torch.onnx.export(
+            _FlowTensorModel(model), dummy, onnx_path, opset_version=opset,
+            input_names=["imgs"], output_names=["flow"],
+            dynamic_axes={"imgs": {0: "batch", 2: "height", 3: "width"},
+                          "flow": {0: "batch", 2: "height", 3: "width"}},
+        )
+    _write_metadata(onnx_path, meta)
+    print(f"已导出 ONNX 模型：{onnx_path}，耗时 {time.time() - start:.2f} 秒")
+
+    int8_path = None
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        int8_path = f"{os.path.splitext(onnx_path)[0]}_int8.onnx"
+        quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QInt8)
+        _write_metadata(int8_path, meta)
+        print(f"已导出 int8 动态量化模型：{int8_path}")
+    return {"onnx": onnx_path, "int8": int8_path}
+
+
+class OnnxFlowModel:
+    """
+    ONNX Runtime（CPUExecutionProvider）上的光流模型，输入输出与 mmflow inference_model 一致：
+    BGR uint8 图像对 → (H, W, 2) float32 光流（像素单位，原图尺寸）。
+    """
+
+    def __init__(self, onnx_path, intra_op_threads=DEFAULT_INTRA_OP_THREADS,
+                 inter_op_threads=DEFAULT_INTER_OP_THREADS):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = (ort.ExecutionMode.ORT_PARALLEL if inter_op_threads > 1
+                                  else ort.ExecutionMode.ORT_SEQUENTIAL)
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        meta = self.session.get_modelmeta().custom_metadata_map.get(_META_KEY)
+        self.preprocess = json.loads(meta) if meta else dict(_DEFAULT_PREPROCESS)
+        self.mean = np.array(self.preprocess["mean"], dtype=np.float32)
+        self.std = np.array(self.preprocess["std"], dtype=np.float32)
+
+    def _network_size(self, height, width):
+        divisor = self.preprocess["size_divisor"]
+        return int(np.ceil(height / divisor) * divisor), int(np.ceil(width / divisor) * divisor)
+
+    def _prepare(self, img, net_h, net_w):
+        # 与 mmflow 测试流水线一致：对齐尺寸（双线性缩放或右下边缘填充）→ 归一化 → CHW
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        height, width = img.shape[:2]
+        if self.preprocess["size_mode"] == "resize":
+            img = cv2.resize(img, (net_w, net_h), interpolation=cv2.INTER_LINEAR)
+        else:
+            img = cv2.copyMakeBorder(img, 0, net_h - height, 0, net_w - width, cv2.BORDER_REPLICATE)
+        img = img.astype(np.float32)
+        if self.preprocess["to_rgb"]:
+            img = img[..., ::-1]
+        return ((img - self.mean) / self.std).transpose(2, 0, 1)
+
+    def _restore(self, flow, height, width):
+        # 网络分辨率 (2, h, w) → 原图尺寸 (H, W, 2)：缩放时按比例换算位移，填充时裁掉填充区域
+        flow = flow.transpose(1, 2, 0)
+        net_h, net_w = flow.shape[:2]
+        if self.preprocess["size_mode"] == "resize":
+            flow = cv2.resize(flow, (width, height), interpolation=cv2.INTER_LINEAR)
+            flow[..., 0] *= width / net_w
+            flow[..., 1] *= height / net_h
+        else:
+            flow = flow[:height, :width]
+        return np.ascontiguousarray(flow, dtype=np.float32)
+
+    def _run(self, img1s, img2s):
+        height, width = img1s[0].shape[:2]
+        net_h, net_w = self._network_size(height, width)
+        imgs = np.stack([np.concatenate([self._prepare(a, net_h, net_w), self._prepare(b, net_h, net_w)])
+                         for a, b in zip(img1s, img2s)])
+        flows = self.session.run(None, {self.input_name: imgs})[0]
+        return [self._restore(flow, height, width) for flow in flows]
+
+    def predict(self, img1s, img2s):
+        """批量推理：尺寸相同的图像对一次前向，尺寸不同时逐对推理。返回光流列表。"""
+        if len({img.shape[:2] for img in img1s}) == 1:
+            return self._run(img1s, img2s)
+        return [self._run([a], [b])[0] for a, b in zip(img1s, img2s)]
+
+
+def load_onnx_flow_model(onnx_path, intra_op_threads=DEFAULT_INTRA_OP_THREADS,
+                         inter_op_threads=DEFAULT_INTER_OP_THREADS):
+    """
+    取得（必要时创建）ONNX Runtime 光流模型，与 FlowNet2 一样在进程内按模型与线程设置复用。
+
+    返回：
+        (model, load_time): load_time 为本次创建会话的耗时（秒），命中缓存时为 0.0
+    """
+    from flow_model_registry import get_model
+
+    device = f"cpu(intra={intra_op_threads},inter={inter_op_threads})"
+    return get_model(onnx_path, onnx_path, device,
+                     lambda path, _, device: OnnxFlowModel(path, intra_op_threads, inter_op_threads))
+
+
+def flow_epe(flow, reference):
+    """端点误差（EPE）：逐像素光流向量差的欧氏距离，返回 (H, W) float32。"""
+    return np.linalg.norm(flow.astype(np.float32) - reference.astype(np.float32), axis=-1)
+
+
+def compare_onnx_with_pytorch(pairs, onnx_path, config_file, checkpoint_file, device="cuda:0",
+                              intra_op_threads=DEFAULT_INTRA_OP_THREADS,
+                              inter_op_threads=DEFAULT_INTER_OP_THREADS, max_pairs=None):
+    """
+    在参考片段上比较 ONNX Runtime 模型与 PyTorch（mmflow）模型的光流输出。
+
+    参数：
+        pairs (Iterable): 产出 (pair_name, img1, img2) 的图像对迭代器（如 iter_frame_pairs）
+        onnx_path (str): 待评估的 .onnx 模型（可为 int8 量化模型）
+        config_file, checkpoint_file, device: 作为参考的 mmflow 模型。mmflow 不支持在 CPU 上运行
+            mmcv 的 Correlation，device 为 CPU 时参考模型改用与导出时相同的纯 PyTorch Correlation
+        max_pairs (int): 最多比较的图像对数（None 为全部）
+
+    返回：
+        report (dict): {"pairs": 比较的对数, "epe_mean": 全部像素的平均 EPE,
+            "epe_max_pair": 单对平均 EPE 的最大值, "epe_p95": 全部像素 EPE 的 95 分位数,
+            "pytorch_time": PyTorch 推理总耗时（秒）, "onnx_time": ONNX Runtime 推理总耗时（秒）,
+            "per_pair": {pair_name: 该对平均 EPE}}
+    """
+    from mmflow.apis import inference_model, init_model
+
+    torch_model = init_model(config_file, checkpoint_file, device=device)
+    if not str(device).startswith("cuda"):
+        _replace_correlation(torch_model)
+    onnx_model = OnnxFlowModel(onnx_path, intra_op_threads, inter_op_threads)
+    per_pair, epes = {}, []
+    torch_time = onnx_time = 0.0
+    for index, (name, img1, img2) in enumerate(pairs):
+        if max_pairs is not None and index >= max_pairs:
+            break
+        if isinstance(img1, str):
+            img1, img2 = cv2.imread(img1), cv2.imread(img2)
+        elif img1.ndim == 2:
+            img1, img2 = cv2.cvtColor(img1, cv2.COLOR_GRAY2BGR), cv2.cvtColor(img2, cv2.COLOR_GRAY2BGR)
+        start = time.time()
+        reference = inference_model(torch_model, img1, img2)
+        torch_time += time.time() - start
+        start = time.time()
+        flow = onnx_model.predict([img1], [img2])[0]
+        onnx_time += time.time() - start
+        epe = flow_epe(flow, reference)
+        per_pair[name] = float(epe.mean())
+        epes.append(epe.ravel())
+
+    if not epes:
+        raise ValueError("参考片段中没有可比较的图像对")
+    epes = np.concatenate(epes)
+    report = {
+        "pairs": len(per_pair),
+        "epe_mean": float(epes.mean()),
+        "epe_max_pair": max(per_pair.values()),
+        "epe_p95": float(np.percentile(epes, 95)),
+        "pytorch_time": torch_time,
+        "onnx_time": onnx_time,
+        "per_pair": per_pair,
+    }
+    print(f"ONNX 与 PyTorch 光流对比：{report['pairs']} 对，平均 EPE {report['epe_mean']:.4f} 像素，"
+          f"P95 {report['epe_p95']:.4f}，单对最大 {report['epe_max_pair']:.4f}；"
+          f"耗时 PyTorch {torch_time:.2f} 秒 / ONNX {onnx_time:.2f} 秒")
+    return report
+
+
+if __name__ == "__main__":
+    # 示例：导出 FlowNet2 并在参考片段上检查精度（替换为实际路径）
+    from invert_and_pairs import iter_frame_pairs
+
+    config = "/media/ecust/新加卷/qyx/qyx/mmflow/configs/flownet2/flownet2_8x1_slong_flyingchairs_384x448.py"
+    checkpoint = "/media/ecust/新加卷/qyx/qyx/mmflow/work_dirs/my_flownet2_8x1_slong_flyingchairs_384x448/latest.pth"
+    reference_clip = "/mnt/video/2025-06-06-11-47-03.raw_frames_tiff_cropped_linearized"
+
+    paths = export_flownet2_onnx(config, checkpoint, "pretrain_model/flownet2.onnx", quantize=True)
+    for model_path in filter(None, paths.values()):
+        compare_onnx_with_pytorch(iter_frame_pairs(reference_clip, invert=True), model_path,
+                                  config, checkpoint, max_pairs=50)
+
+# 调用方式：------------------------------------------------------------------------
+# # 无 GPU 时用 ONNX Runtime CPU 推理 FlowNet2（模型由 export_flownet2_onnx 导出）：
+# run_optical_flow_inference(iter_frame_pairs(linear_frames, invert=True), "out_flo", engine="onnx",
+#                            onnx_model="pretrain_model/flownet2_int8.onnx",
+#                            intra_op_threads=4, inter_op_threads=1)
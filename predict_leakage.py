@@ -8,6 +8,10 @@ import tifffile as tiff
 import matplotlib.pyplot as plt
 from scipy.stats import entropy
 
+from flow_stack import FlowStack, is_flow_stack_path
+from frame_stack import FrameOutput, array_frame_names, is_frame_stack_path, iter_named_frames
+from preprocess_kernel import CAMERA_PARAM
+
 plt.rcParams["font.family"] = ["Arial", "sans-serif"]
 plt.rcParams["axes.unicode_minus"] = False
 
@@ -32,25 +36,31 @@ def load_lookup_table(file_path='./d_i_cl.npy'):
         return None, None
 
 
+def convert_frame_to_cl(img_array, d_i_list, CLs):
+    """将前景帧（ΔI）按查找表插值为 CL 图，返回 float32 数组。"""
+    if len(img_array.shape) > 2:
+        img_array = img_array[..., 0]  # 处理多通道TIFF，取第一个通道
+    img_array = img_array.astype(np.float32)
+    camera_param = CAMERA_PARAM
+    delta_i_array = img_array / camera_param
+     # ---------------------- 新增代码 ----------------------
+    # 计算并打印当前帧 delta_I 的均值（保留4位小数，便于阅读）
+    # delta_i_mean = np.mean(delta_i_array)
+    # print(f"📊 帧 delta_I 均值: {delta_i_mean:.4f}")
+
+    cl_array = np.interp(delta_i_array, d_i_list, CLs)
+    return cl_array.astype(np.float32)
+
+
 def convert_tif_to_cl_tif(tif_path, d_i_list, CLs, save_folder):
     try:
         img_name = os.path.splitext(os.path.basename(tif_path))[0]
         img_array = tiff.imread(tif_path)
-        if len(img_array.shape) > 2:
-            img_array = img_array[..., 0]  # 处理多通道TIFF，取第一个通道
-        img_array = img_array.astype(np.float32)
-        camera_param = 30724
-        delta_i_array = img_array / camera_param
-         # ---------------------- 新增代码 ----------------------
-        # 计算并打印当前帧 delta_I 的均值（保留4位小数，便于阅读）
-        # delta_i_mean = np.mean(delta_i_array)
-        # print(f"📊 帧 {img_name} - delta_I 均值: {delta_i_mean:.4f}")
-
-        cl_array = np.interp(delta_i_array, d_i_list, CLs)
+        cl_array = convert_frame_to_cl(img_array, d_i_list, CLs)
         save_path = os.path.join(save_folder, f"{img_name}_CL.tif")
         if not os.path.exists(save_folder):
             os.makedirs(save_folder, exist_ok=True)
-        tiff.imwrite(save_path, cl_array.astype(np.float32))
+        tiff.imwrite(save_path, cl_array)
         # print(f"✅ Saved: {save_path}")
         return save_path
     except Exception as e:
@@ -58,20 +68,23 @@ def convert_tif_to_cl_tif(tif_path, d_i_list, CLs, save_folder):
         return None
 
 
-def batch_process_images(tif_folder, d_i_list, CLs, output_folder):
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder, exist_ok=True)
-    tif_files = [f for f in os.listdir(tif_folder) if f.lower().endswith(('.tif', '.tiff'))]
-
+def batch_process_images(tif_folder, d_i_list, CLs, output_folder, export_dir=None):
+    """
+    批量将前景帧转换为 CL 图。
+    tif_folder / output_folder 可以是逐帧文件夹或帧堆栈（.npz）；export_dir 为可选的逐帧导出目录。
+    返回：文件夹模式为保存路径列表，帧堆栈模式为帧名列表（均按帧号排序）。
+    """
     # 使用“最后一段数字”稳健排序（frame_0164.tif -> 164）
-    tif_files.sort(key=lambda f: (_extract_last_int_from_name(f), f))
-
     saved_paths = []
-    for f in tif_files:
-        full_path = os.path.join(tif_folder, f)
-        saved_path = convert_tif_to_cl_tif(full_path, d_i_list, CLs, output_folder)
-        if saved_path:
-            saved_paths.append(saved_path)
+    with FrameOutput(output_folder, ext='.tif', export_dir=export_dir) as out:
+        for name, img_array in iter_named_frames(tif_folder, exts=('.tif', '.tiff')):
+            if img_array is None:
+                continue
+            try:
+                cl_array = convert_frame_to_cl(img_array, d_i_list, CLs)
+                saved_paths.append(out.write(f"{name}_CL", cl_array))
+            except Exception as e:
+                print(f"❌ Image processing failed ({name}): {e}")
     return saved_paths
 
 
@@ -87,6 +100,13 @@ def read_flo_file(filename):
     return flow
 
 
+def _as_flow(flow_or_path):
+    # 兼容旧接口：传入 .flo 路径时读文件，传入光流数组（如光流堆栈的视图）时直接使用
+    if isinstance(flow_or_path, str):
+        return read_flo_file(flow_or_path)
+    return np.asarray(flow_or_path, dtype=np.float32)
+
+
 def visualize_flow(flow):
     h, w = flow.shape[:2]
     hsv = np.zeros((h, w, 3), dtype=np.uint8)
@@ -129,8 +149,17 @@ def load_image_safe(image_path):
         return None
 
 
+def _as_image(image_or_path):
+    # 兼容旧接口：传入路径时按文件读取，传入数组时直接使用
+    if isinstance(image_or_path, str):
+        return load_image_safe(image_or_path)
+    if image_or_path is None or image_or_path.size == 0:
+        return None
+    return image_or_path
+
+
 def compute_cl_valid_ratio(cl_path, min_cl_value=0):
-    cl_img = load_image_safe(cl_path)
+    cl_img = _as_image(cl_path)
     if cl_img is None:
         return 0
     if cl_img.dtype != np.float32:
@@ -141,7 +170,7 @@ def compute_cl_valid_ratio(cl_path, min_cl_value=0):
 
 def compute_flow_valid_ratio(flow_path, min_flow_magnitude=0.5):
     try:
-        flow = read_flo_file(flow_path)
+        flow = _as_flow(flow_path)
     except Exception as e:
         print(f"Failed to read flow: {e}")
         return 0
@@ -151,11 +180,11 @@ def compute_flow_valid_ratio(flow_path, min_flow_magnitude=0.5):
 
 
 def compute_iou(cl_path, flow_path, min_cl_value=0, min_flow_magnitude=0.5):
-    cl = load_image_safe(cl_path)
+    cl = _as_image(cl_path)
     if cl is None:
         return 0
     try:
-        flow = read_flo_file(flow_path)
+        flow = _as_flow(flow_path)
     except Exception as e:
         print(f"Failed to read flow file: {e}")
         return 0
@@ -169,22 +198,21 @@ def compute_iou(cl_path, flow_path, min_cl_value=0, min_flow_magnitude=0.5):
     return np.sum(inter) / np.sum(union) if np.sum(union) > 0 else 0
 
 
-def find_matching_flow_file(plume_filename, flow_dir):
+def _match_flow_name(plume_filename, flow_names):
     """
-    通用匹配：优先用“数字帧号”精确匹配 .flo；若失败再用多模式包含匹配。
+    通用匹配：优先用“数字帧号”精确匹配光流名；若失败再用多模式包含匹配。
+    flow_names 为 .flo 文件名或光流堆栈的帧名，返回命中的名称或 None。
     """
     base = os.path.splitext(plume_filename)[0]          # e.g. frame_0001_CL
     base_num = _extract_last_int_from_name(base)        # -> 1 或 inf
     frame_num_str = None if base_num == float('inf') else str(base_num)
 
-    # 1) 优先：在 .flo 文件名中提取“最后一段数字”，若与 CL 的帧号完全相等则命中
+    # 1) 优先：在光流名中提取“最后一段数字”，若与 CL 的帧号完全相等则命中
     exact_candidates = []
-    for f in os.listdir(flow_dir):
-        if not f.endswith('.flo'):
-            continue
+    for f in flow_names:
         f_num = _extract_last_int_from_name(f)
         if frame_num_str is not None and f_num != float('inf') and f_num == int(frame_num_str):
-            exact_candidates.append(os.path.join(flow_dir, f))
+            exact_candidates.append(f)
     if exact_candidates:
         exact_candidates.sort()
         return exact_candidates[0]  # 保证可重复性
@@ -202,21 +230,53 @@ def find_matching_flow_file(plume_filename, flow_dir):
         '_'.join(parts[:2]) if len(parts) >= 2 else base  # frame_0001
     ])
 
-    for f in os.listdir(flow_dir):
-        if f.endswith('.flo') and any(p in f for p in patterns if p):
-            return os.path.join(flow_dir, f)
+    for f in flow_names:
+        if any(p in f for p in patterns if p):
+            return f
 
     print(f"未找到匹配的光流文件！CL文件名：{plume_filename}，尝试过的模式：{patterns}")
     return None
 
 
+def find_matching_flow_file(plume_filename, flow_dir):
+    """在 .flo 目录中查找与 CL 图匹配的光流文件（规则见 _match_flow_name），返回路径或 None。"""
+    # 按文件名排序（与光流堆栈的帧顺序一致），回退匹配不再依赖 os.listdir 的文件系统顺序
+    flo_names = sorted(f for f in os.listdir(flow_dir) if f.endswith('.flo'))
+    name = _match_flow_name(plume_filename, flo_names)
+    return os.path.join(flow_dir, name) if name else None
+
+
+def _iter_plume_flows(plumes, flow_folder):
+    """
+    为每帧 CL 图找到匹配的光流，产出 (plume_filename, plume, flow)；每对光流只读取一次。
+    flow_folder 为光流堆栈（.npy，按帧名索引取内存映射视图）或 .flo 目录；
+    没有匹配或读取失败的帧 flow 为 None（仍然产出，保持帧序号不变）。
+    """
+    if is_flow_stack_path(flow_folder):
+        with FlowStack(flow_folder) as stack:
+            for plume_filename, plume in plumes:
+                name = _match_flow_name(plume_filename, stack.names)
+                yield plume_filename, plume, _as_flow(stack.get(name)) if name else None
+        return
+
+    for plume_filename, plume in plumes:
+        flow_path = find_matching_flow_file(plume_filename, flow_folder)
+        flow = None
+        if flow_path and os.path.exists(flow_path):
+            try:
+                flow = read_flo_file(flow_path)
+            except Exception:
+                pass
+        yield plume_filename, plume, flow
+
+
 def compute_leakage_from_image_and_flow(plume_path, flow_path,
                                         pixel_size=0.002, frame_interval=0.04,
                                         ppm_to_kgm2=0.7142857e-6,
                                         boxes=None, min_overlap=50,
                                         min_flow_valid_ratio=0.5,
                                         min_flow_magnitude=0.5):
-    plume = load_image_safe(plume_path)
+    plume = _as_image(plume_path)
     if plume is None:
         return None
     if plume.dtype != np.float32:
@@ -224,7 +284,7 @@ def compute_leakage_from_image_and_flow(plume_path, flow_path,
     rho = plume * ppm_to_kgm2
     h, w = rho.shape
     try:
-        flow = read_flo_file(flow_path)
+        flow = _as_flow(flow_path)
     except Exception:
         return None
     vx = flow[:, :, 0] * pixel_size / frame_interval
@@ -252,40 +312,65 @@ def compute_leakage_from_image_and_flow(plume_path, flow_path,
 def predict_leakage(foreground_folder, flow_folder, lookup_table_path,
                     frames_per_group=3, window_size=30,
                     fragmentation_threshold=15, min_flow_magnitude=1.0,
-                    min_cl_value=10, save_curve=False, pixel_size=0.002):
+                    min_cl_value=10, save_curve=False, pixel_size=0.002, cl_export_dir=None,
+                    cl_frames=None):
     """
     主函数：返回平均泄漏量 (kg/h)
-    - foreground_folder: 原始前景TIFF目录
-    - flow_folder: 光流 .flo 目录
+    - foreground_folder: 原始前景TIFF目录、前景帧堆栈（.npz），或内存中的 (N, H, W) 前景帧数组
+    - flow_folder: 光流堆栈（.npy，见 flow_stack）或 .flo 目录
     - lookup_table_path: 查找表 .npy 路径
+    - cl_export_dir: 可选，CL 图逐帧导出目录（帧堆栈模式下调试用）
+    - cl_frames: 可选，内存模式下已由融合内核算好的 (N, H, W) CL 帧数组，提供时不再由前景换算
     """
-    # 与你原 main() 一致：CL 放在 foreground 的同级目录
-    output_tif_folder = os.path.join(os.path.dirname(foreground_folder), "CL")
-
     d_i_list, CLs = load_lookup_table(lookup_table_path)
     if d_i_list is None:
         return None
 
-    plume_files = batch_process_images(foreground_folder, d_i_list, CLs, output_tif_folder)
-    if not plume_files:
-        print("⚠️ 没有可用的 CL 图像。")
-        return None
-
-    # 稳健排序：按文件名最后一段数字排序（frame_0164_CL.tif -> 164）
-    plume_files.sort(key=lambda p: (_extract_last_int_from_name(os.path.basename(p)),
-                                    os.path.basename(p)))
+    if cl_frames is not None:
+        # 内存模式（融合内核）：CL 已与前景在同一遍中算好，直接使用
+        if len(cl_frames) == 0:
+            print("⚠️ 没有可用的 CL 图像。")
+            return None
+        curve_folder = os.path.dirname(os.path.abspath(flow_folder))
+        plumes = zip((f"{name}_CL.tif" for name in array_frame_names(len(cl_frames))), cl_frames)
+    elif isinstance(foreground_folder, np.ndarray):
+        # 内存模式：逐帧在内存中换算 CL（与写盘模式的 float32 结果一致），不写 CL 图
+        if len(foreground_folder) == 0:
+            print("⚠️ 没有可用的 CL 图像。")
+            return None
+        curve_folder = os.path.dirname(os.path.abspath(flow_folder))
+        plumes = (
+            (f"{name}_CL.tif", convert_frame_to_cl(frame, d_i_list, CLs))
+            for name, frame in iter_named_frames(foreground_folder)
+        )
+    else:
+        # 与你原 main() 一致：CL 放在 foreground 的同级目录（前景为帧堆栈时 CL 也写成帧堆栈）
+        cl_name = "CL.npz" if is_frame_stack_path(foreground_folder) else "CL"
+        output_tif_folder = os.path.join(os.path.dirname(foreground_folder), cl_name)
+        curve_folder = os.path.dirname(output_tif_folder)
+
+        plume_files = batch_process_images(foreground_folder, d_i_list, CLs, output_tif_folder,
+                                           export_dir=cl_export_dir)
+        if not plume_files:
+            print("⚠️ 没有可用的 CL 图像。")
+            return None
+
+        # 只使用本次生成的 CL 图；按文件名最后一段数字排序（frame_0164_CL.tif -> 164）
+        plume_names = {os.path.splitext(os.path.basename(p))[0] for p in plume_files}
+        plumes = (
+            (f"{name}.tif", plume)
+            for name, plume in iter_named_frames(output_tif_folder, exts=('.tif', '.tiff'))
+            if name in plume_names
+        )
 
     all_valid_q, cl_valid_ratios, flow_valid_ratios, iou_values = [], [], [], []
     plotted_q, plotted_time = [], []
 
-    for frame_idx, plume_path in enumerate(plume_files):
-        plume_filename = os.path.basename(plume_path)
-        flow_path = find_matching_flow_file(plume_filename, flow_folder)
-        if not flow_path or not os.path.exists(flow_path):
+    for frame_idx, (plume_filename, plume, flow) in enumerate(_iter_plume_flows(plumes, flow_folder)):
+        if flow is None:
             continue
 
         try:
-            flow = read_flo_file(flow_path)
             frag_val = calculate_fragmentation(flow, is_raw_flow=True)
             if frag_val > fragmentation_threshold:
                 continue
@@ -293,15 +378,15 @@ def predict_leakage(foreground_folder, flow_folder, lookup_table_path,
             continue
 
         q = compute_leakage_from_image_and_flow(
-            plume_path, flow_path,
+            plume, flow,
             pixel_size=pixel_size,   # 👈 这里传进去
             boxes=[((50, 45), 31), ((50, 45), 32), ((50, 45), 33)],
             min_flow_magnitude=min_flow_magnitude
         )
 
-        cl_valid = compute_cl_valid_ratio(plume_path, min_cl_value)
-        flow_valid = compute_flow_valid_ratio(flow_path, min_flow_magnitude)
-        iou = compute_iou(plume_path, flow_path, min_cl_value, min_flow_magnitude)
+        cl_valid = compute_cl_valid_ratio(plume, min_cl_value)
+        flow_valid = compute_flow_valid_ratio(flow, min_flow_magnitude)
+        iou = compute_iou(plume, flow, min_cl_value, min_flow_magnitude)
 
         cl_valid_ratios.append(cl_valid)
         flow_valid_ratios.append(flow_valid)
@@ -344,7 +429,7 @@ def predict_leakage(foreground_folder, flow_folder, lookup_table_path,
         plt.ylim(0, 5)
         plt.grid(True, linestyle='--', alpha=0.7)
         plt.tight_layout()
-        save_path = os.path.join(os.path.dirname(output_tif_folder), 'flow_vs_time.png')
+        save_path = os.path.join(curve_folder, 'flow_vs_time.png')
         plt.savefig(save_path)
 
     return np.mean(plotted_q) if plotted_q else None
\ No newline at end of file
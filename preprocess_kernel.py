@@ -0,0 +1,173 @@
+import numpy as np
+
+CAMERA_PARAM = 30724  # ΔI 归一化系数（与 predict_leakage 的 CL 换算一致）
+PLANES = ("crop", "linear", "foreground", "cl")
+_PLANE_DTYPES = {
+    "crop": np.uint16,
+    "linear": np.uint8,
+    "foreground": np.uint16,
+    "cl": np.float32,
+}
+
+
+class PreprocessKernel:
+    """
+    融合的逐帧预处理内核：对一块 (n, H, W) uint16 帧，在同一遍中依次得到
+    裁剪帧、线性化帧（uint8）、前景（减背景）和 CL 图，中间结果复用预分配的缓冲区，
+    不再像各阶段那样对整段帧序列分别遍历。
+
+    计算与原各阶段逐位一致：
+        linear     = clip((crop - min_val) / scale_factor, 0, 255) 取整（整数运算）
+        foreground = max(crop - background, 0)（uint16 饱和减法）
+        cl         = interp(float32(foreground) / CAMERA_PARAM, d_i_list, CLs)
+    """
+
+    def __init__(self, min_val, scale_factor, roi=None, background=None,
+                 d_i_list=None, CLs=None, camera_param=CAMERA_PARAM):
+        """
+        参数：
+            min_val (int): 全局最小值（线性化下限）
+            scale_factor (int): 线性化时除以的整数倍数
+            roi (tuple | None): 裁剪窗口 (x, y, w, h)；None 表示输入已是裁剪后的帧
+            background (np.ndarray | None): 逆线性化后的16位背景，计算前景/CL 时需要
+            d_i_list, CLs (np.ndarray | None): ΔI→CL 查找表，计算 CL 时需要
+            camera_param (int): ΔI 归一化系数
+        """
+        self.min_val = int(min_val)
+        # 全局最值相等时 scale_factor 为0，此时所有帧都映射为0
+        self.scale_factor = max(int(scale_factor), 1)
+        self.roi = None if roi is None else tuple(int(v) for v in roi)
+        self.camera_param = np.float32(camera_param)
+        self.background = None
+        self.d_i_list, self.CLs = None, None
+        self._buffers = {}
+        if background is not None:
+            self.set_background(background)
+        if d_i_list is not None:
+            self.set_lookup(d_i_list, CLs)
+
+    def set_background(self, background):
+        """设置（或更换）16位背景图。"""
+        background = np.asarray(background)
+        if background.ndim != 2:
+            raise ValueError(f"背景图必须是单通道灰度图，实际维度: {background.ndim}")
+        if background.dtype != np.uint16:
+            raise TypeError(f"背景应为16位，实际为{background.dtype}")
+        self.background = background
+
+    def set_lookup(self, d_i_list, CLs):
+        """设置 ΔI→CL 查找表。"""
+        if d_i_list is None or CLs is None:
+            raise ValueError("查找表 d_i_list / CLs 不能为空")
+        self.d_i_list, self.CLs = d_i_list, CLs
+
+    def _buffer(self, key, shape, dtype):
+        # 按需（重新）分配，之后的块直接复用；最后一块帧数较少时取前 n 帧的视图
+        buf = self._buffers.get(key)
+        if buf is None or buf.dtype != dtype or buf.shape[1:] != shape[1:] or len(buf) < shape[0]:
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[key] = buf
+        return buf[:shape[0]]
+
+    def _check_planes(self, planes):
+        planes = PLANES if planes is None else tuple(planes)
+        for p in planes:
+            if p not in PLANES:
+                raise ValueError(f"未知的输出平面 {p}，可选：{PLANES}")
+        if ("foreground" in planes or "cl" in planes) and self.background is None:
+            raise ValueError("计算前景/CL 需要先设置背景图（set_background）")
+        if "cl" in planes and self.d_i_list is None:
+            raise ValueError("计算 CL 需要先设置查找表（set_lookup）")
+        return planes
+
+    def _crop(self, block):
+        if self.roi is None:
+            return block
+        x, y, w, h = self.roi
+        if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > block.shape[2] or y + h > block.shape[1]:
+            raise ValueError(f"裁剪区域 (x={x}, y={y}, w={w}, h={h}) 超出帧范围 {block.shape[2]}x{block.shape[1]}")
+        return block[:, y:y + h, x:x + w]
+
+    def run_block(self, block, planes=None, out=None):
+        """
+        处理一块 (n, H, W) uint16 帧，返回 {平面名: (n, h, w) 数组}。
+
+        参数：
+            block (np.ndarray): (n, H, W) uint16 帧块（可以是memmap切片）
+            planes (iterable | None): 需要的输出平面，默认全部（PLANES）
+            out (dict | None): 可选，各平面的目标数组（例如整段输出的切片）；
+                未提供的平面写入内核自己的缓冲区，下一次调用时会被覆盖
+
+        返回：
+            planes (dict): 各平面的结果数组
+        """
+        planes = self._check_planes(planes)
+        block = np.asarray(block)
+        if block.ndim != 3:
+            raise ValueError(f"帧块应为 (n, H, W)，实际维度: {block.ndim}")
+        if block.dtype != np.uint16:
+            raise TypeError(f"帧块应为16位，实际为{block.dtype}")
+        crop = self._crop(block)
+        shape = crop.shape
+        if self.background is not None and self.background.shape != shape[1:] and (
+                "foreground" in planes or "cl" in planes):
+            raise ValueError(f"帧尺寸与背景不匹配（帧: {shape[1:]}, 背景: {self.background.shape}）")
+
+        out = out or {}
+        result = {}
+        for p in planes:
+            result[p] = out[p] if p in out else self._buffer(p, shape, _PLANE_DTYPES[p])
+
+        if "crop" in result:
+            np.copyto(result["crop"], crop)
+
+        work = self._buffer("_work", shape, np.uint16)
+        if "linear" in result:
+            # (x - min) // s 与原先的浮点除法后截断取整结果相同
+            np.subtract(crop, self.min_val, out=work)
+            np.floor_divide(work, self.scale_factor, out=work)
+            np.minimum(work, 255, out=work)
+            np.copyto(result["linear"], work, casting='unsafe')
+
+        if "foreground" in result or "cl" in result:
+            foreground = result["foreground"] if "foreground" in result else work
+            np.maximum(crop, self.background, out=foreground)
+            np.subtract(foreground, self.background, out=foreground)
+
+            if "cl" in result:
+                delta_i = self._buffer("_delta_i", shape, np.float32)
+                np.copyto(delta_i, foreground, casting='unsafe')
+                np.divide(delta_i, self.camera_param, out=delta_i)
+                np.copyto(result["cl"], np.interp(delta_i, self.d_i_list, self.CLs), casting='unsafe')
+
+        return result
+
+    def run_frame(self, frame, planes=None):
+        """处理单帧 (H, W)，返回 {平面名: (h, w) 数组}（内核缓冲区的视图）。"""
+        result = self.run_block(np.asarray(frame)[None], planes)
+        return {p: arr[0] for p, arr in result.items()}
+
+    def run_stack(self, frames, planes=None, chunk=64):
+        """
+        分块处理整段 (N, H, W) 帧，返回 {平面名: (N, h, w) 数组}；
+        输出数组一次性分配，各块结果直接写入对应切片。
+        """
+        if chunk <= 0:
+            raise ValueError("chunk 必须为正整数")
+        planes = self._check_planes(planes)
+        n = len(frames)
+        frame_shape = frames.shape[1:] if self.roi is None else (self.roi[3], self.roi[2])
+        outputs = {p: np.empty((n,) + tuple(frame_shape), dtype=_PLANE_DTYPES[p]) for p in planes}
+        for i in range(0, n, chunk):
+            self.run_block(frames[i:i + chunk], planes,
+                           out={p: arr[i:i + chunk] for p, arr in outputs.items()})
+        return outputs
+
+# 调用方式：------------------------------------------------------------------------
+# kernel = PreprocessKernel(min_val=12609, scale_factor=3, roi=(122, 76, 80, 60))
+# linear = kernel.run_stack(frames, planes=("linear",))["linear"]       # 背景建模前
+#
+# kernel.set_background(background)
+# kernel.set_lookup(d_i_list, CLs)
+# for block in iter_frame_blocks(frames, start=100, chunk=32):         # 逐块，结果复用缓冲区
+#     planes = kernel.run_block(block, planes=("foreground", "cl"))
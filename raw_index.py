@@ -0,0 +1,154 @@
+import os
+import hashlib
+import time
+import numpy as np
+
+from raw_to_frames import RAW_VALUE_MASK
+
+
+def raw_index_path(raw_path):
+    """RAW文件对应的索引文件路径（与RAW同目录，命名沿用 <raw>_xxx 的习惯）。"""
+    return f"{raw_path}_index.npz"
+
+
+def build_raw_index(raw_path, frame_width=320, frame_height=256,
+                    chunk=64, value_mask=RAW_VALUE_MASK):
+    """
+    单遍扫描RAW文件，生成紧凑的索引文件（npz），供后续阶段直接读取：
+    几何信息、帧数、每帧 min/max/mean、内容校验和以及每帧字节偏移。
+
+    参数：
+        raw_path (str): RAW文件路径
+        frame_width (int): 每帧宽度（像素）
+        frame_height (int): 每帧高度（像素）
+        chunk (int): 每次读取的帧数
+        value_mask (int): 像素有效位掩码（RAW为14位；16位相机数据传 0xFFFF）
+
+    返回：
+        index (dict): 索引内容（同 load_raw_index）
+    """
+    if not os.path.exists(raw_path):
+        raise FileNotFoundError(f"文件 {raw_path} 不存在")
+
+    start_time = time.time()
+    st = os.stat(raw_path)
+    frame_pixels = frame_width * frame_height
+    frame_bytes = frame_pixels * 2
+    frame_count = st.st_size // frame_bytes
+
+    frame_min = np.empty(frame_count, dtype=np.uint16)
+    frame_max = np.empty(frame_count, dtype=np.uint16)
+    frame_mean = np.empty(frame_count, dtype=np.float32)
+    digest = hashlib.blake2b(digest_size=16)
+
+    pos = 0
+    with open(raw_path, 'rb') as f:
+        while True:
+            buf = f.read(chunk * frame_bytes)
+            if not buf:
+                break
+            digest.update(buf)
+            n = min(len(buf) // frame_bytes, frame_count - pos)
+            if n <= 0:
+                continue
+            block = np.frombuffer(buf, dtype='<u2', count=n * frame_pixels)
+            block = np.bitwise_and(block, value_mask).astype(np.uint16, copy=False)
+            block = block.reshape(n, frame_pixels)
+            frame_min[pos:pos + n] = block.min(axis=1)
+            frame_max[pos:pos + n] = block.max(axis=1)
+            frame_mean[pos:pos + n] = block.mean(axis=1)
+            pos += n
+
+    index = {
+        "frame_width": frame_width,
+        "frame_height": frame_height,
+        "frame_count": frame_count,
+        "frame_bytes": frame_bytes,
+        "value_mask": value_mask,
+        "file_size": st.st_size,
+        "file_mtime_ns": st.st_mtime_ns,
+        "checksum": digest.hexdigest(),
+        "frame_offsets": np.arange(frame_count, dtype=np.int64) * frame_bytes,
+        "frame_min": frame_min,
+        "frame_max": frame_max,
+        "frame_mean": frame_mean,
+    }
+
+    # 先写临时文件再替换，避免并发读取到写了一半的索引
+    out_path = raw_index_path(raw_path)
+    tmp = out_path + ".tmp"
+    with open(tmp, 'wb') as f:
+        np.savez(f, **index)
+    os.replace(tmp, out_path)
+    print(f"RAW索引已生成：{out_path}（{frame_count} 帧，耗时 {time.time() - start_time:.2f} 秒）")
+    return index
+
+
+def load_raw_index(raw_path, frame_width=320, frame_height=256, verify_checksum=False):
+    """
+    读取RAW索引；若索引不存在、几何不一致或RAW文件已变化（大小/修改时间），返回None。
+
+    参数：
+        raw_path (str): RAW文件路径
+        frame_width (int): 期望的每帧宽度
+        frame_height (int): 期望的每帧高度
+        verify_checksum (bool): 是否额外重新计算内容校验和（需要完整读一遍文件）
+
+    返回：
+        index (dict | None)
+    """
+    path = raw_index_path(raw_path)
+    if not os.path.exists(path) or not os.path.exists(raw_path):
+        return None
+    try:
+        with np.load(path) as data:
+            index = {k: data[k] for k in data.files}
+    except Exception as e:
+        print(f"RAW索引读取失败，将重新生成：{e}")
+        return None
+
+    for k in ("frame_width", "frame_height", "frame_count", "frame_bytes",
+              "value_mask", "file_size", "file_mtime_ns"):
+        index[k] = int(index[k])
+    index["checksum"] = str(index["checksum"])
+
+    st = os.stat(raw_path)
+    if (index["frame_width"], index["frame_height"]) != (frame_width, frame_height):
+        return None
+    if index["file_size"] != st.st_size or index["file_mtime_ns"] != st.st_mtime_ns:
+        return None
+    if verify_checksum:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(raw_path, 'rb') as f:
+            for buf in iter(lambda: f.read(1 << 22), b''):
+                digest.update(buf)
+        if digest.hexdigest() != index["checksum"]:
+            return None
+    return index
+
+
+def get_raw_index(raw_path, frame_width=320, frame_height=256, value_mask=RAW_VALUE_MASK):
+    """读取有效的RAW索引；仅在索引缺失或RAW文件变化时重新扫描生成。"""
+    index = load_raw_index(raw_path, frame_width, frame_height)
+    if index is None or index["value_mask"] != value_mask:
+        index = build_raw_index(raw_path, frame_width, frame_height, value_mask=value_mask)
+    return index
+
+
+def index_min_max(index, start=0, stop=None):
+    """
+    由索引中的逐帧统计得到指定帧范围的全局最小值和最大值（不再读取像素）。
+
+    返回：
+        (global_min, global_max): int；范围内无帧时返回 (None, None)
+    """
+    frame_min = index["frame_min"][start:stop]
+    frame_max = index["frame_max"][start:stop]
+    if frame_min.size == 0:
+        return None, None
+    return int(frame_min.min()), int(frame_max.max())
+
+# 调用方式：------------------------------------------------------------------------
+# index = get_raw_index("video.raw", 320, 256)
+# print("帧数:", index["frame_count"])
+# gmin, gmax = index_min_max(index, start=100)
@@ -3,10 +3,160 @@ import time
 import numpy as np
 from PIL import Image
 
+RAW_VALUE_MASK = 0x3FFF  # 14位有效数据
+
+
+def load_raw_frames(file_path, frame_width=320, frame_height=256):
+    """
+    向量化解码RAW视频：按小端uint16一次性读入整个文件，统一做14位掩码，
+    返回 (N, H, W) 的帧数组（对同一块内存的reshape视图，不逐帧拷贝）。
+
+    参数：
+        file_path (str): RAW文件路径
+        frame_width (int): 每帧宽度（像素）
+        frame_height (int): 每帧高度（像素）
+
+    返回：
+        frames (np.ndarray): 形状为 (N, frame_height, frame_width) 的uint16数组
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"文件 {file_path} 不存在")
+
+    frame_pixels = frame_width * frame_height
+    data = np.fromfile(file_path, dtype='<u2').astype(np.uint16, copy=False)
+    total_frames = data.size // frame_pixels
+    # 丢弃文件末尾不足一帧的残余数据（与逐帧解码时的行为一致）
+    data = data[:total_frames * frame_pixels]
+    np.bitwise_and(data, RAW_VALUE_MASK, out=data)
+    return data.reshape((total_frames, frame_height, frame_width))
+
+
+def count_raw_frames(file_path, frame_width=320, frame_height=256):
+    """根据文件大小计算RAW视频的完整帧数（不读取像素数据）。"""
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"文件 {file_path} 不存在")
+    return os.path.getsize(file_path) // (frame_width * frame_height * 2)
+
+
+def _check_roi(roi, frame_width, frame_height):
+    x, y, w, h = (int(v) for v in roi)
+    if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > frame_width or y + h > frame_height:
+        raise ValueError(f"裁剪区域 (x={x}, y={y}, w={w}, h={h}) 超出帧范围 {frame_width}x{frame_height}")
+    return x, y, w, h
+
+
+def iter_frame_blocks(frames, start=0, stop=None, step=1, chunk=64, roi=None, value_mask=None):
+    """
+    对 (N, H, W) 帧数组（memmap 或 ndarray）按帧范围和裁剪窗口分块拷贝产出。
+    只有被选中的帧和裁剪窗口内的行列会被读取。
+
+    参数：
+        frames (np.ndarray): (N, H, W) 帧数组，通常是磁盘上的memmap
+        start (int): 起始帧序号（含），例如 100 表示跳过前100帧
+        stop (int | None): 结束帧序号（不含），None 表示到末尾
+        step (int): 帧间隔（必须为正整数）
+        chunk (int): 每次产出的最大帧数
+        roi (tuple | None): 裁剪窗口 (x, y, w, h)，None 表示整帧
+        value_mask (int | None): 像素有效位掩码（RAW原始数据需传 RAW_VALUE_MASK）
+
+    产出：
+        block (np.ndarray): 形状为 (n, H, W) 的uint16数组，n <= chunk；
+            指定 roi 时 H, W 为裁剪窗口的高和宽
+    """
+    if step <= 0:
+        raise ValueError("step 必须为正整数")
+    if chunk <= 0:
+        raise ValueError("chunk 必须为正整数")
+    if roi is None:
+        rows, cols = slice(None), slice(None)
+    else:
+        x, y, w, h = _check_roi(roi, frames.shape[2], frames.shape[1])
+        rows, cols = slice(y, y + h), slice(x, x + w)
+
+    indices = range(len(frames))[start:stop:step]
+    for i in range(0, len(indices), chunk):
+        sel = indices[i:i + chunk]
+        block = np.array(frames[sel.start:sel.stop:sel.step, rows, cols], dtype=np.uint16)
+        if value_mask is not None:
+            np.bitwise_and(block, value_mask, out=block)
+        yield block
+
+
+def read_frames_roi(frames, roi, start=0, stop=None, step=1, chunk=64, value_mask=None):
+    """
+    从 (N, H, W) 帧数组中只读取裁剪窗口，并在同一遍遍历中求出全局最小值和最大值。
+
+    参数：
+        frames (np.ndarray): (N, H, W) 帧数组，通常是磁盘上的memmap
+        roi (tuple): 裁剪窗口 (x, y, w, h)
+        start, stop, step, chunk, value_mask: 同 iter_frame_blocks
+
+    返回：
+        cropped (np.ndarray): 形状为 (n, h, w) 的uint16裁剪帧
+        global_min (int | None): 全局最小值（无帧时为None）
+        global_max (int | None): 全局最大值（无帧时为None）
+    """
+    x, y, w, h = _check_roi(roi, frames.shape[2], frames.shape[1])
+    n = len(range(len(frames))[start:stop:step])
+    cropped = np.empty((n, h, w), dtype=np.uint16)
+    global_min, global_max = None, None
+
+    pos = 0
+    for block in iter_frame_blocks(frames, start, stop, step, chunk,
+                                   roi=(x, y, w, h), value_mask=value_mask):
+        cropped[pos:pos + len(block)] = block
+        pos += len(block)
+        block_min, block_max = int(block.min()), int(block.max())
+        global_min = block_min if global_min is None else min(global_min, block_min)
+        global_max = block_max if global_max is None else max(global_max, block_max)
+
+    return cropped, global_min, global_max
+
+
+def open_raw_memmap(file_path, frame_width=320, frame_height=256):
+    """以只读memmap打开RAW文件，返回未做掩码的 (N, H, W) 小端uint16视图。"""
+    total_frames = count_raw_frames(file_path, frame_width, frame_height)
+    if total_frames == 0:
+        return np.zeros((0, frame_height, frame_width), dtype=np.uint16)
+    return np.memmap(file_path, dtype='<u2', mode='r',
+                     shape=(total_frames, frame_height, frame_width))
+
+
+def iter_raw_frames(file_path, start=0, stop=None, step=1, chunk=64,
+                    frame_width=320, frame_height=256, roi=None):
+    """
+    流式读取RAW视频：通过memmap直接定位到所需帧，按固定大小分块产出，
+    内存占用只与 chunk 有关，与录像总长度无关。
+    指定 roi 时只读取并解码裁剪窗口内的行列（memmap跨步视图）。
+
+    参数：
+        file_path (str): RAW文件路径
+        start, stop, step, chunk, roi: 同 iter_frame_blocks
+        frame_width (int): 每帧宽度（像素）
+        frame_height (int): 每帧高度（像素）
+
+    产出：
+        block (np.ndarray): 形状为 (n, H, W) 的uint16数组（已做14位掩码）
+    """
+    raw = open_raw_memmap(file_path, frame_width, frame_height)
+    yield from iter_frame_blocks(raw, start, stop, step, chunk, roi=roi, value_mask=RAW_VALUE_MASK)
+
+
+def read_raw_roi(file_path, roi, start=0, stop=None, step=1, chunk=64,
+                 frame_width=320, frame_height=256):
+    """
+    只解码RAW中裁剪窗口内的像素，并在同一遍遍历中求出全局最小值和最大值。
+    参数与返回值同 read_frames_roi。
+    """
+    raw = open_raw_memmap(file_path, frame_width, frame_height)
+    return read_frames_roi(raw, roi, start, stop, step, chunk, value_mask=RAW_VALUE_MASK)
+
+
 def decode_raw_video(file_path, frame_width=320, frame_height=256,
                      output_folder=None, save_as_tiff=True):
     """
     将RAW格式视频解码为帧序列，并可选择保存为TIFF图像。
+    （兼容接口：内部调用 load_raw_frames，返回的列表元素是同一数组的逐帧视图）
 
     参数：
         file_path (str): RAW文件路径
@@ -18,67 +168,37 @@ def decode_raw_video(file_path, frame_width=320, frame_height=256,
     返回：
         frames (list[np.ndarray]): 每帧的14位灰度图像（numpy数组）
     """
-    def read_raw_file(path):
-        if not os.path.exists(path):
-            raise FileNotFoundError(f"文件 {path} 不存在")
-        with open(path, 'rb') as f:
-            return f.read()
-
-    def count_frames(all_bytes):
-        frame_size = frame_width * frame_height * 2
-        return len(all_bytes) // frame_size
-
-    def extract_frame_data(all_bytes, idx):
-        frame_size = frame_width * frame_height * 2
-        start = idx * frame_size
-        return all_bytes[start:start + frame_size]
-
-    def bytes_to_ints(frame_data):
-        ints_data = []
-        for i in range(0, len(frame_data), 2):
-            low_byte = frame_data[i]
-            high_byte = frame_data[i + 1]
-            value = (high_byte << 8) | low_byte
-            ints_data.append(value & 0x3FFF)  # 14位有效数据
-        return np.array(ints_data, dtype=np.uint16)
-
-    def save_tiff(data, idx):
-        image_data = data.reshape((frame_height, frame_width))
-        image = Image.fromarray(image_data)
-        filename = f"frame_{idx+1:04d}.tiff"
-        path = os.path.join(output_folder, filename)
-        image.save(path, format='TIFF')
-        return path
-
-    # --- 主逻辑 ---
-    all_bytes = read_raw_file(file_path)
-    total_frames = count_frames(all_bytes)
-    frames = []
-
-    if output_folder and not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-
-    print(f"开始解码：{total_frames} 帧")
     start_time = time.time()
+    stack = load_raw_frames(file_path, frame_width, frame_height)
+    total_frames = len(stack)
+    print(f"开始解码：{total_frames} 帧")
 
-    for idx in range(total_frames):
-        frame_bytes = extract_frame_data(all_bytes, idx)
-        ints_data = bytes_to_ints(frame_bytes)
-        frames.append(ints_data.reshape((frame_height, frame_width)))
-
-        if save_as_tiff and output_folder:
-            save_tiff(ints_data, idx)
+    if save_as_tiff and output_folder:
+        os.makedirs(output_folder, exist_ok=True)
+        for idx, frame in enumerate(stack):
+            filename = f"frame_{idx+1:04d}.tiff"
+            Image.fromarray(frame).save(os.path.join(output_folder, filename), format='TIFF')
 
-        if (idx + 1) % 10 == 0 or idx == total_frames - 1:
-            progress = (idx + 1) / total_frames * 100
-            elapsed = time.time() - start_time
-            eta = (elapsed / (idx + 1)) * (total_frames - idx - 1)
-            print(f"进度: {progress:.1f}% ({idx+1}/{total_frames}), 剩余时间: {eta:.1f}s")
+            if (idx + 1) % 10 == 0 or idx == total_frames - 1:
+                progress = (idx + 1) / total_frames * 100
+                elapsed = time.time() - start_time
+                eta = (elapsed / (idx + 1)) * (total_frames - idx - 1)
+                print(f"进度: {progress:.1f}% ({idx+1}/{total_frames}), 剩余时间: {eta:.1f}s")
 
     print(f"解码完成，总耗时 {time.time() - start_time:.2f} 秒")
-    return frames
+    return list(stack)
 
 # 调用方式：------------------------------------------------------------------------
+# # 向量化解码，直接得到 (N, H, W) 数组
+# stack = load_raw_frames("video.raw", 320, 256)
+#
+# # 跳过前100帧，按64帧一块流式读取
+# for block in iter_raw_frames("video.raw", start=100, chunk=64):
+#     print(block.shape)
+#
+# # 只解码裁剪窗口，并同时得到全局最值
+# cropped, gmin, gmax = read_raw_roi("video.raw", (122, 76, 80, 60), start=100)
+#
 # # 仅提取帧，不保存
 # frames = decode_raw_video("video.raw", 320, 256, save_as_tiff=False)
 #
@@ -89,4 +209,4 @@ def decode_raw_video(file_path, frame_width=320, frame_height=256,
 #     frame_height=256,
 #     output_folder="output_frames",
 #     save_as_tiff=True
-# )
\ No newline at end of file
+# )
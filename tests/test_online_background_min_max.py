@@ -0,0 +1,37 @@
+import numpy as np
+
+from frame_cache import open_decoded_frames
+from infra_red_video_for_local_test import _iter_decoding_roi
+from raw_index import get_raw_index, index_min_max
+from raw_to_frames import read_frames_roi
+
+ROI = (122, 76, 80, 60)
+
+
+def _write_raw(path, frame_count=130):
+    # 裁剪窗口外放置冷/热像素，并置位高两位，确保整帧最值与裁剪窗口最值不同、掩码生效
+    rng = np.random.default_rng(0)
+    frames = rng.integers(7000, 9000, size=(frame_count, 256, 320), dtype=np.uint16)
+    frames[:, 0:8, 0:8] = 200
+    frames[:, 240:256, 300:320] = 16000
+    frames |= 0xC000
+    frames.astype("<u2").tofile(path)
+
+
+def test_online_backend_uses_crop_min_max(tmp_path):
+    """在线背景边解码边累计的最值，应与中值/分位数后端由 read_frames_roi 得到的裁剪窗口最值一致。"""
+    raw_path = str(tmp_path / "case.raw")
+    _write_raw(raw_path)
+
+    # 中值/分位数/高斯等后端：解码帧缓存 + read_frames_roi
+    cropped, gmin, gmax = read_frames_roi(open_decoded_frames(raw_path), ROI, start=100)
+
+    # 在线后端：按裁剪窗口流式解码
+    out = np.empty_like(cropped)
+    stats = {}
+    frames = list(_iter_decoding_roi(raw_path, ROI, out, stats, start=100))
+
+    assert len(frames) == len(cropped)
+    assert np.array_equal(out, cropped)
+    assert (stats["min"], stats["max"]) == (gmin, gmax)
+    assert (gmin, gmax) != index_min_max(get_raw_index(raw_path), start=100)
@@ -0,0 +1,50 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import video_encoder
+
+pytestmark = pytest.mark.skipif(not os.path.exists(video_encoder.FFMPEG_PATH), reason="需要 ffmpeg")
+
+
+def _slow_frames(entered, release):
+    # 第二帧在编码名额内才会被取出：取到时说明已占用名额，之后一直阻塞，模拟耗时的热力图渲染
+    frame = np.zeros((16, 16), dtype=np.uint8)
+    yield frame
+    entered.set()
+    release.wait()
+    yield frame
+
+
+def test_proxy_encode_not_blocked_by_final_renders(tmp_path):
+    """最终视频占满名额并等待慢速帧生成时，代理预览仍能立即编码。"""
+    release = threading.Event()
+    finals = []
+    for i in range(video_encoder.MAX_CONCURRENT_ENCODES):
+        entered = threading.Event()
+        t = threading.Thread(target=video_encoder.encode_frames,
+                             args=(_slow_frames(entered, release), str(tmp_path / f"final_{i}.mp4")),
+                             kwargs={"preset": "final"}, daemon=True)
+        t.start()
+        finals.append((t, entered))
+    try:
+        for _, entered in finals:
+            assert entered.wait(timeout=10)
+
+        proxy_path = str(tmp_path / "proxy.mp4")
+        proxy = threading.Thread(target=video_encoder.encode_frames,
+                                 args=([np.zeros((16, 16), dtype=np.uint8)] * 4, proxy_path),
+                                 kwargs={"preset": "proxy"}, daemon=True)
+        proxy.start()
+        proxy.join(timeout=30)
+        assert not proxy.is_alive()
+        assert os.path.exists(proxy_path)
+    finally:
+        release.set()
+        for t, _ in finals:
+            t.join(timeout=30)
+
+    for i in range(video_encoder.MAX_CONCURRENT_ENCODES):
+        assert os.path.exists(tmp_path / f"final_{i}.mp4")
@@ -2,7 +2,7 @@ import os, time, json
 import numpy as np
 from PIL import Image
 from imgs_2_video import create_video_from_pngs, create_video_from_pngs_264
-from imgs_2_video import create_video_for_web
+from video_encoder import encode_frames
 
 def _default_preview_root() -> str:
     # Default to <repo>/data/cases to match the new upload-based layout.
@@ -16,17 +16,30 @@ def _default_preview_root() -> str:
 # - new code stores everything in "data/cases/<case_id>/..."
 PREVIEW_ROOT = os.environ.get("IRV_PREVIEW_ROOT", _default_preview_root())
 
-def _to_uint8_stack(frames):
-    # 全局 min-max 拉伸，保持预览视频亮度一致
-    gmin = min(float(np.min(f)) for f in frames)
-    gmax = max(float(np.max(f)) for f in frames)
+def _iter_frames(frames):
+    # frames 可以是帧列表，也可以是每次调用都返回新迭代器的函数（流式读取时使用）
+    return frames() if callable(frames) else iter(frames)
+
+
+def _to_uint8_stack(frames, gmin=None, gmax=None):
+    # 全局 min-max 拉伸，保持预览视频亮度一致；已知最值（如来自 RAW 索引）时跳过统计遍历
+    if gmin is None or gmax is None:
+        gmin, gmax = float('inf'), float('-inf')
+        for f in _iter_frames(frames):
+            gmin = min(gmin, float(np.min(f)))
+            gmax = max(gmax, float(np.max(f)))
+    gmin, gmax = float(gmin), float(gmax)
     denom = max(gmax - gmin, 1e-9)
-    for f in frames:
+    for f in _iter_frames(frames):
         arr = ((f - gmin) / denom * 255.0).clip(0, 255).astype("uint8")
         yield arr
 
-def make_preview_and_wait(frames, case_id, server_host="localhost", server_port=5001, poll_sec=1):
+def make_preview_and_wait(frames, case_id, server_host="localhost", server_port=5001, poll_sec=1,
+                          gmin=None, gmax=None):
     """
+    frames: 帧列表，或每次调用都返回新帧迭代器的函数（避免整段录像常驻内存）
+    gmin/gmax: 已知的全局最值（如来自 RAW 索引），提供时不再额外遍历帧
+
     1) 生成 PNG + preview.mp4 到 /mnt/video/preview/<case_id>/
     2) 打印前端访问 URL
     3) 阻塞轮询 params.json，返回参数字典
@@ -36,12 +49,13 @@ def make_preview_and_wait(frames, case_id, server_host="localhost", server_port=
     frames_dir = os.path.join(case_dir, "frames")
     os.makedirs(frames_dir, exist_ok=True)
 
-    # 1) 存 PNG
-    for i, arr in enumerate(_to_uint8_stack(frames)):
-        Image.fromarray(arr).save(os.path.join(frames_dir, f"{i:04d}.png"))
+    # 1) 存 PNG，同时 2) 把同一帧直接送入 ffmpeg 合成预览视频（不再回读 PNG 序列）
+    def _save_png_frames():
+        for i, arr in enumerate(_to_uint8_stack(frames, gmin, gmax)):
+            Image.fromarray(arr).save(os.path.join(frames_dir, f"{i:04d}.png"))
+            yield arr
 
-    # 2) 合成预览视频
-    preview_mp4 = create_video_for_web(frames_dir, os.path.join(case_dir, "preview"))
+    preview_mp4 = encode_frames(_save_png_frames(), os.path.join(case_dir, "preview.mp4"), preset="preview")
 
     # 新增：初始化 result.json（供后端读取状态）
     result_path = os.path.join(case_dir, "result.json")
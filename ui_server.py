@@ -2,6 +2,8 @@ from flask import Flask, request, jsonify, render_template_string
 import os, json
 import time
 
+from video_encoder import HLS_CODEC_INFO
+
 def _default_static_root() -> str:
     here = os.path.dirname(os.path.abspath(__file__))
     repo = os.path.abspath(os.path.join(here, "."))
@@ -218,10 +220,15 @@ INDEX_HTML = r"""<!doctype html>
       fetch(`/api/check_new_video/${caseId}`)
           .then(response => response.json())
           .then(data => {
-              if (data.ok && data.new_video_exists && !newVideoExists) {
+              // 浏览器原生支持 HLS 时，渲染过程中即可切换到边写边播的播放列表
+              // （同时确认浏览器能解码分片实际使用的编码，否则等待完整 MP4）
+              const canPlayStream = data.ok && data.new_stream_exists && data.new_stream_codecs &&
+                  vid.canPlayType("application/vnd.apple.mpegurl") &&
+                  vid.canPlayType(`video/mp4; codecs="${data.new_stream_codecs}"`);
+              if (data.ok && (data.new_video_exists || canPlayStream) && !newVideoExists) {
                   // 新视频已生成且未切换过：执行切换逻辑
                   newVideoExists = true;
-                  NEW_VIDEO_URL = data.new_video_url;
+                  NEW_VIDEO_URL = data.new_video_exists ? data.new_video_url : data.new_stream_url;
                   switchToNewVideo();
                   // 停止轮询（已切换，无需继续检测）
                   clearInterval(videoSwitchPollTimer);
@@ -381,10 +388,22 @@ def check_new_video(case_id: str):
         if os.path.getsize(new_video_path) > 1024:
             video_exists = True
     
+    # 渲染过程中边写出的 HLS 播放列表（浏览器原生支持 HLS 时可提前切换）
+    stream_path = os.path.join(case_dir, "final_hls", "index.m3u8")
+    stream_exists = os.path.exists(stream_path) and os.path.getsize(stream_path) > 0
+    codec_path = os.path.join(case_dir, "final_hls", HLS_CODEC_INFO)
+    stream_codecs = None
+    if os.path.exists(codec_path):
+        with open(codec_path, "r", encoding="utf-8") as f:
+            stream_codecs = json.load(f).get("codecs")
+
     return jsonify({
         "ok": True,
         "new_video_exists": video_exists,  # 布尔值：True=已生成，False=未生成
-        "new_video_url": f"/static/{case_id}/raw_final_visualization_video.mp4"  # 新视频URL（提前返回，方便切换）
+        "new_video_url": f"/static/{case_id}/raw_final_visualization_video.mp4",  # 新视频URL（提前返回，方便切换）
+        "new_stream_exists": stream_exists,
+        "new_stream_url": f"/static/{case_id}/final_hls/index.m3u8",
+        "new_stream_codecs": stream_codecs
     })
 
 if __name__ == "__main__":
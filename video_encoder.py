@@ -0,0 +1,305 @@
+import json
+import os
+import queue
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+# ffmpeg 路径：优先环境变量 IRV_FFMPEG_PATH，其次 PATH 中的 ffmpeg，最后是系统默认位置
+FFMPEG_PATH = os.environ.get("IRV_FFMPEG_PATH") or shutil.which("ffmpeg") or "/usr/bin/ffmpeg"
+
+# 按优先级排列的候选编码器
+ENCODER_CANDIDATES = ("libx264", "mpeg4", "libopenh264")
+
+# 各编码器输出在浏览器 MediaSource 中对应的 codecs 字符串（x264 默认 High Profile，
+# openh264 为 Constrained Baseline，mpeg4 为 MPEG-4 Part 2），前端据此判断能否边下边播 HLS 分片
+ENCODER_MSE_CODECS = {"libx264": "avc1.64001f", "libopenh264": "avc1.42e01f", "mpeg4": "mp4v.20.9"}
+
+# 同时进行的编码数与每个编码使用的线程数上限（避免多个 case 同时编码时挤占数值计算阶段的 CPU）。
+# 最终结果视频边渲染边编码，名额在整个渲染期间都被占用，因此预览类编码单独一个名额池，
+# 新上传 case 的代理预览不会排在其他 case 的最终视频渲染后面
+MAX_CONCURRENT_ENCODES = max(1, int(os.environ.get("IRV_MAX_CONCURRENT_ENCODES", "2")))
+MAX_CONCURRENT_PREVIEW_ENCODES = max(1, int(os.environ.get("IRV_MAX_CONCURRENT_PREVIEW_ENCODES", "2")))
+ENCODE_THREADS = max(1, int(os.environ.get("IRV_ENCODE_THREADS", "2")))
+
+# 速度预设："proxy" 用于上传后立即生成的低分辨率代理预览，"preview" 用于完整预览（尽快出片），
+# "final" 用于最终结果视频（画质优先）；pool 为占用的编码名额池
+PRESETS = {
+    "proxy": {"x264_preset": "ultrafast", "crf": 28, "mpeg4_q": 10, "pool": "preview"},
+    "preview": {"x264_preset": "veryfast", "crf": 26, "mpeg4_q": 7, "pool": "preview"},
+    "final": {"x264_preset": "medium", "crf": 23, "mpeg4_q": 5, "pool": "final"},
+}
+
+_ENCODE_LIMITS = {"final": MAX_CONCURRENT_ENCODES, "preview": MAX_CONCURRENT_PREVIEW_ENCODES}
+_ENCODE_SLOTS = {pool: threading.BoundedSemaphore(limit) for pool, limit in _ENCODE_LIMITS.items()}
+_PROBE_LOCK = threading.Lock()
+_PROBE_CACHE = {}
+
+
+def probe_encoders(ffmpeg_path=None):
+    """
+    列出 ffmpeg 支持的编码器名称（ffmpeg -hide_banner -encoders）。
+    每个 ffmpeg 路径在进程内只探测一次，结果缓存；ffmpeg 不可用时返回空集合。
+    """
+    ffmpeg_path = ffmpeg_path or FFMPEG_PATH
+    with _PROBE_LOCK:
+        if ffmpeg_path in _PROBE_CACHE:
+            return _PROBE_CACHE[ffmpeg_path]
+        encoders = set()
+        try:
+            result = subprocess.run([ffmpeg_path, "-hide_banner", "-encoders"],
+                                    capture_output=True, text=True, check=True)
+            # 图例之后（"------" 行以下）每行形如 " V....D libx264   libx264 H.264 / AVC ..."
+            lines = result.stdout.splitlines()
+            start = next((i + 1 for i, line in enumerate(lines) if line.strip().startswith("---")), 0)
+            for line in lines[start:]:
+                parts = line.split()
+                if len(parts) >= 2 and len(parts[0]) == 6:
+                    encoders.add(parts[1])
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"[警告] 无法探测 ffmpeg 编码器（{ffmpeg_path}）：{e}")
+        _PROBE_CACHE[ffmpeg_path] = frozenset(encoders)
+        return _PROBE_CACHE[ffmpeg_path]
+
+
+def detect_encoder(candidates=ENCODER_CANDIDATES):
+    """按优先级返回第一个可用的编码器名（使用缓存的探测结果）。"""
+    available = probe_encoders()
+    for enc in candidates:
+        if enc in available:
+            return enc
+    raise RuntimeError("没有可用的视频编码器，请检查 ffmpeg 安装！")
+
+
+def encoder_args(preset="final", encoder=None, threads=None):
+    """
+    生成编码参数（-c:v 及画质、线程数参数）。
+
+    参数:
+    preset (str): 速度预设，见 PRESETS
+    encoder (str | None): 编码器名，None 时自动选择
+    threads (int | None): 单个编码的线程数，None 时为 ENCODE_THREADS
+    """
+    if preset not in PRESETS:
+        raise ValueError(f"未知的编码预设 {preset}，可选：{tuple(PRESETS)}")
+    settings = PRESETS[preset]
+    encoder = encoder or detect_encoder()
+    args = ["-c:v", encoder]
+    if encoder == "libx264":
+        args += ["-preset", settings["x264_preset"], "-crf", str(settings["crf"])]
+    elif encoder == "mpeg4":
+        args += ["-q:v", str(settings["mpeg4_q"])]
+    args += ["-threads", str(threads or ENCODE_THREADS)]
+    return args
+
+
+@contextmanager
+def encode_slot(preset="final"):
+    """占用预设所属名额池中的一个编码名额；名额用尽时等待同池的其他编码结束。"""
+    if preset not in PRESETS:
+        raise ValueError(f"未知的编码预设 {preset}，可选：{tuple(PRESETS)}")
+    pool = PRESETS[preset]["pool"]
+    slots = _ENCODE_SLOTS[pool]
+    if not slots.acquire(blocking=False):
+        print(f"[INFO] 已有 {_ENCODE_LIMITS[pool]} 个视频在编码（{pool} 名额池），等待空闲...")
+        slots.acquire()
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+HLS_PLAYLIST = "index.m3u8"
+HLS_CODEC_INFO = "codec.json"  # HLS 目录中记录实际使用的编码器与 codecs 字符串
+
+
+def _output_args(width, height, output_path, fps=25, hls_dir=None, hls_time=1):
+    args = ["-pix_fmt", "yuv420p"]   # 浏览器友好
+    if width % 2 or height % 2:
+        # yuv420p 要求宽高为偶数，奇数尺寸时补一行/一列
+        args += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2"]
+    if hls_dir is None:
+        return args + [output_path]
+
+    # 边编码边输出：同一路编码经 tee 同时写入 HLS（fMP4 分片 + event 播放列表）和完整 MP4；
+    # 每 hls_time 秒一个关键帧，保证分片按时切出，前端拿到前几个分片即可开始播放
+    hls_opts = ":".join([
+        "f=hls",
+        f"hls_time={hls_time}",
+        "hls_playlist_type=event",
+        "hls_segment_type=fmp4",
+        "hls_fmp4_init_filename=init.mp4",
+        f"hls_segment_filename={os.path.join(hls_dir, 'seg_%05d.m4s')}",
+    ])
+    tee = f"[f=mp4:movflags=+faststart]{output_path}|[{hls_opts}]{os.path.join(hls_dir, HLS_PLAYLIST)}"
+    return args + ["-g", str(max(1, int(fps * hls_time))), "-flags", "+global_header",
+                   "-map", "0:v", "-f", "tee", tee]
+
+
+def encode_png_sequence(frames_dir, output_path, preset="final", fps=25, pattern="%04d.png"):
+    """
+    将帧目录中的 PNG 序列（默认 %04d.png）编码为 MP4。
+
+    返回:
+    str: 输出视频路径；编码失败时抛出 subprocess.CalledProcessError
+    """
+    cmd = [
+        FFMPEG_PATH, "-y", "-hide_banner", "-loglevel", "error",
+        "-framerate", str(fps),
+        "-i", os.path.join(frames_dir, pattern),
+        *encoder_args(preset),
+        "-pix_fmt", "yuv420p",   # 浏览器友好
+        output_path,
+    ]
+    with encode_slot(preset):
+        try:
+            subprocess.run(cmd, check=True, capture_output=True, text=True)
+        except subprocess.CalledProcessError as e:
+            print(f"[错误] 命令：{' '.join(cmd)}")
+            print(f"[FFmpeg 输出] {e.stderr}")
+            raise
+    print(f"[OK] 视频已生成：{output_path}（{preset}）")
+    return output_path
+
+
+def _pipe_writer(stdin, frames_queue, state):
+    # 后台线程：把队列中的帧字节写入 ffmpeg 的 stdin；ffmpeg 提前退出时记录错误并继续取空队列
+    try:
+        while True:
+            data = frames_queue.get()
+            if data is None:
+                break
+            if state["error"] is None:
+                try:
+                    stdin.write(data)
+                except (BrokenPipeError, OSError) as e:
+                    state["error"] = e
+    finally:
+        try:
+            stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+
+def _drain_stderr(stream, chunks):
+    for line in iter(stream.readline, b""):
+        chunks.append(line)
+    stream.close()
+
+
+def encode_frames(frames, output_path, preset="final", fps=25, channel_order="bgr", queue_size=16,
+                  hls_dir=None, hls_time=1):
+    """
+    将帧迭代器直接以 rawvideo 写入 ffmpeg 的 stdin 编码为 MP4，
+    不需要先存 %04d.png 序列，也不需要临时帧目录。
+    提供 hls_dir 时同时边编码边写出 HLS 分片（hls_dir/index.m3u8）。
+    视频先写入 <name>.part.mp4，编码成功后再改名，避免前端读到未写完的文件。
+
+    参数:
+    frames (Iterable[np.ndarray]): uint8 帧；(H, W) 为灰度，(H, W, 3) 为彩色
+    output_path (str): 输出视频路径（.mp4）
+    preset (str): 速度预设，见 PRESETS
+    fps (int | float): 帧率
+    channel_order (str): 彩色帧的通道顺序，"bgr"（cv2 读入的默认顺序）或 "rgb"
+    queue_size (int): 待写入 ffmpeg 的最大缓冲帧数（帧的生成与编码并行，但内存有上限）
+    hls_dir (str | None): 可选，HLS 输出目录（已有内容会被清空）
+    hls_time (int): HLS 分片时长（秒）
+
+    返回:
+    str | None: 输出视频路径；没有任何帧时返回 None
+    """
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        print(f"错误: 没有可编码的帧，未生成 {output_path}")
+        return None
+
+    if first.ndim == 2:
+        pix_fmt = "gray"
+    elif first.ndim == 3 and first.shape[2] == 3:
+        pix_fmt = "bgr24" if channel_order == "bgr" else "rgb24"
+    else:
+        raise ValueError(f"不支持的帧形状: {first.shape}")
+    frame_shape = first.shape
+    height, width = frame_shape[:2]
+
+    base, ext = os.path.splitext(output_path)
+    mp4_path = f"{base}.part{ext}"
+    encoder = detect_encoder()
+    if hls_dir is not None:
+        shutil.rmtree(hls_dir, ignore_errors=True)
+        os.makedirs(hls_dir)
+        with open(os.path.join(hls_dir, HLS_CODEC_INFO), "w", encoding="utf-8") as f:
+            json.dump({"encoder": encoder, "codecs": ENCODER_MSE_CODECS.get(encoder)}, f)
+
+    cmd = [
+        FFMPEG_PATH, "-y", "-hide_banner", "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", pix_fmt, "-s", f"{width}x{height}", "-r", str(fps),
+        "-i", "-",
+        *encoder_args(preset, encoder),
+        *_output_args(width, height, mp4_path, fps=fps, hls_dir=hls_dir, hls_time=hls_time),
+    ]
+
+    with encode_slot(preset):
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        frames_queue = queue.Queue(maxsize=queue_size)
+        state = {"error": None}
+        stderr_chunks = []
+        writer = threading.Thread(target=_pipe_writer, args=(proc.stdin, frames_queue, state), daemon=True)
+        reader = threading.Thread(target=_drain_stderr, args=(proc.stderr, stderr_chunks), daemon=True)
+        writer.start()
+        reader.start()
+
+        count = 0
+        try:
+            frame = first
+            while frame is not None:
+                if frame.shape != frame_shape:
+                    raise ValueError(f"帧尺寸不一致：{frame.shape}，视频为 {frame_shape}")
+                if frame.dtype != np.uint8:
+                    raise TypeError(f"帧应为 uint8，实际为 {frame.dtype}")
+                frames_queue.put(np.ascontiguousarray(frame).tobytes())
+                count += 1
+                if state["error"] is not None:
+                    break
+                frame = next(frames, None)
+        except BaseException:
+            # 先结束 ffmpeg，写线程随之退出阻塞的写入并取空队列，再放入结束标记
+            proc.kill()
+            frames_queue.put(None)
+            writer.join()
+            proc.wait()
+            reader.join()
+            if os.path.exists(mp4_path):
+                os.remove(mp4_path)
+            raise
+
+        frames_queue.put(None)
+        writer.join()
+        returncode = proc.wait()
+        reader.join()
+
+    if returncode != 0 or state["error"] is not None:
+        print(f"[错误] 命令：{' '.join(cmd)}")
+        print(f"[FFmpeg 输出] {b''.join(stderr_chunks).decode('utf-8', errors='replace')}")
+        if os.path.exists(mp4_path):
+            os.remove(mp4_path)
+        raise subprocess.CalledProcessError(returncode, cmd)
+    os.replace(mp4_path, output_path)
+    print(f"[OK] 视频已生成：{output_path}（{count} 帧，{width}x{height}，{fps}fps，{preset}）")
+    return output_path
+
+# 调用方式：------------------------------------------------------------------------
+# # 预览：帧直接管道输入 ffmpeg（不落盘PNG），快速预设
+# encode_frames((frame for frame in frames_u8), "preview.mp4", preset="preview")
+#
+# # 最终结果：已有 %04d.png 帧目录时
+# encode_png_sequence("frames_dir", "final.mp4", preset="final")
+#
+# # 最终结果边渲染边播放：同时写出 final_hls/index.m3u8 分片
+# encode_frames(rendered_frames, "final.mp4", preset="final", hls_dir="final_hls")
+#
+# # 环境变量：IRV_FFMPEG_PATH / IRV_MAX_CONCURRENT_ENCODES / IRV_MAX_CONCURRENT_PREVIEW_ENCODES / IRV_ENCODE_THREADS